@@ -0,0 +1,413 @@
+import contextvars
+import heapq
+import itertools
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+from openai import AzureOpenAI, APIConnectionError, APIStatusError, APITimeoutError, RateLimitError
+
+from config import AZURE_DEPLOYMENTS, AZURE_HEALTH, AZURE_MODELS, AZURE_RETRY
+from metrics import REGISTRY, Counter, Gauge, current_span
+
+logger = logging.getLogger(__name__)
+
+# Request priorities: lower values are served first. They order the waiters
+# of one process's limiters; separate processes split the quota instead
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 10
+
+# Rough token cost of one image part at the default detail level
+IMAGE_TOKEN_ESTIMATE = 1100
+# Output budget assumed when a request does not set max_tokens
+DEFAULT_COMPLETION_ESTIMATE = 800
+
+_request_priority = contextvars.ContextVar('request_priority', default=PRIORITY_INTERACTIVE)
+
+THROTTLED = REGISTRY.register(Counter(
+    'aoai_throttled_total', 'Requests answered with 429 by deployment'))
+RETRIES = REGISTRY.register(Counter(
+    'aoai_retries_total', 'Retried model calls by deployment and reason'))
+LIMITER_WAIT = REGISTRY.register(Counter(
+    'aoai_limiter_wait_seconds_total', 'Time spent waiting for rate limiter capacity'))
+LIMITER_RATE = REGISTRY.register(Gauge(
+    'aoai_limiter_rate_rpm', 'Current adaptive request rate per deployment'))
+IN_FLIGHT = REGISTRY.register(Gauge(
+    'aoai_in_flight_requests', 'Model calls currently in flight per deployment'))
+
+
+@contextmanager
+def request_priority(priority):
+    """Run model calls made within this block at the given priority"""
+    token = _request_priority.set(priority)
+    try:
+        yield
+    finally:
+        _request_priority.reset(token)
+
+
+def estimate_tokens(kwargs):
+    """Estimate the prompt plus completion tokens a chat request will consume"""
+    chars = 0
+    images = 0
+    for message in kwargs.get('messages', []):
+        content = message.get('content')
+        if isinstance(content, str):
+            chars += len(content)
+        elif isinstance(content, list):
+            for part in content:
+                if part.get('type') == 'text':
+                    chars += len(part.get('text', ''))
+                elif part.get('type') == 'image_url':
+                    images += 1
+    for tool in kwargs.get('tools') or []:
+        chars += len(str(tool))
+    completion = kwargs.get('max_tokens') or kwargs.get('max_completion_tokens') or DEFAULT_COMPLETION_ESTIMATE
+    return chars // 4 + images * IMAGE_TOKEN_ESTIMATE + completion
+
+
+def _header_float(headers, name):
+    value = headers.get(name) if headers is not None else None
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def retry_after_seconds(headers):
+    """Read the server-requested delay from retry-after-ms / retry-after headers"""
+    retry_after_ms = _header_float(headers, 'retry-after-ms')
+    if retry_after_ms is not None:
+        return retry_after_ms / 1000
+    return _header_float(headers, 'retry-after')
+
+
+class TokenBucket:
+    """Continuously refilling bucket; not thread-safe on its own"""
+
+    def __init__(self, per_minute, now=None):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic() if now is None else now
+
+    def refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        # Requests larger than the whole bucket only need it to be full
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.rate
+
+    def clamp(self, remaining):
+        self.level = min(self.level, float(remaining))
+
+
+class DeploymentLimiter:
+    """RPM/TPM token buckets for one deployment with priority-ordered waiters.
+
+    The request rate adapts to the service: a 429 halts dispatch until its
+    Retry-After has passed and cuts the rate, successful calls slowly raise it
+    back, and x-ratelimit-remaining-* headers clamp the local buckets to what
+    the service reports. clock returns the current time in seconds.
+    """
+
+    def __init__(self, deployment, rpm, tpm, min_rate_fraction=0.1, clock=time.monotonic):
+        self.deployment = deployment
+        self.max_rpm = rpm
+        self.min_rpm = max(1.0, rpm * min_rate_fraction)
+        self.clock = clock
+        self.requests = TokenBucket(rpm, clock())
+        self.tokens = TokenBucket(tpm, clock())
+        self.blocked_until = 0.0
+        self.cooldown_until = 0.0
+        self._cond = threading.Condition()
+        self._waiters = []
+        self._sequence = itertools.count()
+        LIMITER_RATE.set(rpm, deployment=deployment)
+
+    def acquire(self, tokens, priority=PRIORITY_INTERACTIVE):
+        """Block until the request may be sent; returns seconds waited"""
+        ticket = (priority, next(self._sequence))
+        start = self.clock()
+        with self._cond:
+            heapq.heappush(self._waiters, ticket)
+            try:
+                while True:
+                    if self._waiters[0] == ticket:
+                        now = self.clock()
+                        self.requests.refill(now)
+                        self.tokens.refill(now)
+                        wait = max(self.blocked_until - now,
+                                   self.requests.wait_time(1),
+                                   self.tokens.wait_time(tokens))
+                        if wait <= 0:
+                            self.requests.level -= 1
+                            self.tokens.level -= min(tokens, self.tokens.capacity)
+                            heapq.heappop(self._waiters)
+                            self._cond.notify_all()
+                            break
+                        self._cond.wait(wait)
+                    else:
+                        self._cond.wait()
+            except BaseException:
+                self._waiters.remove(ticket)
+                heapq.heapify(self._waiters)
+                self._cond.notify_all()
+                raise
+        waited = self.clock() - start
+        if waited > 0.001:
+            LIMITER_WAIT.inc(waited, deployment=self.deployment)
+        return waited
+
+    def estimated_wait(self, tokens):
+        """Seconds until a request of this size could be dispatched, ignoring queued waiters"""
+        with self._cond:
+            now = self.clock()
+            self.requests.refill(now)
+            self.tokens.refill(now)
+            queued = len(self._waiters) / self.requests.rate
+            return max(self.blocked_until - now, self.requests.wait_time(1), self.tokens.wait_time(tokens)) + queued
+
+    def settle(self, estimated, actual):
+        """Correct the token bucket once the real usage of a call is known"""
+        if actual is None:
+            return
+        with self._cond:
+            self.tokens.level = min(self.tokens.capacity, self.tokens.level + estimated - actual)
+            self._cond.notify_all()
+
+    def observe_headers(self, headers):
+        remaining_requests = _header_float(headers, 'x-ratelimit-remaining-requests')
+        remaining_tokens = _header_float(headers, 'x-ratelimit-remaining-tokens')
+        with self._cond:
+            if remaining_requests is not None:
+                self.requests.clamp(remaining_requests)
+            if remaining_tokens is not None:
+                self.tokens.clamp(remaining_tokens)
+
+    def on_success(self):
+        with self._cond:
+            rpm = self.requests.rate * 60
+            if rpm < self.max_rpm:
+                self._set_rpm(min(self.max_rpm, rpm + max(1.0, self.max_rpm * 0.05)))
+
+    def on_throttled(self, retry_after):
+        with self._cond:
+            now = self.clock()
+            if retry_after:
+                self.blocked_until = max(self.blocked_until, now + retry_after)
+            # A burst of 429s from one overload only cuts the rate once
+            if now >= self.cooldown_until:
+                self._set_rpm(max(self.min_rpm, self.requests.rate * 60 * 0.7))
+                self.cooldown_until = now + max(retry_after or 0, 1.0)
+            self.requests.level = min(self.requests.level, 0.0)
+            self._cond.notify_all()
+
+    def _set_rpm(self, rpm):
+        self.requests.refill(self.clock())
+        self.requests.rate = rpm / 60.0
+        LIMITER_RATE.set(round(rpm, 2), deployment=self.deployment)
+
+
+class Deployment:
+    """One deployment in a role's pool, with its own client, limiter and health state"""
+
+    def __init__(self, role, deployment, endpoint, api_key, api_version, weight=1.0, rpm=60, tpm=60000):
+        self.role = role
+        self.name = deployment
+        self.endpoint = endpoint
+        self.weight = max(weight, 0.01)
+        self.label = f'{deployment}@{urlparse(endpoint or "").hostname or endpoint}'
+        self.client = AzureOpenAI(
+            api_version=api_version,
+            api_key=api_key,
+            azure_endpoint=endpoint,
+            max_retries=0  # Retries are handled by RateLimitedClient
+        )
+        self.limiter = DeploymentLimiter(self.label, rpm, tpm)
+        self.in_flight = 0
+        self.latency = None  # EWMA of seconds per successful call
+        self.consecutive_failures = 0
+        self.unhealthy_until = 0.0
+
+    def healthy(self, now):
+        return now >= self.unhealthy_until
+
+    def score(self, tokens):
+        """Expected time until this deployment could finish the request, scaled by weight"""
+        latency = self.latency if self.latency is not None else 1.0
+        return (self.limiter.estimated_wait(tokens) + latency * (self.in_flight + 1)) / self.weight
+
+
+class DeploymentPool:
+    """Latency- and load-aware routing across the deployments of one role"""
+
+    def __init__(self, role, deployments, failure_threshold=3, cooldown_seconds=30.0):
+        self.role = role
+        self.deployments = deployments
+        self.failure_threshold = failure_threshold
+        self.cooldown_seconds = cooldown_seconds
+        self._lock = threading.Lock()
+
+    def choose(self, tokens, exclude=()):
+        """Pick the best deployment not in exclude, preferring healthy ones"""
+        with self._lock:
+            now = time.monotonic()
+            candidates = [d for d in self.deployments if d not in exclude] or list(self.deployments)
+            healthy = [d for d in candidates if d.healthy(now)]
+            if healthy:
+                chosen = min(healthy, key=lambda d: d.score(tokens))
+            else:
+                chosen = min(candidates, key=lambda d: d.unhealthy_until)
+            chosen.in_flight += 1
+            IN_FLIGHT.set(chosen.in_flight, deployment=chosen.label)
+            return chosen
+
+    def release(self, deployment, latency=None, failed=False):
+        with self._lock:
+            deployment.in_flight -= 1
+            IN_FLIGHT.set(deployment.in_flight, deployment=deployment.label)
+            if latency is not None:
+                deployment.latency = latency if deployment.latency is None else 0.8 * deployment.latency + 0.2 * latency
+                deployment.consecutive_failures = 0
+            if failed:
+                deployment.consecutive_failures += 1
+                if deployment.consecutive_failures >= self.failure_threshold:
+                    deployment.unhealthy_until = time.monotonic() + self.cooldown_seconds
+                    logger.warning(f'{deployment.label} marked unhealthy for {self.cooldown_seconds:.0f}s '
+                                   f'after {deployment.consecutive_failures} consecutive failures')
+
+
+class RateLimitedClient:
+    """Azure OpenAI client that throttles, retries, load-balances and fails over across deployments"""
+
+    def __init__(self, pools, models=None, max_retries=6, base_delay=0.5, max_delay=30.0,
+                 clock=time.monotonic, sleep=time.sleep):
+        self.pools = pools
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.clock = clock
+        self.sleep = sleep
+        # Callers may still pass a deployment name as model; map it to its role
+        self._roles_by_model = {model: role for role, model in (models or {}).items()}
+
+    def backoff(self, attempt):
+        """Full-jitter exponential backoff"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    def create_chat_completion(self, role=None, priority=None, **kwargs):
+        """Send a chat completion to the best deployment for the role, retrying 429s and
+        transient failures and failing over to other deployments in the pool"""
+        role = role or self._roles_by_model.get(kwargs.get('model'), 'text')
+        pool = self.pools[role]
+        priority = _request_priority.get() if priority is None else priority
+        estimated = estimate_tokens(kwargs)
+
+        attempt = 0
+        tried = []
+        while True:
+            deployment = pool.choose(estimated, exclude=tried)
+            limiter = deployment.limiter
+            limiter.acquire(estimated, priority)
+            start = self.clock()
+            try:
+                raw = deployment.client.chat.completions.with_raw_response.create(
+                    **{**kwargs, 'model': deployment.name})
+            except RateLimitError as e:
+                pool.release(deployment)
+                headers = e.response.headers if e.response is not None else None
+                retry_after = retry_after_seconds(headers)
+                limiter.observe_headers(headers)
+                limiter.on_throttled(retry_after)
+                THROTTLED.inc(deployment=deployment.label)
+                delay = max(retry_after or 0, self.backoff(attempt))
+                reason = 'throttled'
+                error = e
+            except (APIConnectionError, APITimeoutError) as e:
+                pool.release(deployment, failed=True)
+                delay, reason, error = self.backoff(attempt), 'connection', e
+            except APIStatusError as e:
+                if e.status_code < 500:
+                    pool.release(deployment)
+                    raise
+                pool.release(deployment, failed=True)
+                delay, reason, error = self.backoff(attempt), 'server_error', e
+            except BaseException:
+                pool.release(deployment)
+                raise
+            else:
+                pool.release(deployment, latency=self.clock() - start)
+                limiter.observe_headers(raw.headers)
+                limiter.on_success()
+                completion = raw.parse()
+                if not kwargs.get('stream'):
+                    usage = getattr(completion, 'usage', None)
+                    limiter.settle(estimated, getattr(usage, 'total_tokens', None))
+                return completion
+
+            if attempt >= self.max_retries:
+                raise error
+            attempt += 1
+            RETRIES.inc(deployment=deployment.label, reason=reason)
+            stage = current_span()
+            if stage is not None:
+                stage.retries += 1
+
+            # Fail over immediately while the pool still has deployments that
+            # have not been tried in this round; back off once all have failed
+            tried.append(deployment)
+            if len(tried) < len(pool.deployments):
+                logger.warning(f'{deployment.label} call failed ({reason}), '
+                               f'failing over (retry {attempt}/{self.max_retries})')
+                continue
+            tried = []
+            logger.warning(f'{deployment.label} call failed ({reason}), retry {attempt}/{self.max_retries} in {delay:.2f}s')
+            self.sleep(delay)
+
+
+def create_client():
+    """Build the shared rate-limited client and deployment pools from config"""
+    # Pre-forked server workers each run their own limiter, so each one
+    # keeps to its share of every deployment's quota. Priorities only order
+    # the calls of one process, so other processes such as batch.py are given
+    # a fraction of the quota instead (AZURE_OPENAI_QUOTA_FRACTION)
+    workers = max(1, int(os.getenv('AZURE_OPENAI_QUOTA_WORKERS', '1')))
+    share = min(1.0, max(0.01, float(os.getenv('AZURE_OPENAI_QUOTA_FRACTION', '1')))) / workers
+    pools = {
+        role: DeploymentPool(
+            role,
+            [
+                Deployment(role, **{**entry, 'rpm': max(1, int(entry['rpm'] * share)),
+                                    'tpm': max(1, int(entry['tpm'] * share))})
+                for entry in entries
+            ],
+            **AZURE_HEALTH
+        )
+        for role, entries in AZURE_DEPLOYMENTS.items()
+    }
+    return RateLimitedClient(pools, models=AZURE_MODELS, **AZURE_RETRY)
+
+
+_shared_client = None
+_shared_client_lock = threading.Lock()
+
+
+def get_client():
+    """Return the process-wide client so every caller shares its limiters and pools"""
+    global _shared_client
+    if _shared_client is None:
+        with _shared_client_lock:
+            if _shared_client is None:
+                _shared_client = create_client()
+    return _shared_client
@@ -1,323 +1,227 @@
-from flask import Flask, render_template, request, jsonify
-import base64 
+from flask import Flask, Blueprint, render_template, request, jsonify, Response, send_file, url_for
 import os 
-from openai import AzureOpenAI 
+import json
 from dotenv import load_dotenv
-import io
-from pdf2image import convert_from_bytes
-import PyPDF2
 import logging
-import asyncio
-from tools import get_summary_card_tool, process_summary_card
-from history import HistoryManager
-from datetime import datetime
-from config import AZURE_CONFIG, AZURE_MODELS, MAX_FILE_SIZE, ALLOWED_EXTENSIONS
-
-app = Flask(__name__)
-app.config['MAX_CONTENT_LENGTH'] = MAX_FILE_SIZE
+import threading
+from sqlalchemy import text as sql_text
+from aoai_client import get_client
+from blobstore import BlobNotFound, get_blob_store
+from history import HistoryManager, source_key
+from database import engine, init_db
+from config import MAX_FILE_SIZE, ALLOWED_EXTENSIONS, PODCAST, SINGLE_FLIGHT, VARIANTS, VOICES
+from metrics import request_trace, render_metrics
+from logging_setup import configure_logging, payload
+from pipeline import PipelineError, extract_text, generate_narration, generate_variants, preload_modules
+from prompts import LANGUAGE_NAMES, TONE_INSTRUCTIONS, VOICE_STYLE_PROMPTS
+from retention import start_retention_worker
+from singleflight import get_single_flight, request_key
 
 # Load environment variables
 load_dotenv('keys.env')
 
-# Initialize Azure OpenAI client
-client = AzureOpenAI(
-    api_version=AZURE_CONFIG['api_version'],
-    api_key=AZURE_CONFIG['api_key'],
-    azure_endpoint=AZURE_CONFIG['azure_endpoint']
-)
-
-# Initialize history manager
-history_manager = HistoryManager()
-
-# Voice style mappings
-VOICE_STYLE_PROMPTS = {
-    'contemplating_british': """You are an expert voice actor specializing in silly voices. Respond and vocalize to the user the EXACT same input text, but in your voice response you MUST express EACH of the vocal cadence, inflection, and tone of David Attenborough.""",
-    
-    'curious_american': """You are an expert voice actor specializing in silly voices. Respond and vocalize to the user the EXACT same input text, but in your voice response you MUST express EACH of the vocal cadence, inflection, and tone of Bill Nye the Science Guy.""",
-    
-    'energetic_host': """You are an expert voice actor specializing in silly voices. Respond and vocalize to the user the EXACT same input text, but in your voice response you MUST express EACH of the vocal cadence, inflection, and tone of Jimmy Fallon.""",
-    
-    'thoughtful_journalist': """You are an expert voice actor specializing in silly voices. Respond and vocalize to the user the EXACT same input text, but in your voice response you MUST express EACH of the vocal cadence, inflection, and tone of Morgan Freeman.""",
-    
-    'friendly_interviewer': """You are an expert voice actor specializing in silly voices. Respond and vocalize to the user the EXACT same input text, but in your voice response you MUST express EACH of the vocal cadence, inflection, and tone of Oprah Winfrey.""",
-    
-    'authoritative_professor': """You are an expert voice actor specializing in silly voices. Respond and vocalize to the user the EXACT same input text, but in your voice response you MUST express EACH of the vocal cadence, inflection, and tone of Neil deGrasse Tyson.""",
-    
-    'passionate_expert': """You are an expert voice actor specializing in silly voices. Respond and vocalize to the user the EXACT same input text, but in your voice response you MUST express EACH of the vocal cadence, inflection, and tone of Tony Robbins.""",
-    
-    'analytical_researcher': """You are an expert voice actor specializing in silly voices. Respond and vocalize to the user the EXACT same input text, but in your voice response you MUST express EACH of the vocal cadence, inflection, and tone of Carl Sagan.""",
-    
-    'experienced_practitioner': """You are an expert voice actor specializing in silly voices. Respond and vocalize to the user the EXACT same input text, but in your voice response you MUST express EACH of the vocal cadence, inflection, and tone of Gordon Ramsay.""",
-    
-    'industry_veteran': """You are an expert voice actor specializing in silly voices. Respond and vocalize to the user the EXACT same input text, but in your voice response you MUST express EACH of the vocal cadence, inflection, and tone of Steve Jobs.""",
-    
-    'pirate_interviewer': """You are an expert voice actor specializing in silly voices. Respond and vocalize to the user the EXACT same input text, but in your voice response you MUST express EACH of the vocal cadence, inflection, and tone of Johnny Depp as Jack Sparrow.""",
-    
-    'vampire_expert': """You are an expert voice actor specializing in silly voices. Respond and vocalize to the user the EXACT same input text, but in your voice response you MUST express EACH of the vocal cadence, inflection, and tone of Christopher Lee as Count Dracula."""
-}
-
-ALLOWED_EXTENSIONS = {'txt', 'pdf', 'doc', 'docx'}
-
-# Set up logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('app.log'),
-        logging.StreamHandler()  # This will print to console as well
-    ]
-)
 logger = logging.getLogger(__name__)
 
+main = Blueprint('main', __name__)
+
+_history_manager = None
+_history_manager_lock = threading.Lock()
+
+def get_history_manager():
+    """Return the process-wide history manager, created on first use"""
+    global _history_manager
+    if _history_manager is None:
+        with _history_manager_lock:
+            if _history_manager is None:
+                _history_manager = HistoryManager()
+    return _history_manager
+
+def create_app(setup_database=True):
+    """Build the Flask app without opening clients or connections.
+
+    Azure OpenAI clients, the blob store and database connections are created
+    on first use, or up front by warm_up() once the serving process exists.
+    """
+    configure_logging()
+    app = Flask(__name__)
+    app.config['MAX_CONTENT_LENGTH'] = MAX_FILE_SIZE
+    app.register_blueprint(main)
+
+    if setup_database:
+        # Create missing tables and columns
+        init_db()
+    return app
+
+def warm_up():
+    """Import heavy modules and open clients and connections before the first request"""
+    preload_modules()
+    get_client()
+    get_blob_store()
+    get_history_manager()
+    with engine.connect() as connection:
+        connection.execute(sql_text('SELECT 1'))
+    start_retention_worker()
+    logger.info(f'Worker {os.getpid()} warmed up')
+
+@main.teardown_app_request
+def remove_session(exception=None):
+    # Return this thread's connection to the pool between requests
+    if _history_manager is not None:
+        _history_manager.db.remove()
+
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def extract_text_from_pdf_hybrid(pdf_bytes):
-    try:
-        # First try to extract text directly using PyPDF2
-        pdf_reader = PyPDF2.PdfReader(io.BytesIO(pdf_bytes))
-        num_pages = len(pdf_reader.pages)
-        logger.info(f'PDF has {num_pages} pages')
-        
-        text = ""
-        for page_num, page in enumerate(pdf_reader.pages, 1):
-            logger.info(f'Processing page {page_num}/{num_pages}')
-            page_text = page.extract_text()
-            if page_text.strip():
-                text += page_text + "\n"
-        
-        # If we got meaningful text, return it
-        if len(text.strip()) > 500:  # Arbitrary threshold
-            logger.info(f'Successfully extracted {len(text)} characters directly from PDF. Using text extraction.')
-            return text
-        else:
-            logger.info(f'Only extracted {len(text.strip())} characters, which is below threshold of 500. Falling back to vision.')
-
-        # If direct extraction didn't get enough text, fall back to vision approach
-        logger.info('Direct text extraction insufficient, falling back to vision approach')
-        return extract_text_from_pdf_vision(pdf_bytes)
+@main.route('/')
+def home():
+    return render_template('index.html')
 
-    except Exception as e:
-        logger.error(f'Error in hybrid PDF processing: {str(e)}', exc_info=True)
-        raise Exception(f"Could not process PDF: {str(e)}")
+@main.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
 
-async def process_page_vision(client, image, page_num, total_pages):
-    try:
-        logger.info(f'Processing page {page_num}/{total_pages}')
-        
-        # Convert image to PNG and base64
-        img_byte_arr = io.BytesIO()
-        image.save(img_byte_arr, format='PNG')
-        img_byte_arr = img_byte_arr.getvalue()
-        img_base64 = base64.b64encode(img_byte_arr).decode('utf-8')
-        logger.info(f'Page {page_num} converted to PNG and base64 encoded')
-    
-        # Send to text / vision model
-        logger.info(f'Sending page {page_num} to {AZURE_MODELS["text"]}')
-        
-        # Create a semaphore to limit concurrent API calls
-        sem = asyncio.Semaphore(10)
-        
-        async with sem:
-            completion = await asyncio.to_thread(
-                client.chat.completions.create,
-                model=AZURE_MODELS['text'],
-                messages=[
-                    {
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "text",
-                                "text": "Please read this document and extract all the text you see in a clear format. Also describe graphs, images, and tables in a clear format."
-                            },
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:image/png;base64,{img_base64}"
-                                }
-                            }
-                        ]
-                    }
-                ]
-            )
-        
-        page_text = completion.choices[0].message.content
-        logger.info(f'Successfully received text for page {page_num}')
-        return page_num, page_text
-    except Exception as e:
-        logger.error(f'Error processing page {page_num}: {str(e)}', exc_info=True)
-        raise
+@main.route('/upload-document', methods=['POST'])
+def upload_document():
+    with request_trace('upload_document') as trace:
+        response = process_upload_request()
+        logger.info(f'Request {trace.request_id} stage timings (s): '
+                    + ', '.join(f'{stage}={duration:.2f}' for stage, duration in trace.stage_totals().items()))
+    return response
+
+# Fields that must be one of a fixed set of values
+PARAMETER_CHOICES = {
+    'tone': TONE_INSTRUCTIONS,
+    'language': LANGUAGE_NAMES,
+    'voice': VOICES,
+    'voice1_style': VOICE_STYLE_PROMPTS,
+    'voice2_style': VOICE_STYLE_PROMPTS,
+    'voice2': VOICES
+}
 
-def extract_text_from_pdf_vision(pdf_bytes):
+def narration_params(values):
+    """generate_narration's keyword arguments from form fields (or a variant's fields); PipelineError if one is invalid"""
+    goal = values.get('goal', 'general_summary')
+    if not isinstance(goal, str) or not goal:
+        raise PipelineError(f'Invalid goal {goal!r}', 400)
     try:
-        # Convert PDF pages to images
-        logger.info('Converting PDF to images')
-        images = convert_from_bytes(pdf_bytes)
-        
-        if not images:
-            raise Exception("Could not convert PDF to images")
-            
-        logger.info(f'Successfully converted PDF to {len(images)} images')
-        
-        # Create an event loop for async operations
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        
-        # Process all pages concurrently with a semaphore limit of 10
-        total_pages = len(images)
-        tasks = []
-        for idx, image in enumerate(images, start=1):
-            task = process_page_vision(client, image, idx, total_pages)
-            tasks.append(task)
-        
-        # Run all tasks concurrently
-        logger.info(f'Processing all pages concurrently (max 10 at a time)')
-        all_results = loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
-        
-        # Handle any exceptions and collect successful results
-        processed_results = []
-        for result in all_results:
-            if isinstance(result, Exception):
-                logger.error(f'Page processing error: {str(result)}')
-                continue
-            processed_results.append(result)
-        
-        # Sort results by page number and extract text
-        processed_results.sort(key=lambda x: x[0])  # Sort by page number
-        all_text = [text for _, text in processed_results]
-        
-        # Combine text from all pages
-        final_text = "\n\n=== Page Break ===\n\n".join(all_text)
-        logger.info(f'Successfully processed all {len(processed_results)} pages')
-        logger.info(f'Final text:\n{final_text}')
-        
-        # Close the event loop
-        loop.close()
-        
-        return final_text
-
-    except Exception as e:
-        logger.error(f'Error in vision PDF processing: {str(e)}', exc_info=True)
-        raise Exception(f"Could not process PDF: {str(e)}")
-
-def summarize_text(text, target_minutes, tone, language, goal, goal_instruction=None, voice1_style=None, voice2_style=None):
+        # str() first, so JSON values such as 2.5 or true are not truncated to a number
+        summary_length = int(str(values.get('summary_length', '2')))
+    except ValueError:
+        summary_length = 0
+    if summary_length < 1:
+        raise PipelineError(f"Invalid summary_length {values.get('summary_length')!r}: expected a whole number of minutes", 400)
+    params = {
+        'summary_length': summary_length,
+        'tone': values.get('tone', 'conversational'),
+        'language': values.get('language', 'english'),
+        'goal': goal,
+        'goal_instruction': values.get('goal_instruction') if goal == 'custom' else None,
+        'voice': values.get('voice', 'alloy'),
+        'voice1_style': values.get('voice1_style', 'contemplating_british') if goal == 'podcast' else None,
+        'voice2_style': values.get('voice2_style', 'authoritative_professor') if goal == 'podcast' else None,
+        'voice2': values.get('voice2', PODCAST['second_voice']) if goal == 'podcast' else None
+    }
+    for field, choices in PARAMETER_CHOICES.items():
+        value = params[field]
+        if value is not None and (not isinstance(value, str) or value not in choices):
+            raise PipelineError(f'Invalid {field} {value!r}: expected one of {", ".join(sorted(choices))}', 400)
+    if goal == 'custom' and not isinstance(params['goal_instruction'], str):
+        raise PipelineError('A custom goal needs a goal_instruction', 400)
+    return params
+
+def audio_url(entry_id):
+    """URL the entry's WAV file is streamed from"""
+    return url_for('main.get_entry_audio', entry_id=entry_id)
+
+def history_settings(params, processing_method):
+    """Settings stored with a history entry"""
+    return {
+        'summary_length': params['summary_length'],
+        'tone': params['tone'],
+        'language': params['language'],
+        'goal': params['goal'],
+        'goal_instruction': params['goal_instruction'],
+        'voice': params['voice'],
+        'voice2': params['voice2'],
+        'processing_method': processing_method
+    }
+
+def process_variants(variants_json, rerun_text, file_bytes, original_filename, processing_method):
+    """Narrate one document in several variants, extracting it only once.
+
+    variants_json is a JSON list of objects, each overriding some of the form's
+    generation fields, e.g. [{"language": "german"}, {"summary_length": 10}].
+    """
     try:
-        # Add logging at the start of summarize_text
-        logger.info(f"summarize_text called with:")
-        logger.info(f"  target_minutes: {target_minutes}")
-        logger.info(f"  tone: {tone}")
-        logger.info(f"  language: {language}")
-        logger.info(f"  goal: {goal}")
-        if goal == "custom":
-            logger.info(f"  goal_instruction: {goal_instruction}")
-        if goal == "podcast":
-            logger.info(f"  voice1_style: {voice1_style}")
-            logger.info(f"  voice2_style: {voice2_style}")
-        
-        # Create a mapping for proper language names
-        language_mapping = {
-            'english': 'English',
-            'spanish': 'Spanish',
-            'french': 'French',
-            'german': 'German',
-            'italian': 'Italian',
-            'portuguese': 'Portuguese',
-            'dutch': 'Dutch',
-            'polish': 'Polish',
-            'japanese': 'Japanese',
-            'chinese': 'Chinese',
-            'korean': 'Korean',
-            'swedish': 'Swedish'
-        }
-        
-        # Get proper language name or default to English
-        target_language = language_mapping.get(language.lower(), 'English')
-        logger.info(f"  Mapped language '{language}' to '{target_language}'")
-        
-        logger.info(f'Starting text summarization for {target_minutes} minute(s) in {tone} tone, language: {target_language}')
-        logger.info(f'Input text length: {len(text)} characters')
-        
-        # Assuming average speaking rate of 150 words per minute
-        target_words = target_minutes * 110
-        
-        # Add tone-specific instructions
-        tone_instructions = {
-            'professional': "Use clear, precise language with business-appropriate terminology.",
-            'conversational': "Use natural, friendly language as if speaking to a friend.",
-            'enthusiastic': "Use energetic and engaging language with dynamic expressions.",
-            'formal': "Use sophisticated vocabulary and academic language.",
-            'casual': "Use relaxed, everyday language and a laid-back style.",
-            'empathetic': "Use warm, understanding language that shows emotional awareness."
-        }
-        
-        # Add goal-specific instructions
-        goal_instructions = {
-            'general_summary': "Create a comprehensive overview of the main points and key takeaways from the document.",
-            'key_insights': "Focus on extracting and highlighting the most important insights, findings, and key points from the document.",
-            'action_items': "Identify and list the main action items, tasks, and next steps mentioned in the document.",
-            'topic_analysis': "Analyze the document with a focus on the specific topic or aspect requested.",
-            'recommendations': "Extract and elaborate on the recommendations, suggestions, and proposed solutions from the document.",
-            'podcast': f"""Create an engaging conversation about the document between two people:
-Speaker 1 ({VOICE_STYLE_PROMPTS[voice1_style] if voice1_style else 'contemplating_british'}): Ask insightful questions about the content.
-Speaker 2 ({VOICE_STYLE_PROMPTS[voice2_style] if voice2_style else 'authoritative_professor'}): Provide detailed, informative answers.
-Make it feel like a natural podcast discussion while covering the key points from the document. When creating the summary put emphasis on the speak tone like  voice)"""
-        }
-        
-        tone_instruction = tone_instructions.get(tone, tone_instructions['conversational']) if goal != 'podcast' else ""
-        goal_instruction = goal_instructions.get(goal, goal_instruction if goal == "custom" else "Analyze the document according to this specific goal: " + goal)
-        
-        # Add language-specific instruction
-        language_instruction = f"The summary must be written entirely in {target_language}. Do not use any other language."
-        
-        completion = client.chat.completions.create(
-            model=AZURE_MODELS['text'],
-            messages=[
-                {
-                    "role": "system",
-                    "content": f"""You are a specialized document analyzer. {language_instruction}
-
-Your task: {goal_instruction}
-
-Format your response as a clear, engaging summary that takes approximately {target_minutes} minute(s) to read aloud (about {target_words} words). {tone_instruction}
-
-Focus on delivering content that precisely matches the specified goal while maintaining a natural speaking flow. The summary should be like a script for audiobook narrator.
-For every 100 words, make a page break, write out === Page Break === """
-                },
-                {
-                    "role": "user",
-                    "content": f"Please analyze this text in {target_language}, focusing on the specified goal and aiming for approximately {target_words} words:\n\n{text}"
-                }
-            ]
+        overrides = json.loads(variants_json)
+    except json.JSONDecodeError:
+        raise PipelineError('variants must be a JSON list', 400)
+    if not isinstance(overrides, list) or not overrides or not all(isinstance(item, dict) for item in overrides):
+        raise PipelineError('variants must be a non-empty JSON list of objects', 400)
+    if len(overrides) > VARIANTS['max_variants']:
+        raise PipelineError(f"At most {VARIANTS['max_variants']} variants per request", 400)
+    # Every variant is validated before any of them runs
+    form = request.form.to_dict()
+    variants = [narration_params({**form, **override}) for override in overrides]
+
+    # The extracted text is stored once per document, so later variant
+    # requests for the same document skip extraction too
+    history_manager = get_history_manager()
+    source_id = source_key(file_bytes if file_bytes is not None else rerun_text, processing_method)
+    text = history_manager.get_source_text(source_id)
+    if text is None:
+        text = rerun_text or extract_text(original_filename, file_bytes, processing_method)
+        if not text:
+            logger.error('Text extraction failed')
+            raise PipelineError('Could not extract text from file', 400)
+        history_manager.save_source(source_id, original_filename, processing_method, text)
+    else:
+        logger.info(f'Using stored text of source document {source_id[:12]}')
+
+    logger.info(f'Generating {len(variants)} variants (text length: {len(text)} characters)')
+    results = []
+    for params, result in zip(variants, generate_variants(text, variants)):
+        if isinstance(result, Exception):
+            status_code = result.status_code if isinstance(result, PipelineError) else 500
+            results.append({'status': 'error', 'message': str(result), 'status_code': status_code, 'settings': params})
+            continue
+        entry_id = history_manager.save_entry(
+            audio=result['audio'],
+            summary_html=result['formatted_summary'],
+            original_filename=original_filename,
+            metadata=history_settings(params, processing_method),
+            # The text is kept once, on the source document
+            extracted_text=None,
+            source_id=source_id
         )
-        
-        summary = completion.choices[0].message.content
-        logger.info(f'Successfully generated {tone} summary in {target_language} (length: {len(summary)} characters)')
-        logger.info(f'Summary:\n{summary}')
-        return summary
-        
-    except Exception as e:
-        logger.error(f'Error summarizing text: {str(e)}', exc_info=True)
-        return None
+        results.append({
+            'status': 'success',
+            'entry_id': entry_id,
+            'audio_url': audio_url(entry_id),
+            'text_response': result['formatted_summary'],
+            'settings': params
+        })
 
-@app.route('/')
-def home():
-    return render_template('index.html')
+    succeeded = sum(1 for result in results if result['status'] == 'success')
+    logger.info(f'{succeeded} of {len(results)} variants succeeded')
+    response = {'status': 'success' if succeeded else 'error', 'source_id': source_id, 'variants': results}
+    return jsonify(response), 200 if succeeded else results[0]['status_code']
 
-@app.route('/upload-document', methods=['POST'])
-def upload_document():
+def process_upload_request():
     try:
-        # Add detailed logging of all form data
+        # Log the form data, with long fields such as rerun_text shortened
         logger.info("Received form data:")
         for key, value in request.form.items():
-            logger.info(f"  {key}: {value}")
+            logger.info(f"  {key}: {payload(value)}")
 
         # Check if this is a rerun
         rerun_text = request.form.get('rerun_text')
         if rerun_text:
             logger.info("Processing rerun request with existing text")
-            text = rerun_text
             # For reruns, we'll keep the original filename from the request
             original_filename = request.form.get('original_filename', 'Unknown Document')
+            file_bytes = None
+            processing_method = 'rerun'
         else:
             # Normal file processing
             if 'file' not in request.files:
@@ -342,162 +246,73 @@ def upload_document():
             file_bytes = file.read()
             file_size = len(file_bytes) / 1024  # Size in KB
             logger.info(f'File size: {file_size:.2f} KB')
-            
-            # Extract text based on file type and processing method
-            if file.filename.endswith('.pdf'):
-                logger.info('Processing PDF file')
-                if processing_method == 'vision':
-                    text = extract_text_from_pdf_vision(file_bytes)
-                else:
-                    text = extract_text_from_pdf_hybrid(file_bytes)
-            else:  # For txt files
-                logger.info('Processing TXT file')
-                text = file_bytes.decode('utf-8')
 
-        if not text:
-            logger.error('Text extraction failed')
-            return jsonify({'status': 'error', 'message': 'Could not extract text from file'}), 400
-
-        logger.info(f'Successfully extracted/received text (length: {len(text)} characters)')
+        variants = request.form.get('variants')
+        if variants:
+            return process_variants(variants, rerun_text, file_bytes, original_filename, processing_method)
 
         # Get processing parameters
-        summary_length = int(request.form.get('summary_length', '2'))
-        tone = request.form.get('tone', 'conversational')
-        language = request.form.get('language', 'english')
-        goal = request.form.get('goal', 'general_summary')
-        goal_instruction = request.form.get('goal_instruction') if goal == 'custom' else None
-        voice1_style = request.form.get('voice1_style', 'contemplating_british') if goal == 'podcast' else None
-        voice2_style = request.form.get('voice2_style', 'authoritative_professor') if goal == 'podcast' else None
-
-        # Summarize the text with target length
-        logger.info(f'Starting text summarization for {summary_length} minute(s)')
-        summary = summarize_text(text, summary_length, tone, language, goal, goal_instruction, voice1_style, voice2_style)
-        if not summary:
-            logger.error('Summarization failed')
-            return jsonify({'status': 'error', 'message': 'Could not summarize text'}), 500
-
-        logger.info(f'Successfully generated {summary_length}-minute summary (length: {len(summary)} characters)')
-
-        # Generate audio from summary
-        logger.info('Starting audio generation')
-        voice = request.form.get('voice', 'alloy')
-        logger.info(f'Using voice: {voice}')
-
-        # First, get the formatted summary
-        logger.info('Creating formatted summary card')
-        format_completion = client.chat.completions.create(
-            model=AZURE_MODELS['text'],
-            messages=[
-                {
-                    "role": "system",
-                    "content": f"You are a content formatter. Create a beautifully formatted summary card using the create_summary_card tool. Format the content according to the goal: {goal if goal != 'custom' else goal_instruction}"
-                },
-                {
-                    "role": "user",
-                    "content": summary
-                }
-            ],
-            tools=[get_summary_card_tool(goal, goal_instruction)],
-            tool_choice="required"
-        )
+        params = {**narration_params(request.form), 'processing_method': processing_method}
 
-        # Process the tool calls to create formatted summary
-        formatted_summary = summary
-        if hasattr(format_completion.choices[0].message, 'tool_calls') and format_completion.choices[0].message.tool_calls:
-            tool_call = format_completion.choices[0].message.tool_calls[0]
-            if tool_call.function.name == "create_summary_card":
-                formatted_summary = process_summary_card(tool_call, goal, goal_instruction)
-
-        # Generate audio chunks
-        summary_chunks = summary.split("=== Page Break ===")
-        summary_chunks = [chunk.strip() for chunk in summary_chunks if chunk.strip()]
-        logger.info(f'Split summary into {len(summary_chunks)} chunks')
-        
-        audio_chunks = []
-        for i, chunk in enumerate(summary_chunks):
-            logger.info(f'Processing chunk {i+1}/{len(summary_chunks)}')
-            chunk_completion = client.chat.completions.create(
-                model=AZURE_MODELS['audio'],
-                messages=[
-                    {
-                        "role": "system",
-                        "content": [
-                            {
-                                "type": "text",
-                                "text": f"""You are a professional audiobook reader. Your task is to read the provided text in {language}, ensuring it remains engaging throughout.
-
-- **Language**: {language}
-- **Voice**: {voice}
-{f'- **Voice Style**: For Speaker 1 use: {VOICE_STYLE_PROMPTS[voice1_style]}, For Speaker 2 use: {VOICE_STYLE_PROMPTS[voice2_style]} this is VERY IMPORTANT' if goal == 'podcast' else f'- **Tone**: {tone}'}
-
-# Output Format
-Produce an engaging {'podcast' if goal == 'podcast' else 'audiobook narration'} in {language}, maintaining the specified {'voice style but do not read (SPEAKER etc out load), it is VERY IMPORTANT you adhere to the voice styles for each speaker' if goal == 'podcast' else 'tone'} and read the text WORD for WORD."""
-                            }
-                        ]
-                    },
-                    {
-                        "role": "user",
-                        "content": chunk
-                    }
-                ],
-                modalities=["text", "audio"],
-                audio={"voice": voice, "format": "wav"},
-                temperature=1.2,
-                top_p=1,
-                frequency_penalty=0,
-                presence_penalty=0
+        def generate():
+            text = rerun_text or extract_text(original_filename, file_bytes, processing_method)
+            if not text:
+                logger.error('Text extraction failed')
+                raise PipelineError('Could not extract text from file', 400)
+
+            logger.info(f'Successfully extracted/received text (length: {len(text)} characters)')
+
+            result = generate_narration(
+                text, params['summary_length'], params['tone'], params['language'], params['goal'],
+                params['goal_instruction'], params['voice'], params['voice1_style'], params['voice2_style'],
+                params['voice2']
             )
-            
-            audio_data = base64.b64decode(chunk_completion.choices[0].message.audio.data)
-            audio_chunks.append(audio_data)
-            logger.info(f'Successfully generated audio for chunk {i+1}')
-
-        # Combine audio chunks
-        logger.info('Combining audio chunks')
-        from pydub import AudioSegment
-        import io
-
-        combined_audio = AudioSegment.empty()
-        for audio_data in audio_chunks:
-            audio_segment = AudioSegment.from_wav(io.BytesIO(audio_data))
-            combined_audio += audio_segment
-
-        combined_audio_bytes = io.BytesIO()
-        combined_audio.export(combined_audio_bytes, format='wav')
-        combined_audio_base64 = base64.b64encode(combined_audio_bytes.getvalue()).decode('utf-8')
-        logger.info('Successfully combined all audio chunks')
-
-        # Save to history (always save, whether it's a rerun or not)
-        history_metadata = {
-            'summary_length': summary_length,
-            'tone': tone,
-            'language': language,
-            'goal': goal,
-            'goal_instruction': goal_instruction if goal == 'custom' else None,
-            'voice': voice,
-            'processing_method': request.form.get('processing_method', 'vision') if not rerun_text else 'rerun'
-        }
-        
-        history_manager.save_entry(
-            audio_data=combined_audio_base64,
-            summary_html=formatted_summary,
-            original_filename=original_filename,
-            metadata=history_metadata,
-            extracted_text=text
-        )
+
+            # Save to history (always save, whether it's a rerun or not)
+            entry_id = get_history_manager().save_entry(
+                audio=result['audio'],
+                summary_html=result['formatted_summary'],
+                original_filename=original_filename,
+                metadata=history_settings(params, processing_method),
+                extracted_text=text
+            )
+            return {
+                'entry_id': entry_id,
+                'formatted_summary': result['formatted_summary']
+            }
+
+        def load_result(entry_id):
+            entry = get_history_manager().get_entry(entry_id)
+            if entry is None:
+                raise PipelineError('Generated entry is no longer available', 500)
+            return {
+                'entry_id': entry_id,
+                'formatted_summary': entry['summary_html']
+            }
+
+        # Identical requests that overlap in time share one generation
+        if SINGLE_FLIGHT['enabled']:
+            key = request_key(file_bytes if file_bytes is not None else rerun_text,
+                              {**params, 'original_filename': original_filename})
+            result = get_single_flight().run(key, generate, load_result)
+        else:
+            result = generate()
 
         logger.info('Successfully generated audio and formatted summary')
         return jsonify({
             'status': 'success',
-            'audio_data': combined_audio_base64,
-            'text_response': formatted_summary
+            'entry_id': result['entry_id'],
+            'audio_url': audio_url(result['entry_id']),
+            'text_response': result['formatted_summary']
         })
 
+    except PipelineError as e:
+        return jsonify({'status': 'error', 'message': e.message}), e.status_code
     except Exception as e:
         logger.error(f'Error in upload_document: {str(e)}', exc_info=True)
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
-@app.route('/history', methods=['GET'])
+@main.route('/history', methods=['GET'])
 def get_history():
     try:
         page = request.args.get('page', 1, type=int)
@@ -505,7 +320,9 @@ def get_history():
         offset = (page - 1) * limit
         include_text = request.args.get('include_text', 'false').lower() == 'true'
         
-        entries = history_manager.get_entries(limit=limit, offset=offset, include_text=include_text)
+        entries = get_history_manager().get_entries(limit=limit, offset=offset, include_text=include_text)
+        for entry in entries:
+            entry['audio_url'] = audio_url(entry['id'])
         return jsonify({
             'status': 'success',
             'entries': entries
@@ -514,10 +331,30 @@ def get_history():
         logger.error(f'Error getting history: {str(e)}', exc_info=True)
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
-@app.route('/history/text/<entry_id>', methods=['GET'])
+@main.route('/history/<entry_id>/audio', methods=['GET'])
+def get_entry_audio(entry_id):
+    """Stream an entry's WAV file from the blob store"""
+    try:
+        audio = get_history_manager().open_audio(entry_id)
+        if audio is None:
+            return jsonify({'status': 'error', 'message': 'Entry not found'}), 404
+        stream, size, mime_type, audio_hash = audio
+        response = send_file(stream, mimetype=mime_type or 'audio/wav', etag=audio_hash or False,
+                             conditional=False, download_name=f'{entry_id}.wav')
+        # Range requests let the player seek without downloading the whole file
+        response.content_length = size
+        return response.make_conditional(request, accept_ranges=True, complete_length=size)
+    except BlobNotFound:
+        logger.error(f'Audio of entry {entry_id} is missing from the blob store')
+        return jsonify({'status': 'error', 'message': 'Audio not found'}), 404
+    except Exception as e:
+        logger.error(f'Error getting entry audio: {str(e)}', exc_info=True)
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+@main.route('/history/text/<entry_id>', methods=['GET'])
 def get_entry_text(entry_id):
     try:
-        text = history_manager.get_entry_text(entry_id)
+        text = get_history_manager().get_entry_text(entry_id)
         if text:
             return jsonify({
                 'status': 'success',
@@ -528,12 +365,11 @@ def get_entry_text(entry_id):
         logger.error(f'Error getting entry text: {str(e)}', exc_info=True)
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
-@app.route('/history/<entry_id>', methods=['DELETE'])
+@main.route('/history/<entry_id>', methods=['DELETE'])
 def delete_history_entry(entry_id):
     """Delete a specific history entry"""
     try:
-        history_manager = HistoryManager()
-        success = history_manager.delete_entry(entry_id)
+        success = get_history_manager().delete_entry(entry_id)
         if success:
             return jsonify({"status": "success", "message": "Entry deleted successfully"})
         else:
@@ -542,4 +378,6 @@ def delete_history_entry(entry_id):
         return jsonify({"status": "error", "message": str(e)}), 500
 
 if __name__ == '__main__':
+    app = create_app()
+    start_retention_worker()
     app.run(debug=True, host='0.0.0.0', port=5001) 
\ No newline at end of file
@@ -0,0 +1,125 @@
+import binascii
+import io
+import struct
+import wave
+
+import numpy as np
+
+# Number of bars in the history list waveform
+WAVEFORM_PEAKS = 120
+
+# Streamed pcm16 audio from the audio deployment: 24 kHz, 16-bit, mono
+PCM16_SAMPLE_RATE = 24000
+
+_SAMPLE_DTYPES = {1: np.uint8, 2: '<i2', 4: '<i4'}
+
+
+def pcm_samples(frames, sample_width, channels):
+    """Decode little-endian PCM frames into a (samples, channels) float array in [-1, 1]"""
+    dtype = _SAMPLE_DTYPES.get(sample_width)
+    if dtype is None:
+        raise Exception(f"Unsupported sample width: {sample_width} bytes")
+    samples = np.frombuffer(frames, dtype=dtype)
+    samples = samples[:len(samples) - len(samples) % channels].reshape(-1, channels)
+    if sample_width == 1:
+        # 8-bit WAV is unsigned with silence at 128
+        return (samples.astype(np.float32) - 128.0) / 128.0
+    return samples.astype(np.float32) / float(2 ** (8 * sample_width - 1))
+
+
+def waveform_peaks(samples, buckets=WAVEFORM_PEAKS):
+    """Downsample to the loudest absolute amplitude per bucket, normalised to the loudest bucket"""
+    if len(samples) == 0:
+        return []
+    # Fold channels first, then split the signal into equal buckets padded with silence
+    amplitude = np.abs(samples).max(axis=1)
+    buckets = min(buckets, len(amplitude))
+    bucket_size = -(-len(amplitude) // buckets)
+    padded = np.zeros(buckets * bucket_size, dtype=amplitude.dtype)
+    padded[:len(amplitude)] = amplitude
+    peaks = padded.reshape(buckets, bucket_size).max(axis=1)
+    loudest = peaks.max()
+    if loudest > 0:
+        peaks = peaks / loudest
+    return np.round(peaks.astype(np.float64), 3).tolist()
+
+
+def analyze_wav(wav_data, buckets=WAVEFORM_PEAKS):
+    """Return duration, format details and waveform peaks for a WAV file (bytes or a binary file object)"""
+    source = wav_data if hasattr(wav_data, 'read') else io.BytesIO(wav_data)
+    with wave.open(source, 'rb') as wav:
+        channels = wav.getnchannels()
+        sample_width = wav.getsampwidth()
+        sample_rate = wav.getframerate()
+        frames = wav.readframes(wav.getnframes())
+
+    samples = pcm_samples(frames, sample_width, channels)
+    return {
+        'duration_seconds': round(len(samples) / sample_rate, 3) if sample_rate else 0.0,
+        'sample_rate': sample_rate,
+        'channels': channels,
+        'sample_width': sample_width,
+        'peaks': waveform_peaks(samples, buckets)
+    }
+
+
+class PcmBuffer:
+    """Raw PCM frames decoded from base64 audio deltas into a preallocated buffer"""
+
+    def __init__(self, capacity=0, sample_rate=PCM16_SAMPLE_RATE, channels=1, sample_width=2):
+        self._data = bytearray(capacity)
+        self.length = 0
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.sample_width = sample_width
+
+    def append_base64(self, encoded):
+        """Decode one audio delta into the buffer and return its frames"""
+        frames = binascii.a2b_base64(encoded)
+        end = self.length + len(frames)
+        if end > len(self._data):
+            # Grow at least geometrically when the size estimate was too small
+            self._data.extend(bytes(max(end - len(self._data), len(self._data))))
+        self._data[self.length:end] = frames
+        self.length = end
+        return frames
+
+    @property
+    def duration_seconds(self):
+        return self.length / (self.sample_rate * self.channels * self.sample_width)
+
+    def frames(self):
+        return memoryview(self._data)[:self.length]
+
+
+def wav_header(data_size, sample_rate=PCM16_SAMPLE_RATE, channels=1, sample_width=2):
+    """The 44-byte RIFF header of a PCM WAV file holding data_size bytes of frames"""
+    byte_rate = sample_rate * channels * sample_width
+    return struct.pack(
+        '<4sI4s4sIHHIIHH4sI',
+        b'RIFF', 36 + data_size, b'WAVE',
+        b'fmt ', 16, 1, channels, sample_rate, byte_rate, channels * sample_width, 8 * sample_width,
+        b'data', data_size
+    )
+
+
+def pcm_to_wav(buffers, gaps=None):
+    """Join PcmBuffers of the same format into one WAV file, copying each frame once.
+
+    gaps, if given, holds the seconds of silence to put after each buffer but
+    the last.
+    """
+    first = buffers[0]
+    frame_size = first.channels * first.sample_width
+    gap_sizes = [int(seconds * first.sample_rate) * frame_size for seconds in (gaps or [])]
+    total = sum(buffer.length for buffer in buffers) + sum(gap_sizes[:len(buffers) - 1])
+    # Zero-filled, so the gaps are already silence
+    wav = bytearray(44 + total)
+    wav[:44] = wav_header(total, first.sample_rate, first.channels, first.sample_width)
+    offset = 44
+    for index, buffer in enumerate(buffers):
+        wav[offset:offset + buffer.length] = buffer.frames()
+        offset += buffer.length
+        if index < len(buffers) - 1 and index < len(gap_sizes):
+            offset += gap_sizes[index]
+    return wav
@@ -0,0 +1,254 @@
+"""Unattended batch processing of many documents through the pipeline.
+
+Takes a folder of documents or a JSONL manifest with one document per line:
+    {"file": "reports/q1.pdf", "goal": "key_insights", "tone": "professional",
+     "voice": "alloy", "language": "german", "summary_length": 5}
+
+Missing fields fall back to the command-line defaults; relative paths are
+resolved against the manifest's folder. Progress is checkpointed so an
+interrupted run resumes where it stopped, and results are written to history
+in bulk inserts.
+
+Usage:
+    python batch.py reports/ --parallelism 4 --goal key_insights
+    python batch.py nightly.jsonl --parallelism 8 --commit-every 20 --quota-fraction 0.3
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from dotenv import load_dotenv
+
+load_dotenv('keys.env')
+
+from aoai_client import PRIORITY_BATCH, request_priority
+from config import ALLOWED_EXTENSIONS, PODCAST
+from database import init_db
+from history import HistoryManager, new_entry_id
+from logging_setup import configure_logging
+from metrics import request_trace
+from pipeline import PipelineError, extract_text, generate_narration
+
+logger = logging.getLogger('batch')
+
+# Generation parameters a manifest line may set, with their defaults
+PARAMETER_DEFAULTS = {
+    'summary_length': 2,
+    'tone': 'conversational',
+    'language': 'english',
+    'goal': 'general_summary',
+    'goal_instruction': None,
+    'voice': 'alloy',
+    'voice1_style': 'contemplating_british',
+    'voice2_style': 'authoritative_professor',
+    'voice2': PODCAST['second_voice'],
+    'processing_method': 'vision',
+}
+
+
+def load_jobs(source, defaults):
+    """Build the job list from a folder or a JSONL manifest"""
+    if os.path.isdir(source):
+        # Paths are relative to the folder and resolved against it below
+        entries = [
+            {'file': name}
+            for name in sorted(os.listdir(source))
+            if name.rsplit('.', 1)[-1].lower() in ALLOWED_EXTENSIONS
+        ]
+        base_dir = source
+    else:
+        base_dir = os.path.dirname(os.path.abspath(source))
+        entries = []
+        with open(source) as f:
+            for line_number, line in enumerate(f, start=1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entries.append(json.loads(line))
+                except json.JSONDecodeError as e:
+                    raise SystemExit(f'{source}:{line_number}: invalid JSON: {e}')
+
+    jobs = []
+    for entry in entries:
+        path = entry['file'] if os.path.isabs(entry['file']) else os.path.join(base_dir, entry['file'])
+        params = {key: entry.get(key, defaults[key]) for key in PARAMETER_DEFAULTS}
+        params['summary_length'] = int(params['summary_length'])
+        if params['goal'] != 'custom':
+            params['goal_instruction'] = None
+        if params['goal'] != 'podcast':
+            params['voice1_style'] = params['voice2_style'] = params['voice2'] = None
+        jobs.append({'path': os.path.normpath(path), 'params': params, 'key': job_key(path, params)})
+    return jobs
+
+
+def job_key(path, params):
+    """Stable identity of a job: the document path plus every generation parameter"""
+    payload = json.dumps({'file': os.path.abspath(path), **params}, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def load_checkpoint(path):
+    """Keys of the finished jobs, and {key: entry_id} of jobs whose save may not have been committed"""
+    done = set()
+    pending = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # A partially written last line from an interrupted run
+                if record.get('status') == 'pending':
+                    pending[record['key']] = record['entry_id']
+                elif record.get('status') == 'done':
+                    done.add(record['key'])
+                    pending.pop(record['key'], None)
+    return done, pending
+
+
+def reconcile_pending(history_manager, pending, checkpoint_path):
+    """Checkpoint as done the pending jobs whose entries were committed before an interruption"""
+    records = [
+        {'key': key, 'status': 'done', 'entry_id': entry_id}
+        for key, entry_id in pending.items()
+        if history_manager.get_entry(entry_id) is not None
+    ]
+    if records:
+        append_checkpoint(checkpoint_path, records)
+        logger.info(f'{len(records)} jobs saved before the interruption were not yet checkpointed')
+    return {record['key'] for record in records}
+
+
+def append_checkpoint(path, records):
+    with open(path, 'a') as f:
+        for record in records:
+            f.write(json.dumps(record) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def run_job(job):
+    """Extract, summarize and synthesize one document at batch priority"""
+    params = job['params']
+    filename = os.path.basename(job['path'])
+    with request_priority(PRIORITY_BATCH), request_trace('batch', request_id=job['key'][:12]):
+        with open(job['path'], 'rb') as f:
+            file_bytes = f.read()
+        text = extract_text(filename, file_bytes, params['processing_method'])
+        if not text:
+            raise PipelineError('Could not extract text from file', 400)
+        result = generate_narration(
+            text, params['summary_length'], params['tone'], params['language'], params['goal'],
+            params['goal_instruction'], params['voice'], params['voice1_style'], params['voice2_style'],
+            params['voice2']
+        )
+
+    return {
+        'audio': result['audio'],
+        'summary_html': result['formatted_summary'],
+        'original_filename': filename,
+        'metadata': {
+            'summary_length': params['summary_length'],
+            'tone': params['tone'],
+            'language': params['language'],
+            'goal': params['goal'],
+            'goal_instruction': params['goal_instruction'],
+            'voice': params['voice'],
+            'voice2': params['voice2'],
+            'processing_method': params['processing_method'],
+            'batch': True
+        },
+        'extracted_text': text
+    }
+
+
+def flush(history_manager, pending, checkpoint_path):
+    """Bulk-insert finished jobs, then checkpoint them"""
+    if not pending:
+        return
+    # The entry IDs are checkpointed before the insert, so a run interrupted
+    # between the commit and the done records can tell on resume which jobs
+    # were saved instead of generating them again
+    entry_ids = [new_entry_id() for _ in pending]
+    append_checkpoint(checkpoint_path, [
+        {'key': job['key'], 'file': job['path'], 'status': 'pending', 'entry_id': entry_id}
+        for (job, _), entry_id in zip(pending, entry_ids)
+    ])
+    history_manager.save_entries([{**entry, 'entry_id': entry_id} for (_, entry), entry_id in zip(pending, entry_ids)])
+    append_checkpoint(checkpoint_path, [
+        {'key': job['key'], 'file': job['path'], 'status': 'done', 'entry_id': entry_id}
+        for (job, _), entry_id in zip(pending, entry_ids)
+    ])
+    logger.info(f'Saved {len(pending)} entries to history')
+    pending.clear()
+
+
+def run_batch(jobs, parallelism, commit_every, checkpoint_path):
+    history_manager = HistoryManager()
+    done, saved = load_checkpoint(checkpoint_path)
+    done |= reconcile_pending(history_manager, saved, checkpoint_path)
+    remaining = [job for job in jobs if job['key'] not in done]
+    logger.info(f'{len(jobs)} jobs, {len(jobs) - len(remaining)} already done, {len(remaining)} to run')
+
+    pending = []
+    failed = 0
+    executor = ThreadPoolExecutor(max_workers=parallelism)
+    futures = {executor.submit(run_job, job): job for job in remaining}
+    try:
+        for completed, future in enumerate(as_completed(futures), start=1):
+            job = futures[future]
+            try:
+                pending.append((job, future.result()))
+                logger.info(f'[{completed}/{len(remaining)}] Finished {job["path"]}')
+            except Exception as e:
+                failed += 1
+                logger.error(f'[{completed}/{len(remaining)}] Failed {job["path"]}: {str(e)}')
+                append_checkpoint(checkpoint_path, [
+                    {'key': job['key'], 'file': job['path'], 'status': 'failed', 'error': str(e)}
+                ])
+            if len(pending) >= commit_every:
+                flush(history_manager, pending, checkpoint_path)
+    except KeyboardInterrupt:
+        logger.warning('Interrupted; saving finished jobs. Rerun the same command to resume.')
+        executor.shutdown(wait=False, cancel_futures=True)
+        flush(history_manager, pending, checkpoint_path)
+        raise
+    executor.shutdown()
+    flush(history_manager, pending, checkpoint_path)
+    return len(remaining) - failed, failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Turn a folder or JSONL manifest of documents into narrations')
+    parser.add_argument('source', help='Folder of documents or a JSONL manifest')
+    parser.add_argument('--parallelism', type=int, default=4, help='Documents processed at the same time')
+    parser.add_argument('--commit-every', type=int, default=10, help='Finished documents per bulk insert')
+    parser.add_argument('--checkpoint', help='Checkpoint file (default: <source>.checkpoint.jsonl)')
+    parser.add_argument('--quota-fraction', type=float, default=0.5,
+                        help="Share of each deployment's RPM/TPM quota to use, leaving the rest to the web app")
+    for key, default in PARAMETER_DEFAULTS.items():
+        parser.add_argument(f'--{key.replace("_", "-")}', dest=key, default=default,
+                            type=int if key == 'summary_length' else str)
+    args = parser.parse_args()
+
+    configure_logging(file=None)
+    # This process has its own limiter, which the servers' priorities do not
+    # reach, so it keeps to its share of the quota; read when the client is created
+    os.environ['AZURE_OPENAI_QUOTA_FRACTION'] = str(args.quota_fraction)
+    init_db()
+    defaults = {key: getattr(args, key) for key in PARAMETER_DEFAULTS}
+    jobs = load_jobs(args.source, defaults)
+    checkpoint_path = args.checkpoint or os.path.abspath(args.source).rstrip(os.sep) + '.checkpoint.jsonl'
+
+    succeeded, failed = run_batch(jobs, max(1, args.parallelism), max(1, args.commit_every), checkpoint_path)
+    logger.info(f'Batch complete: {succeeded} succeeded, {failed} failed (checkpoint: {checkpoint_path})')
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,409 @@
+"""Local stand-in for the Azure OpenAI chat completions API.
+
+Serves canned text, summary-card tool calls and valid WAV audio so the full
+pipeline can be exercised without spending tokens. Latency, the share of
+requests answered with 429 and the amount of audio returned per chunk are
+configurable, and optional per-deployment RPM/TPM quotas are enforced over a
+sliding minute with x-ratelimit-remaining-* headers like the real service.
+Summaries and audio can take time per generated word or second of audio, and
+are sent as server-sent events (text deltas, or base64 pcm16 audio deltas)
+when the request sets "stream": true. Audio can also be made as long as its
+text would take to read, and summaries requested in podcast form come back
+as a script of alternating speaker turns. Prompt caching is simulated like
+the real service: a prompt sharing a prefix of at least 1024 tokens with an
+earlier prompt to the same deployment reports it, in 128-token steps, as
+usage.prompt_tokens_details.cached_tokens.
+
+Run standalone:
+    python -m benchmarks.fake_aoai --port 8089 --latency 0.2 --rate-429 0.05
+"""
+import argparse
+import base64
+import collections
+import hashlib
+import io
+import json
+import math
+import random
+import re
+import struct
+import threading
+import time
+import uuid
+import wave
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SAMPLE_RATE = 24000
+
+# Prompt caching: shortest cached prefix and cache step, in tokens of about 4 characters
+CACHE_MIN_TOKENS = 1024
+CACHE_STEP_TOKENS = 128
+
+CANNED_PAGE_TEXT = (
+    "Quarterly operations report. Revenue grew steadily across all regions while "
+    "operating costs remained flat. The chart on this page shows monthly active users "
+    "rising from 1.2 million to 1.6 million. The table lists regional targets and the "
+    "actual results for each quarter."
+)
+
+CANNED_SENTENCE = (
+    "The document describes how the team improved delivery times, reduced costs and "
+    "planned the next phase of the rollout across the remaining regions."
+)
+
+CANNED_QUESTION = "So what did the report find about delivery and costs?"
+
+WORD_PATTERN = re.compile(r'\S+\s*')
+
+PATH_PATTERN = re.compile(r'^/openai/deployments/(?P<deployment>[^/]+)/chat/completions')
+
+
+def make_pcm(seconds, sample_rate=SAMPLE_RATE, frequency=220.0):
+    """Return mono 16-bit little-endian PCM frames of a quiet sine tone"""
+    frames = int(seconds * sample_rate)
+    step = 2 * math.pi * frequency / sample_rate
+    return struct.pack(f'<{frames}h', *(int(3000 * math.sin(step * i)) for i in range(frames)))
+
+
+def make_wav(seconds, sample_rate=SAMPLE_RATE, frequency=220.0):
+    """Return a mono 16-bit PCM WAV file containing a quiet sine tone"""
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        wav.writeframes(make_pcm(seconds, sample_rate, frequency))
+    return buffer.getvalue()
+
+
+class FakeAzureOpenAIConfig:
+    def __init__(self, latency=0.05, jitter=0.0, rate_429=0.0, retry_after=1.0,
+                 audio_seconds=2.0, summary_chunks=4, rpm_limit=0, tpm_limit=0, seed=None,
+                 word_latency=0.0, audio_latency=0.0, chars_per_second=0.0):
+        self.latency = latency
+        self.word_latency = word_latency
+        self.audio_latency = audio_latency  # Seconds to generate one second of audio
+        self.jitter = jitter
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.audio_seconds = audio_seconds
+        # When set, audio lasts as long as reading its text at this speed
+        self.chars_per_second = chars_per_second
+        self.summary_chunks = summary_chunks
+        self.rpm_limit = rpm_limit
+        self.tpm_limit = tpm_limit
+        self.random = random.Random(seed)
+
+
+class FakeAzureOpenAIServer:
+    """Threaded HTTP server answering chat completion requests with canned payloads"""
+
+    def __init__(self, host='127.0.0.1', port=0, config=None):
+        self.config = config or FakeAzureOpenAIConfig()
+        self.stats = {'requests': 0, 'rate_limited': 0, 'by_kind': {}}
+        self._stats_lock = threading.Lock()
+        self._audio_cache = {}
+        self._usage = collections.defaultdict(collections.deque)
+        self._usage_lock = threading.Lock()
+        self._prompt_prefixes = set()
+        self._prompt_prefixes_lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def endpoint(self):
+        host, port = self._httpd.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _count(self, kind, rate_limited=False):
+        with self._stats_lock:
+            self.stats['requests'] += 1
+            self.stats['by_kind'][kind] = self.stats['by_kind'].get(kind, 0) + 1
+            if rate_limited:
+                self.stats['rate_limited'] += 1
+
+    def _check_quota(self, deployment, tokens):
+        """Apply the sliding-window quota; returns (headers, retry_after or None)"""
+        config = self.config
+        if not config.rpm_limit and not config.tpm_limit:
+            return {}, None
+        with self._usage_lock:
+            now = time.monotonic()
+            window = self._usage[deployment]
+            while window and now - window[0][0] >= 60:
+                window.popleft()
+            used_requests = len(window)
+            used_tokens = sum(cost for _, cost in window)
+            over_requests = config.rpm_limit and used_requests + 1 > config.rpm_limit
+            over_tokens = config.tpm_limit and used_tokens + tokens > config.tpm_limit
+            if over_requests or over_tokens:
+                retry_after = max(0.1, 60 - (now - window[0][0])) if window else 1.0
+                headers = {
+                    'x-ratelimit-remaining-requests': str(max(0, config.rpm_limit - used_requests)) if config.rpm_limit else None,
+                    'x-ratelimit-remaining-tokens': str(max(0, config.tpm_limit - used_tokens)) if config.tpm_limit else None,
+                }
+                return {k: v for k, v in headers.items() if v is not None}, retry_after
+            window.append((now, tokens))
+            headers = {
+                'x-ratelimit-remaining-requests': str(config.rpm_limit - used_requests - 1) if config.rpm_limit else None,
+                'x-ratelimit-remaining-tokens': str(config.tpm_limit - used_tokens - tokens) if config.tpm_limit else None,
+            }
+            return {k: v for k, v in headers.items() if v is not None}, None
+
+    def _cached_tokens(self, deployment, prompt):
+        """Tokens of the longest prefix of prompt seen before by deployment, remembering its prefixes"""
+        digest = hashlib.sha256(deployment.encode('utf-8'))
+        cached = 0
+        offset = 0
+        with self._prompt_prefixes_lock:
+            for end in range(4 * CACHE_MIN_TOKENS, len(prompt) + 1, 4 * CACHE_STEP_TOKENS):
+                digest.update(prompt[offset:end].encode('utf-8'))
+                offset = end
+                key = digest.hexdigest()
+                if key in self._prompt_prefixes:
+                    cached = end // 4
+                else:
+                    self._prompt_prefixes.add(key)
+        return cached
+
+    def _audio_seconds(self, body):
+        if self.config.chars_per_second <= 0:
+            return self.config.audio_seconds
+        text = ''.join(m['content'] for m in body.get('messages', [])
+                       if m.get('role') == 'user' and isinstance(m.get('content'), str))
+        return round(len(text) / self.config.chars_per_second, 1)
+
+    def _audio_base64(self, audio_format='wav', seconds=None):
+        seconds = self.config.audio_seconds if seconds is None else seconds
+        key = (audio_format, seconds)
+        if key not in self._audio_cache:
+            audio = make_pcm(seconds) if audio_format == 'pcm16' else make_wav(seconds)
+            self._audio_cache[key] = base64.b64encode(audio).decode('ascii')
+        return self._audio_cache[key]
+
+    def _summary_text(self, podcast=False):
+        if podcast:
+            pages = [f'Speaker 1: {CANNED_QUESTION}\nSpeaker 2: {" ".join([CANNED_SENTENCE] * 4)}'
+                     for _ in range(self.config.summary_chunks)]
+        else:
+            pages = [' '.join([CANNED_SENTENCE] * 5) for _ in range(self.config.summary_chunks)]
+        return '\n\n=== Page Break ===\n\n'.join(pages)
+
+    def _stream_events(self, deployment, response):
+        """Yield (delay, chat.completion.chunk) pairs that spell out a text response word by word"""
+        message = response['choices'][0]['message']
+        base = {'id': response['id'], 'object': 'chat.completion.chunk',
+                'created': response['created'], 'model': deployment}
+        yield 0.0, {**base, 'choices': [{'index': 0, 'delta': {'role': 'assistant', 'content': ''}, 'finish_reason': None}]}
+        for word in WORD_PATTERN.findall(message.get('content') or ''):
+            yield self.config.word_latency, {
+                **base, 'choices': [{'index': 0, 'delta': {'content': word}, 'finish_reason': None}]
+            }
+        yield 0.0, {**base, 'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]}
+        yield 0.0, {**base, 'choices': [], 'usage': response['usage']}
+
+    def _stream_audio_events(self, deployment, response, delta_seconds=0.1):
+        """Yield (delay, chat.completion.chunk) pairs carrying the audio as base64 pcm16 deltas"""
+        audio = response['choices'][0]['message']['audio']
+        pcm = base64.b64decode(audio['data'])
+        step = int(SAMPLE_RATE * delta_seconds) * 2
+        base = {'id': response['id'], 'object': 'chat.completion.chunk',
+                'created': response['created'], 'model': deployment}
+        yield 0.0, {**base, 'choices': [{'index': 0, 'delta': {'role': 'assistant', 'content': None}, 'finish_reason': None}]}
+        for offset in range(0, len(pcm), step):
+            data = base64.b64encode(pcm[offset:offset + step]).decode('ascii')
+            yield self.config.audio_latency * delta_seconds, {
+                **base, 'choices': [{'index': 0, 'delta': {'audio': {'id': audio['id'], 'data': data}}, 'finish_reason': None}]
+            }
+        yield 0.0, {**base, 'choices': [{'index': 0, 'delta': {
+            'audio': {'id': audio['id'], 'transcript': audio['transcript'], 'expires_at': audio['expires_at']}
+        }, 'finish_reason': 'stop'}]}
+        yield 0.0, {**base, 'choices': [], 'usage': response['usage']}
+
+    def _build_response(self, deployment, body):
+        kind, message = self._classify(body)
+        completion_text = message.get('content') or ''
+        prompt = json.dumps(body.get('messages', []))
+        return kind, {
+            'id': f'chatcmpl-{uuid.uuid4().hex[:24]}',
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': deployment,
+            'choices': [{'index': 0, 'finish_reason': 'stop', 'message': message}],
+            'usage': {
+                'prompt_tokens': len(prompt) // 4,
+                'completion_tokens': max(1, len(completion_text) // 4),
+                'total_tokens': len(prompt) // 4 + max(1, len(completion_text) // 4),
+                'prompt_tokens_details': {'cached_tokens': self._cached_tokens(deployment, prompt)}
+            }
+        }
+
+    def _classify(self, body):
+        if 'audio' in (body.get('modalities') or []):
+            return 'audio', {
+                'role': 'assistant',
+                'content': None,
+                'audio': {
+                    'id': f'audio_{uuid.uuid4().hex[:16]}',
+                    'data': self._audio_base64((body.get('audio') or {}).get('format', 'wav'), self._audio_seconds(body)),
+                    'expires_at': int(time.time()) + 3600,
+                    'transcript': 'canned transcript'
+                }
+            }
+        if body.get('tools'):
+            arguments = {
+                'title': 'Benchmark Summary',
+                'main_points': ['Revenue grew', 'Costs stayed flat'],
+                'key_highlights': [{'highlight': 'User growth', 'details': '1.2M to 1.6M'}],
+                'conclusion': 'Steady progress.'
+            }
+            return 'tool', {
+                'role': 'assistant',
+                'content': None,
+                'tool_calls': [{
+                    'id': f'call_{uuid.uuid4().hex[:16]}',
+                    'type': 'function',
+                    'function': {'name': 'create_summary_card', 'arguments': json.dumps(arguments)}
+                }]
+            }
+        for message in body.get('messages', []):
+            content = message.get('content')
+            if isinstance(content, list) and any(part.get('type') == 'image_url' for part in content):
+                return 'vision', {'role': 'assistant', 'content': CANNED_PAGE_TEXT}
+        # The podcast instructions ask for lines starting with "Speaker 1:"
+        podcast = any('"Speaker 1:"' in str(message.get('content')) for message in body.get('messages', []))
+        return 'text', {'role': 'assistant', 'content': self._summary_text(podcast)}
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send_json(self, status, payload, headers=None):
+                data = json.dumps(payload).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _send_stream(self, events, headers=None):
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.send_header('Connection', 'close')
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.close_connection = True
+                for delay, event in events:
+                    if delay > 0:
+                        time.sleep(delay)
+                    self.wfile.write(f'data: {json.dumps(event)}\n\n'.encode('utf-8'))
+                    self.wfile.flush()
+                self.wfile.write(b'data: [DONE]\n\n')
+                self.wfile.flush()
+
+            def do_POST(self):
+                match = PATH_PATTERN.match(self.path)
+                length = int(self.headers.get('Content-Length', 0))
+                raw = self.rfile.read(length) if length else b'{}'
+                if not match:
+                    self._send_json(404, {'error': {'code': 'NotFound', 'message': self.path}})
+                    return
+                body = json.loads(raw or b'{}')
+                config = server.config
+
+                delay = config.latency + (config.random.uniform(0, config.jitter) if config.jitter else 0)
+                if delay > 0:
+                    time.sleep(delay)
+
+                if config.rate_429 and config.random.random() < config.rate_429:
+                    server._count('rate_limited', rate_limited=True)
+                    self._send_json(429, {
+                        'error': {'code': '429', 'message': 'Rate limit is exceeded. Try again later.'}
+                    }, headers={'Retry-After': str(config.retry_after)})
+                    return
+
+                deployment = match.group('deployment')
+                quota_headers, retry_after = server._check_quota(deployment, len(raw) // 4)
+                if retry_after is not None:
+                    server._count('rate_limited', rate_limited=True)
+                    self._send_json(429, {
+                        'error': {'code': '429', 'message': 'Requests to this deployment have exceeded the rate limit.'}
+                    }, headers={'Retry-After': f'{retry_after:.1f}', **quota_headers})
+                    return
+
+                kind, payload = server._build_response(deployment, body)
+                server._count(kind)
+                if body.get('stream') and kind in ('text', 'audio'):
+                    events = server._stream_events if kind == 'text' else server._stream_audio_events
+                    self._send_stream(events(deployment, payload), headers=quota_headers)
+                    return
+                if kind == 'audio' and config.audio_latency > 0:
+                    time.sleep(config.audio_latency * server._audio_seconds(body))
+                if kind == 'text' and config.word_latency > 0:
+                    # Generation time grows with the length of the summary
+                    time.sleep(config.word_latency * len(WORD_PATTERN.findall(payload['choices'][0]['message']['content'])))
+                self._send_json(200, payload, headers=quota_headers)
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a fake Azure OpenAI chat completions server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--latency', type=float, default=0.05, help='Base response latency in seconds')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Additional random latency in seconds')
+    parser.add_argument('--rate-429', type=float, default=0.0, help='Fraction of requests answered with 429')
+    parser.add_argument('--retry-after', type=float, default=1.0, help='Retry-After value sent with 429s')
+    parser.add_argument('--audio-seconds', type=float, default=2.0, help='Seconds of audio per audio chunk')
+    parser.add_argument('--summary-chunks', type=int, default=4, help='Page breaks in canned summaries')
+    parser.add_argument('--word-latency', type=float, default=0.0, help='Seconds per generated summary word')
+    parser.add_argument('--audio-latency', type=float, default=0.0, help='Seconds to generate one second of audio')
+    parser.add_argument('--chars-per-second', type=float, default=0.0,
+                        help='Make audio as long as reading its text at this speed (0 = --audio-seconds per chunk)')
+    parser.add_argument('--rpm-limit', type=int, default=0, help='Per-deployment requests per minute (0 = unlimited)')
+    parser.add_argument('--tpm-limit', type=int, default=0, help='Per-deployment tokens per minute (0 = unlimited)')
+    args = parser.parse_args()
+
+    config = FakeAzureOpenAIConfig(
+        latency=args.latency, jitter=args.jitter, rate_429=args.rate_429, retry_after=args.retry_after,
+        audio_seconds=args.audio_seconds, summary_chunks=args.summary_chunks,
+        rpm_limit=args.rpm_limit, tpm_limit=args.tpm_limit, word_latency=args.word_latency,
+        audio_latency=args.audio_latency, chars_per_second=args.chars_per_second
+    )
+    server = FakeAzureOpenAIServer(args.host, args.port, config)
+    print(f'Fake Azure OpenAI listening on {server.endpoint}')
+    try:
+        server._httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server._httpd.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,344 @@
+"""Offline benchmark for the document-to-audio pipeline.
+
+Starts the fake Azure OpenAI server, points the app at it, and drives
+/upload-document with TXT and PDF corpora at several concurrency levels.
+Reports p50/p95/p99 latency, throughput, peak RSS, a per-stage breakdown and
+the prompt cache hit rate per stage as JSON.
+
+Usage:
+    python -m benchmarks.run_benchmark --concurrency 1 4 8 --requests 16
+    python -m benchmarks.run_benchmark --latency 0.3 --rate-429 0.05 --output bench.json
+    python -m benchmarks.run_benchmark --deployments 3 --rpm-limit 120
+"""
+import argparse
+import json
+import os
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+
+from benchmarks.fake_aoai import FakeAzureOpenAIConfig, FakeAzureOpenAIServer, CANNED_PAGE_TEXT
+
+SAMPLE_PARAGRAPH = (
+    "The program reached its third milestone this quarter. Teams in every region "
+    "completed the migration to the new platform, and support tickets fell by a "
+    "third compared with the previous period. The next phase focuses on automation, "
+    "training and the retirement of the legacy reporting tools. "
+)
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = (len(ordered) - 1) * pct / 100
+    lower = int(index)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (index - lower)
+
+
+def build_text_pdf(pages):
+    """Build a minimal PDF with a real text layer (no external dependencies)"""
+    objects = []
+    page_ids = []
+    font_id = 3
+    objects.append(b'<< /Type /Catalog /Pages 2 0 R >>')
+    objects.append(None)  # Pages object, filled in once page ids are known
+    objects.append(b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>')
+    for page_text in pages:
+        lines = [page_text[i:i + 90] for i in range(0, len(page_text), 90)]
+        stream = 'BT /F1 10 Tf 40 800 Td 12 TL ' + ' '.join(
+            '(' + line.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)') + ") '" for line in lines
+        ) + ' ET'
+        stream_bytes = stream.encode('latin-1')
+        objects.append(b'<< /Length %d >>\nstream\n' % len(stream_bytes) + stream_bytes + b'\nendstream')
+        content_id = len(objects)
+        objects.append(
+            b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Contents %d 0 R '
+            b'/Resources << /Font << /F1 %d 0 R >> >> >>' % (content_id, font_id)
+        )
+        page_ids.append(len(objects))
+    kids = b' '.join(b'%d 0 R' % page_id for page_id in page_ids)
+    objects[1] = b'<< /Type /Pages /Kids [' + kids + b'] /Count %d >>' % len(page_ids)
+
+    output = bytearray(b'%PDF-1.4\n')
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(output))
+        output += b'%d 0 obj\n' % number + body + b'\nendobj\n'
+    xref_offset = len(output)
+    output += b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1)
+    for offset in offsets:
+        output += b'%010d 00000 n \n' % offset
+    output += b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(objects) + 1, xref_offset)
+    return bytes(output)
+
+
+def build_image_pdf(pages):
+    """Build an image-only PDF that forces the vision path (requires Pillow)"""
+    from PIL import Image, ImageDraw
+    images = []
+    for page_number in range(pages):
+        image = Image.new('RGB', (850, 1100), 'white')
+        draw = ImageDraw.Draw(image)
+        draw.text((40, 40), f'Page {page_number + 1}: {CANNED_PAGE_TEXT[:80]}', fill='black')
+        images.append(image)
+    buffer = __import__('io').BytesIO()
+    images[0].save(buffer, format='PDF', save_all=True, append_images=images[1:])
+    return buffer.getvalue()
+
+
+def build_corpus(include_vision):
+    """Return a list of (name, filename, bytes, processing_method) documents"""
+    corpus = [
+        ('txt_small', 'small.txt', (SAMPLE_PARAGRAPH * 8).encode('utf-8'), 'vision'),
+        ('txt_large', 'large.txt', (SAMPLE_PARAGRAPH * 400).encode('utf-8'), 'vision'),
+        ('pdf_text', 'report.pdf', build_text_pdf([SAMPLE_PARAGRAPH * 3] * 10), 'hybrid'),
+    ]
+    if include_vision:
+        corpus.append(('pdf_scanned', 'scanned.pdf', build_image_pdf(5), 'vision'))
+    return corpus
+
+
+def load_corpus_dir(path):
+    corpus = []
+    for name in sorted(os.listdir(path)):
+        extension = name.rsplit('.', 1)[-1].lower()
+        if extension not in ('txt', 'pdf'):
+            continue
+        with open(os.path.join(path, name), 'rb') as f:
+            corpus.append((name, name, f.read(), 'hybrid' if extension == 'pdf' else 'vision'))
+    return corpus
+
+
+class RssSampler:
+    """Track peak resident set size of this process while a level runs"""
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    @staticmethod
+    def current_rss():
+        try:
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError):
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, self.current_rss())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self.peak = self.current_rss()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self.current_rss())
+
+
+def run_level(flask_app, corpus, concurrency, total_requests, form_overrides):
+    from metrics import add_trace_listener, remove_trace_listener
+
+    traces = []
+    traces_lock = threading.Lock()
+
+    def collect(trace):
+        with traces_lock:
+            traces.append(trace)
+
+    def one_request(index):
+        name, filename, payload, method = corpus[index % len(corpus)]
+        form = {
+            'summary_length': '2',
+            'tone': 'conversational',
+            'language': 'english',
+            'goal': 'general_summary',
+            'voice': 'alloy',
+            'processing_method': method,
+            **form_overrides
+        }
+        import io
+        form['file'] = (io.BytesIO(payload), filename)
+        client = flask_app.test_client()
+        start = time.perf_counter()
+        response = client.post('/upload-document', data=form, content_type='multipart/form-data')
+        elapsed = time.perf_counter() - start
+        return name, response.status_code, elapsed
+
+    add_trace_listener(collect)
+    try:
+        with RssSampler() as sampler:
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                results = list(pool.map(one_request, range(total_requests)))
+            wall = time.perf_counter() - start
+    finally:
+        remove_trace_listener(collect)
+
+    latencies = [elapsed for _, status, elapsed in results if status == 200]
+    errors = sum(1 for _, status, _ in results if status != 200)
+
+    stages = {}
+    prompt_tokens = {}
+    for trace in traces:
+        for stage, duration in trace.stage_totals().items():
+            stages.setdefault(stage, []).append(duration)
+        for recorded in trace.spans:
+            if recorded.prompt_tokens:
+                tokens = prompt_tokens.setdefault(recorded.stage, [0, 0])
+                tokens[0] += recorded.prompt_tokens
+                tokens[1] += recorded.cached_tokens
+
+    by_document = {}
+    for name, status, elapsed in results:
+        if status == 200:
+            by_document.setdefault(name, []).append(elapsed)
+
+    return {
+        'concurrency': concurrency,
+        'requests': total_requests,
+        'errors': errors,
+        'wall_seconds': round(wall, 3),
+        'throughput_rps': round(len(latencies) / wall, 3) if wall else None,
+        'latency_seconds': {
+            'p50': _round(percentile(latencies, 50)),
+            'p95': _round(percentile(latencies, 95)),
+            'p99': _round(percentile(latencies, 99)),
+            'mean': _round(statistics.fmean(latencies)) if latencies else None
+        },
+        'peak_rss_mb': round(sampler.peak / (1024 * 1024), 1),
+        'stages_seconds': {
+            stage: {
+                'p50': _round(percentile(values, 50)),
+                'p95': _round(percentile(values, 95)),
+                'mean': _round(statistics.fmean(values))
+            }
+            for stage, values in sorted(stages.items())
+        },
+        # Share of prompt tokens served from the prompt cache
+        'prompt_cache_hit_rate': {
+            stage: round(cached / prompt, 3) for stage, (prompt, cached) in sorted(prompt_tokens.items())
+        },
+        'documents_p50_seconds': {
+            name: _round(percentile(values, 50)) for name, values in sorted(by_document.items())
+        }
+    }
+
+
+def _round(value):
+    return round(value, 4) if value is not None else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline against a fake Azure OpenAI server')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 8])
+    parser.add_argument('--requests', type=int, default=12, help='Requests per concurrency level')
+    parser.add_argument('--latency', type=float, default=0.05, help='Fake model latency in seconds')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Additional random fake latency in seconds')
+    parser.add_argument('--rate-429', type=float, default=0.0, help='Fraction of fake requests answered with 429')
+    parser.add_argument('--retry-after', type=float, default=0.2, help='Retry-After sent with injected 429s')
+    parser.add_argument('--audio-seconds', type=float, default=2.0, help='Seconds of audio per TTS chunk')
+    parser.add_argument('--summary-chunks', type=int, default=4, help='Page breaks per canned summary')
+    parser.add_argument('--word-latency', type=float, default=0.0, help='Fake seconds per generated summary word')
+    parser.add_argument('--audio-latency', type=float, default=0.0, help='Fake seconds to generate one second of audio')
+    parser.add_argument('--chars-per-second', type=float, default=0.0,
+                        help='Make fake audio as long as reading its text at this speed (0 = --audio-seconds per chunk)')
+    parser.add_argument('--goal', default='general_summary', help="Goal sent with every request, e.g. 'podcast'")
+    parser.add_argument('--rpm-limit', type=int, default=0, help='Fake per-deployment requests per minute')
+    parser.add_argument('--tpm-limit', type=int, default=0, help='Fake per-deployment tokens per minute')
+    parser.add_argument('--deployments', type=int, default=1,
+                        help='Number of fake deployments (separate servers) in each model pool')
+    parser.add_argument('--corpus', help='Directory of .txt/.pdf files to use instead of the built-in corpus')
+    parser.add_argument('--database-url', help='Database URL (defaults to a temporary SQLite file)')
+    parser.add_argument('--seed', type=int, default=1234)
+    parser.add_argument('--output', help='Write the JSON report to this file instead of stdout')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='aoai-bench-')
+    with ExitStack() as stack:
+        servers = [
+            stack.enter_context(FakeAzureOpenAIServer(config=FakeAzureOpenAIConfig(
+                latency=args.latency, jitter=args.jitter, rate_429=args.rate_429, retry_after=args.retry_after,
+                audio_seconds=args.audio_seconds, summary_chunks=args.summary_chunks,
+                rpm_limit=args.rpm_limit, tpm_limit=args.tpm_limit, seed=args.seed + index,
+                word_latency=args.word_latency, audio_latency=args.audio_latency,
+                chars_per_second=args.chars_per_second
+            )))
+            for index in range(max(1, args.deployments))
+        ]
+        # The app reads its configuration at import time, so point it at the
+        # fake servers and a scratch database before importing it
+        os.environ['AZURE_OPENAI_ENDPOINT'] = servers[0].endpoint
+        os.environ['AZURE_OPENAI_API_KEY'] = 'benchmark'
+        os.environ['DATABASE_URL'] = args.database_url or f'sqlite:///{os.path.join(workdir, "bench.db")}'
+        os.environ.setdefault('BLOB_STORE_PATH', os.path.join(workdir, 'blobs'))
+        # The corpus repeats the same documents with the same settings from
+        # several threads; with coalescing those requests would share one
+        # generation instead of each running the pipeline
+        os.environ['SINGLE_FLIGHT'] = 'false'
+        # Size the client-side limiter to the fake quota so it is only the
+        # bottleneck when a quota is being simulated
+        for role in ('TEXT', 'AUDIO'):
+            os.environ[f'AZURE_OPENAI_{role}_RPM'] = str(args.rpm_limit or 100000)
+            os.environ[f'AZURE_OPENAI_{role}_TPM'] = str(args.tpm_limit or 100000000)
+        if len(servers) > 1:
+            os.environ['AZURE_OPENAI_DEPLOYMENTS'] = json.dumps({
+                role: [{'endpoint': server.endpoint} for server in servers] for role in ('text', 'audio')
+            })
+
+        import_start = time.perf_counter()
+        import app as app_module
+        flask_app = app_module.create_app()
+        import_seconds = time.perf_counter() - import_start
+
+        corpus = load_corpus_dir(args.corpus) if args.corpus else build_corpus(shutil.which('pdftoppm') is not None)
+        levels = [
+            run_level(flask_app, corpus, concurrency, args.requests, {'goal': args.goal})
+            for concurrency in args.concurrency
+        ]
+        report = {
+            'config': {
+                'latency': args.latency,
+                'jitter': args.jitter,
+                'rate_429': args.rate_429,
+                'audio_seconds': args.audio_seconds,
+                'summary_chunks': args.summary_chunks,
+                'word_latency': args.word_latency,
+                'audio_latency': args.audio_latency,
+                'chars_per_second': args.chars_per_second,
+                'goal': args.goal,
+                'rpm_limit': args.rpm_limit,
+                'tpm_limit': args.tpm_limit,
+                'deployments': len(servers),
+                'corpus': [name for name, _, _, _ in corpus]
+            },
+            'app_import_seconds': round(import_seconds, 3),
+            'fake_servers': [server.stats for server in servers],
+            'levels': levels
+        }
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        sys.stdout.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+"""Measure cold-start time and per-worker memory of the web app.
+
+Two measurements, both in fresh processes:
+
+1. Import time: how long `import <module>` takes in a new interpreter, and
+   the interpreter's peak RSS afterwards (median of --import-runs runs).
+2. Served startup: boots gunicorn with the given target and config, times
+   how long it takes until `/` answers, then reads RSS, PSS and USS (private
+   memory) of the master and every worker from /proc/<pid>/smaps_rollup.
+   PSS and USS show how much memory the workers share copy-on-write.
+
+Run from the repository root; point --chdir at another checkout to compare
+revisions, e.g. the old single-module app:
+
+    python -m benchmarks.startup
+    python -m benchmarks.startup --chdir /tmp/old-checkout --target app:app --config ''
+
+Linux only for the memory figures (needs /proc). Prints a JSON report.
+"""
+import argparse
+import json
+import os
+import shutil
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPORT_PROBE = """
+import resource, sys, time
+start = time.perf_counter()
+__import__(sys.argv[1])
+elapsed = time.perf_counter() - start
+print(elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+"""
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def measure_import(module, cwd, env, runs):
+    """Median wall time and peak RSS of importing module in a fresh interpreter"""
+    seconds, rss_kb = [], []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, '-c', IMPORT_PROBE, module],
+            cwd=cwd, env=env, capture_output=True, text=True, check=True
+        ).stdout.split()
+        seconds.append(float(output[-2]))
+        rss_kb.append(int(output[-1]))
+    return {
+        'module': module,
+        'runs': runs,
+        'seconds_median': round(statistics.median(seconds), 3),
+        'seconds_min': round(min(seconds), 3),
+        'peak_rss_mb': round(statistics.median(rss_kb) / 1024, 1)
+    }
+
+
+def child_pids(pid):
+    children = []
+    for task in os.listdir(f'/proc/{pid}/task'):
+        try:
+            with open(f'/proc/{pid}/task/{task}/children') as f:
+                children.extend(int(child) for child in f.read().split())
+        except FileNotFoundError:
+            continue
+    return sorted(children)
+
+
+def memory_of(pid):
+    """RSS, PSS and USS in MB from /proc/<pid>/smaps_rollup"""
+    values = {}
+    with open(f'/proc/{pid}/smaps_rollup') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) >= 2 and parts[0].endswith(':') and parts[1].isdigit():
+                values[parts[0][:-1]] = int(parts[1])
+    uss = values.get('Private_Clean', 0) + values.get('Private_Dirty', 0)
+    return {
+        'rss_mb': round(values.get('Rss', 0) / 1024, 1),
+        'pss_mb': round(values.get('Pss', 0) / 1024, 1),
+        'uss_mb': round(uss / 1024, 1)
+    }
+
+
+def wait_until_serving(url, process, timeout):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if process.poll() is not None:
+            raise Exception(f'gunicorn exited with code {process.returncode}')
+        try:
+            with urllib.request.urlopen(url, timeout=5) as response:
+                if response.status == 200:
+                    return
+        except (urllib.error.URLError, ConnectionError, socket.timeout):
+            time.sleep(0.05)
+    raise Exception(f'{url} did not answer within {timeout}s')
+
+
+def measure_served(target, config, workers, threads, cwd, env, timeout, settle):
+    """Boot gunicorn, time until the first successful response and sample worker memory"""
+    port = free_port()
+    command = [sys.executable, '-m', 'gunicorn', target,
+               '--bind', f'127.0.0.1:{port}', '--workers', str(workers), '--threads', str(threads)]
+    if config:
+        command += ['--config', config]
+    start = time.perf_counter()
+    process = subprocess.Popen(command, cwd=cwd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    try:
+        url = f'http://127.0.0.1:{port}/'
+        wait_until_serving(url, process, timeout)
+        first_response = time.perf_counter() - start
+
+        # Let every worker finish booting and warming up, then touch the app a
+        # few times so the sampled memory reflects workers that have served
+        time.sleep(settle)
+        for _ in range(workers * 4):
+            urllib.request.urlopen(url, timeout=5).read()
+
+        workers_memory = [{'pid': pid, **memory_of(pid)} for pid in child_pids(process.pid)]
+        return {
+            'target': target,
+            'config': config or None,
+            'workers': workers,
+            'threads': threads,
+            'first_response_seconds': round(first_response, 3),
+            'master': {'pid': process.pid, **memory_of(process.pid)},
+            'workers_memory': workers_memory,
+            'worker_uss_mb_mean': round(statistics.mean(w['uss_mb'] for w in workers_memory), 1) if workers_memory else None,
+            'worker_pss_mb_mean': round(statistics.mean(w['pss_mb'] for w in workers_memory), 1) if workers_memory else None
+        }
+    finally:
+        process.send_signal(signal.SIGTERM)
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure cold-start time and per-worker memory')
+    parser.add_argument('--chdir', default=REPO_ROOT, help='Checkout to measure (default: this repository)')
+    parser.add_argument('--target', default='wsgi:app', help='WSGI target for gunicorn')
+    parser.add_argument('--import-module', help='Module to time imports of (default: module of --target)')
+    parser.add_argument('--config', default='gunicorn.conf.py', help="gunicorn config file ('' for none)")
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--import-runs', type=int, default=5)
+    parser.add_argument('--timeout', type=float, default=60.0, help='Seconds to wait for the first response')
+    parser.add_argument('--settle', type=float, default=2.0, help='Seconds to wait for workers before sampling memory')
+    parser.add_argument('--database-url', help='Database to start against (default: a temporary sqlite file)')
+    args = parser.parse_args()
+
+    if shutil.which('gunicorn') is None and subprocess.run(
+            [sys.executable, '-c', 'import gunicorn'], capture_output=True).returncode != 0:
+        raise SystemExit('gunicorn is not installed (pip install -r requirements.txt)')
+
+    workdir = tempfile.mkdtemp(prefix='aoai-startup-')
+    try:
+        env = dict(os.environ)
+        env['DATABASE_URL'] = args.database_url or f'sqlite:///{os.path.join(workdir, "startup.db")}'
+        env['BLOB_STORE_PATH'] = os.path.join(workdir, 'blobs')
+        # Clients are only constructed, never called, so placeholder credentials do
+        env.setdefault('AZURE_OPENAI_API_KEY', 'startup-benchmark')
+        env.setdefault('AZURE_OPENAI_ENDPOINT', 'http://127.0.0.1:9')
+
+        module = args.import_module or args.target.split(':')[0]
+        report = {
+            'import': measure_import(module, args.chdir, env, args.import_runs),
+            'served': measure_served(args.target, args.config, args.workers, args.threads,
+                                     args.chdir, env, args.timeout, args.settle)
+        }
+        print(json.dumps(report, indent=2))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,269 @@
+from abc import ABC, abstractmethod
+import hashlib
+import io
+import os
+import tempfile
+import threading
+
+from config import BLOB_STORE
+
+# Read size when storing a blob from a stream
+COPY_BLOCK_SIZE = 1024 * 1024
+
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def is_stream(data):
+    """Whether data is a readable binary file object rather than bytes"""
+    return hasattr(data, 'read')
+
+
+def read_blocks(stream, block_size=COPY_BLOCK_SIZE):
+    while True:
+        block = stream.read(block_size)
+        if not block:
+            return
+        yield block
+
+
+def sharded_key(digest):
+    """Spread blobs over two directory levels: ab/cd/abcd..."""
+    return f'{digest[:2]}/{digest[2:4]}/{digest}'
+
+
+class BlobNotFound(Exception):
+    pass
+
+
+class BlobStore(ABC):
+    """Content-addressed storage for binary payloads such as generated audio.
+
+    Blobs are identified by the SHA-256 of their content, so writing the same
+    bytes twice stores them once. Backends implement every abstract method, so
+    an incomplete one fails when it is created.
+    """
+
+    @abstractmethod
+    def put(self, data, mime_type='application/octet-stream'):
+        """Store data (a bytes-like object or a readable binary stream) and return its content hash"""
+
+    @abstractmethod
+    def get(self, digest):
+        """Return the bytes stored under digest"""
+
+    @abstractmethod
+    def size(self, digest):
+        """Return the size in bytes of the blob"""
+
+    def open(self, digest):
+        """Return a readable binary file object for the blob"""
+        return io.BytesIO(self.get(digest))
+
+    @abstractmethod
+    def exists(self, digest):
+        """Whether a blob is stored under digest"""
+
+    @abstractmethod
+    def delete(self, digest):
+        """Remove the blob; deleting a missing blob is not an error"""
+
+
+class LocalBlobStore(BlobStore):
+    """Filesystem backend with sharded content-hash paths and atomic writes"""
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        os.makedirs(self.root, exist_ok=True)
+
+    def path(self, digest):
+        return os.path.join(self.root, *sharded_key(digest).split('/'))
+
+    def put(self, data, mime_type='application/octet-stream'):
+        if is_stream(data):
+            return self._put_stream(data)
+        digest = content_hash(data)
+        path = self.path(digest)
+        if os.path.exists(path):
+            return digest
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        # Write to a temporary file in the same directory and rename it into
+        # place, so readers never see a partially written blob
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        return digest
+
+    def _put_stream(self, stream):
+        # The hash is only known once the stream has been read, so it is
+        # hashed while being copied to a temporary file under the root
+        digest = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for block in read_blocks(stream):
+                    digest.update(block)
+                    f.write(block)
+                f.flush()
+                os.fsync(f.fileno())
+            path = self.path(digest.hexdigest())
+            if os.path.exists(path):
+                os.unlink(tmp_path)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        return digest.hexdigest()
+
+    def get(self, digest):
+        with self.open(digest) as f:
+            return f.read()
+
+    def size(self, digest):
+        try:
+            return os.path.getsize(self.path(digest))
+        except FileNotFoundError:
+            raise BlobNotFound(digest)
+
+    def open(self, digest):
+        try:
+            return open(self.path(digest), 'rb')
+        except FileNotFoundError:
+            raise BlobNotFound(digest)
+
+    def exists(self, digest):
+        return os.path.exists(self.path(digest))
+
+    def delete(self, digest):
+        try:
+            os.unlink(self.path(digest))
+        except FileNotFoundError:
+            pass
+
+
+class S3BlobStore(BlobStore):
+    """S3-compatible backend (AWS S3, MinIO, Azurite's S3 gateways, ...)"""
+
+    def __init__(self, bucket, prefix='', endpoint_url=None, region=None,
+                 access_key=None, secret_key=None):
+        try:
+            import boto3
+            from botocore.exceptions import ClientError
+        except ImportError:
+            raise Exception("The s3 blob store backend requires boto3 (pip install -r requirements.txt)")
+        self._client_error = ClientError
+        self.bucket = bucket
+        self.prefix = prefix.strip('/')
+        self.client = boto3.client(
+            's3',
+            endpoint_url=endpoint_url,
+            region_name=region,
+            aws_access_key_id=access_key,
+            aws_secret_access_key=secret_key
+        )
+
+    def key(self, digest):
+        key = sharded_key(digest)
+        return f'{self.prefix}/{key}' if self.prefix else key
+
+    def _is_missing(self, error):
+        return error.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound')
+
+    def put(self, data, mime_type='application/octet-stream'):
+        if is_stream(data):
+            return self._put_stream(data, mime_type)
+        digest = content_hash(data)
+        if not self.exists(digest):
+            # S3 object writes are atomic: readers see the old state or the whole object
+            body = data if isinstance(data, (bytes, bytearray)) else bytes(data)
+            self.client.put_object(Bucket=self.bucket, Key=self.key(digest), Body=body, ContentType=mime_type)
+        return digest
+
+    def _put_stream(self, stream, mime_type):
+        # The key is the hash of the content, so the stream is spooled (to
+        # disk once it is large) while hashing and uploaded afterwards
+        digest = hashlib.sha256()
+        with tempfile.SpooledTemporaryFile(max_size=8 * COPY_BLOCK_SIZE) as spool:
+            for block in read_blocks(stream):
+                digest.update(block)
+                spool.write(block)
+            if not self.exists(digest.hexdigest()):
+                spool.seek(0)
+                self.client.upload_fileobj(spool, self.bucket, self.key(digest.hexdigest()),
+                                           ExtraArgs={'ContentType': mime_type})
+        return digest.hexdigest()
+
+    def get(self, digest):
+        with self.open(digest) as body:
+            return body.read()
+
+    def size(self, digest):
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self.key(digest))['ContentLength']
+        except self._client_error as e:
+            if self._is_missing(e):
+                raise BlobNotFound(digest)
+            raise
+
+    def open(self, digest):
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=self.key(digest))['Body']
+        except self._client_error as e:
+            if self._is_missing(e):
+                raise BlobNotFound(digest)
+            raise
+
+    def exists(self, digest):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.key(digest))
+            return True
+        except self._client_error as e:
+            if self._is_missing(e):
+                return False
+            raise
+
+    def delete(self, digest):
+        self.client.delete_object(Bucket=self.bucket, Key=self.key(digest))
+
+
+_blob_store = None
+_blob_store_lock = threading.Lock()
+
+
+def create_blob_store(settings=BLOB_STORE):
+    backend = settings['backend']
+    if backend == 'local':
+        return LocalBlobStore(settings['path'])
+    if backend == 's3':
+        return S3BlobStore(
+            settings['s3_bucket'],
+            prefix=settings['s3_prefix'],
+            endpoint_url=settings['s3_endpoint_url'],
+            region=settings['s3_region'],
+            access_key=settings['s3_access_key'],
+            secret_key=settings['s3_secret_key']
+        )
+    raise Exception(f"Unknown blob store backend: {backend}")
+
+
+def get_blob_store():
+    """Return the process-wide blob store configured in config.BLOB_STORE"""
+    global _blob_store
+    if _blob_store is None:
+        with _blob_store_lock:
+            if _blob_store is None:
+                _blob_store = create_blob_store()
+    return _blob_store
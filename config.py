@@ -1,3 +1,4 @@
+import json
 import os
 from dotenv import load_dotenv
 
@@ -18,6 +19,170 @@ AZURE_MODELS = {
     'audio': os.getenv('AZURE_OPENAI_AUDIO_DEPLOYMENT', 'gpt-4o-audio-preview'),
 }
 
+# Rate limits per deployment (requests and tokens per minute), matching the
+# quota assigned to each deployment in AI Foundry
+AZURE_RATE_LIMITS = {
+    'text': {
+        'rpm': int(os.getenv('AZURE_OPENAI_TEXT_RPM', '300')),
+        'tpm': int(os.getenv('AZURE_OPENAI_TEXT_TPM', '150000')),
+    },
+    'audio': {
+        'rpm': int(os.getenv('AZURE_OPENAI_AUDIO_RPM', '60')),
+        'tpm': int(os.getenv('AZURE_OPENAI_AUDIO_TPM', '60000')),
+    },
+}
+
+# Deployment pool: every model role can be served by several deployments
+# across regions/endpoints. Set AZURE_OPENAI_DEPLOYMENTS (JSON) or
+# AZURE_OPENAI_DEPLOYMENTS_FILE (path to a JSON file) to a mapping of role to
+# a list of deployments, for example:
+# {"text": [{"endpoint": "https://swe.openai.azure.com", "api_key_env": "SWE_KEY",
+#            "deployment": "gpt-4o", "weight": 2, "rpm": 300, "tpm": 150000},
+#           {"endpoint": "https://eus.openai.azure.com", "api_key_env": "EUS_KEY",
+#            "deployment": "gpt-4o", "weight": 1}],
+#  "audio": [...]}
+# Without it, each role uses the single deployment configured above.
+def _load_deployment_pool():
+    raw = os.getenv('AZURE_OPENAI_DEPLOYMENTS')
+    path = os.getenv('AZURE_OPENAI_DEPLOYMENTS_FILE')
+    if not raw and path:
+        with open(path) as f:
+            raw = f.read()
+    configured = json.loads(raw) if raw else {}
+
+    pool = {}
+    for role, deployment in AZURE_MODELS.items():
+        entries = configured.get(role) or [{}]
+        pool[role] = []
+        for entry in entries:
+            api_key = entry.get('api_key')
+            if api_key is None and entry.get('api_key_env'):
+                api_key = os.getenv(entry['api_key_env'])
+            pool[role].append({
+                'endpoint': entry.get('endpoint', AZURE_CONFIG['azure_endpoint']),
+                'api_key': api_key if api_key is not None else AZURE_CONFIG['api_key'],
+                'api_version': entry.get('api_version', AZURE_CONFIG['api_version']),
+                'deployment': entry.get('deployment', deployment),
+                'weight': float(entry.get('weight', 1)),
+                'rpm': int(entry.get('rpm', AZURE_RATE_LIMITS[role]['rpm'])),
+                'tpm': int(entry.get('tpm', AZURE_RATE_LIMITS[role]['tpm'])),
+            })
+    return pool
+
+AZURE_DEPLOYMENTS = _load_deployment_pool()
+
+# Health tracking: a deployment that fails this many calls in a row (5xx or
+# connection errors) is skipped for the cooldown period
+AZURE_HEALTH = {
+    'failure_threshold': int(os.getenv('AZURE_OPENAI_FAILURE_THRESHOLD', '3')),
+    'cooldown_seconds': float(os.getenv('AZURE_OPENAI_UNHEALTHY_COOLDOWN', '30')),
+}
+
+# Retry behaviour for throttled (429) and failed (5xx / connection) requests
+AZURE_RETRY = {
+    'max_retries': int(os.getenv('AZURE_OPENAI_MAX_RETRIES', '6')),
+    'base_delay': float(os.getenv('AZURE_OPENAI_RETRY_BASE_DELAY', '0.5')),
+    'max_delay': float(os.getenv('AZURE_OPENAI_RETRY_MAX_DELAY', '30')),
+}
+
 # Application Configuration
 MAX_FILE_SIZE = 64 * 1024 * 1024  # 64MB max file size
-ALLOWED_EXTENSIONS = {'txt', 'pdf', 'doc', 'docx'} 
\ No newline at end of file
+ALLOWED_EXTENSIONS = {'txt', 'pdf', 'doc', 'docx'}
+
+# Voices the audio model can read with
+VOICES = {'alloy', 'ash', 'ballad', 'coral', 'echo', 'fable', 'nova', 'onyx', 'sage', 'shimmer', 'verse'}
+
+# Blob storage for generated audio: 'local' (sharded files under BLOB_STORE_PATH)
+# or 's3' (any S3-compatible service, e.g. MinIO via BLOB_STORE_S3_ENDPOINT_URL)
+BLOB_STORE = {
+    'backend': os.getenv('BLOB_STORE_BACKEND', 'local'),
+    'path': os.getenv('BLOB_STORE_PATH', 'history/blobs'),
+    's3_bucket': os.getenv('BLOB_STORE_S3_BUCKET', 'aoai-audio'),
+    's3_prefix': os.getenv('BLOB_STORE_S3_PREFIX', 'audio'),
+    's3_endpoint_url': os.getenv('BLOB_STORE_S3_ENDPOINT_URL'),
+    's3_region': os.getenv('BLOB_STORE_S3_REGION'),
+    's3_access_key': os.getenv('BLOB_STORE_S3_ACCESS_KEY'),
+    's3_secret_key': os.getenv('BLOB_STORE_S3_SECRET_KEY'),
+}
+
+# Logging: records are handed to a background thread that writes them to a
+# rotating file (LOG_FILE, empty to disable) and the console. Long values such
+# as form fields are cut to LOG_MAX_PAYLOAD_CHARS, except for a sampled
+# fraction of requests (LOG_PAYLOAD_SAMPLE_RATE) that log them in full.
+LOGGING = {
+    'level': os.getenv('LOG_LEVEL', 'INFO'),
+    'format': os.getenv('LOG_FORMAT', 'text'),  # 'text' or 'json'
+    'file': os.getenv('LOG_FILE', 'app.log'),
+    'max_bytes': int(os.getenv('LOG_MAX_BYTES', str(10 * 1024 * 1024))),
+    'backup_count': int(os.getenv('LOG_BACKUP_COUNT', '5')),
+    'queue_size': int(os.getenv('LOG_QUEUE_SIZE', '10000')),
+    'max_payload_chars': int(os.getenv('LOG_MAX_PAYLOAD_CHARS', '200')),
+    'payload_sample_rate': float(os.getenv('LOG_PAYLOAD_SAMPLE_RATE', '0')),
+}
+
+# Metrics of pre-forked workers: each worker writes snapshots to METRICS_DIR
+# and /metrics merges them. gunicorn.conf.py sets a default; when it is empty
+# (the development server), /metrics reports the single process.
+METRICS = {
+    'directory': os.getenv('METRICS_DIR', ''),
+    'write_interval': float(os.getenv('METRICS_WRITE_INTERVAL', '5')),
+}
+
+# Narration pipeline: the summary is streamed and each chunk is synthesized as
+# soon as it is complete, with up to TTS_CONCURRENCY chunks in flight. Chunks
+# end at page breaks, or at a sentence boundary once they exceed
+# MAX_CHUNK_CHARS. With STREAM_AUDIO, each chunk's audio is streamed as pcm16
+# deltas and only wrapped in a WAV header when the narration is stored.
+PIPELINE = {
+    'stream_summary': os.getenv('STREAM_SUMMARY', 'true').lower() == 'true',
+    'stream_audio': os.getenv('STREAM_AUDIO', 'false').lower() == 'true',
+    'tts_concurrency': int(os.getenv('TTS_CONCURRENCY', '4')),
+    'max_chunk_chars': int(os.getenv('MAX_CHUNK_CHARS', '1500')),
+}
+
+# Single-flight: identical generation requests (same input and parameters)
+# that arrive while one is running wait for it and share its result. Within a
+# process this uses in-memory events; across workers, a claim row in the
+# database, kept alive by a heartbeat every LEASE/3 seconds.
+SINGLE_FLIGHT = {
+    'enabled': os.getenv('SINGLE_FLIGHT', 'true').lower() == 'true',
+    'shared': os.getenv('SINGLE_FLIGHT_SHARED', 'true').lower() == 'true',
+    'lease_seconds': float(os.getenv('SINGLE_FLIGHT_LEASE_SECONDS', '30')),
+    'poll_interval': float(os.getenv('SINGLE_FLIGHT_POLL_INTERVAL', '0.5')),
+    'wait_timeout': float(os.getenv('SINGLE_FLIGHT_WAIT_TIMEOUT', '1800')),
+    'retain_seconds': float(os.getenv('SINGLE_FLIGHT_RETAIN_SECONDS', '600')),
+}
+
+# History retention: a background task deletes entries older than
+# HISTORY_MAX_AGE_DAYS and, oldest first, entries beyond HISTORY_MAX_TOTAL_BYTES
+# of audio (0 disables either limit), RETENTION_BATCH_SIZE rows per statement.
+# On PostgreSQL, history_entries is range-partitioned by month so expired
+# months are dropped whole instead of row by row.
+RETENTION = {
+    'max_age_days': float(os.getenv('HISTORY_MAX_AGE_DAYS', '0')),
+    'max_total_bytes': int(os.getenv('HISTORY_MAX_TOTAL_BYTES', '0')),
+    'interval_seconds': float(os.getenv('RETENTION_INTERVAL_SECONDS', '3600')),
+    'batch_size': int(os.getenv('RETENTION_BATCH_SIZE', '500')),
+    'batch_pause': float(os.getenv('RETENTION_BATCH_PAUSE', '0.1')),
+    'partition': os.getenv('HISTORY_PARTITIONING', 'true').lower() == 'true',
+    'partitions_ahead': int(os.getenv('HISTORY_PARTITIONS_AHEAD', '2')),
+}
+
+# Podcast mode: the script is split into speaker turns, each synthesized with
+# its speaker's voice and style, up to PODCAST_TURN_CONCURRENCY at a time.
+# Turns longer than PODCAST_MAX_TURN_CHARS are cut at a sentence boundary, and
+# PODCAST_TURN_GAP_MS of silence is put between different speakers' turns.
+PODCAST = {
+    'second_voice': os.getenv('PODCAST_SECOND_VOICE', 'echo'),
+    'turn_concurrency': int(os.getenv('PODCAST_TURN_CONCURRENCY', '8')),
+    'max_turn_chars': int(os.getenv('PODCAST_MAX_TURN_CHARS', '400')),
+    'turn_gap_ms': int(os.getenv('PODCAST_TURN_GAP_MS', '300')),
+}
+
+# Variant requests: one upload narrated in several languages, voices or
+# lengths. The document is extracted once, and the model calls of all its
+# variants share VARIANT_CONCURRENCY slots.
+VARIANTS = {
+    'max_variants': int(os.getenv('MAX_VARIANTS', '8')),
+    'concurrency': int(os.getenv('VARIANT_CONCURRENCY', '8')),
+}
@@ -0,0 +1,56 @@
+"""gunicorn settings for the production server (see wsgi.py).
+
+The app and its heavy modules are loaded once in the master and shared by
+the forked workers. Anything holding sockets or threads (database pool,
+Azure OpenAI clients, blob store client) is created per worker after fork.
+"""
+import multiprocessing
+import os
+import tempfile
+
+# A rotating log file cannot be shared safely by several processes, so
+# workers log to stderr, which gunicorn and Docker collect
+os.environ.setdefault('LOG_FILE', '')
+# Every worker has its own metrics; /metrics merges the snapshots they write here
+os.environ.setdefault('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'aoai-audio-metrics'))
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5001')}"
+workers = int(os.getenv('WEB_CONCURRENCY', min(multiprocessing.cpu_count() * 2 + 1, 8)))
+# Requests spend most of their time waiting on Azure OpenAI, so each worker
+# serves several at once on threads
+worker_class = 'gthread'
+threads = int(os.getenv('GUNICORN_THREADS', '8'))
+# Long documents take minutes to summarize and narrate
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '600'))
+graceful_timeout = 30
+keepalive = 5
+preload_app = True
+accesslog = '-'
+
+
+def on_starting(server):
+    # Workers enforce their share of each deployment's rate limits
+    os.environ['AZURE_OPENAI_QUOTA_WORKERS'] = str(server.cfg.workers)
+    # Counters start from zero with each server run
+    from metrics import clear_shared_metrics
+    clear_shared_metrics(os.environ['METRICS_DIR'])
+
+
+def post_fork(server, worker):
+    # Connections opened by the master (init_db) must not be shared with workers
+    from database import engine
+    engine.dispose(close=False)
+    from config import METRICS
+    from metrics import REGISTRY
+    REGISTRY.share(METRICS['directory'], METRICS['write_interval'])
+
+
+def worker_exit(server, worker):
+    # Keep the exiting worker's final counts in the merged totals
+    from metrics import REGISTRY
+    REGISTRY.write_snapshot()
+
+
+def post_worker_init(worker):
+    from app import warm_up
+    warm_up()
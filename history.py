@@ -1,33 +1,176 @@
-from datetime import datetime
-import base64
-from database import SessionLocal
-from models import HistoryEntry
-from sqlalchemy import desc
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+import hashlib
+import io
+import logging
+import threading
+from audio import analyze_wav
+from database import SessionLocal, engine
+from metrics import span
+from blobstore import BlobNotFound, get_blob_store, is_stream
+from config import RETENTION
+from sqlalchemy.orm import scoped_session
+from models import HistoryEntry, SourceDocument
+from sqlalchemy import delete, desc, func, text
+from sqlalchemy.exc import IntegrityError
+
+logger = logging.getLogger(__name__)
+
+_last_entry_time = None
+_entry_id_lock = threading.Lock()
+# Stands in for the per-blob advisory locks on databases other than PostgreSQL
+_blob_lock = threading.Lock()
+
+def new_entry_id():
+    """Create a timestamp-based ID (maintaining compatibility) that is unique within the process"""
+    global _last_entry_time
+    with _entry_id_lock:
+        now = datetime.now()
+        # Microseconds keep entries saved within the same second from colliding;
+        # bumping past the last ID covers bulk inserts within one microsecond
+        if _last_entry_time is not None and now <= _last_entry_time:
+            now = _last_entry_time + timedelta(microseconds=1)
+        _last_entry_time = now
+        return now.strftime("%Y%m%d_%H%M%S_%f")
+
+def source_key(data, processing_method):
+    """ID of the SourceDocument for a document (bytes, or text for reruns) and processing method"""
+    data = data if isinstance(data, (bytes, bytearray)) else data.encode('utf-8')
+    return hashlib.sha256(f'{hashlib.sha256(data).hexdigest()}:{processing_method}'.encode('utf-8')).hexdigest()
 
 class HistoryManager:
-    def __init__(self):
-        """Initialize the HistoryManager with database session"""
-        self.db = SessionLocal()
+    def __init__(self, blob_store=None):
+        """Initialize the HistoryManager with a thread-local database session"""
+        # Requests are served from several threads; each gets its own session
+        self.db = scoped_session(SessionLocal)
+        self.blob_store = blob_store or get_blob_store()
 
-    def save_entry(self, audio_data, summary_html, original_filename, metadata, extracted_text):
-        """Save a new history entry to the database"""
+    def _build_entry(self, audio, summary_html, original_filename, metadata, extracted_text, source_id=None,
+                     entry_id=None):
+        # The WAV goes to the blob store; the row only references it by hash
+        audio_hash = self.blob_store.put(audio, 'audio/wav')
+        self._pin_blob(audio_hash, audio)
+        if is_stream(audio):
+            # The stream has been consumed, so the stored copy is analysed
+            audio_size = self.blob_store.size(audio_hash)
+            with self.blob_store.open(audio_hash) as stored:
+                audio_metadata = self._analyze_audio(stored)
+        else:
+            audio_size = len(audio)
+            audio_metadata = self._analyze_audio(audio)
+        return HistoryEntry(
+            id=entry_id or new_entry_id(),
+            original_filename=original_filename,
+            summary_html=summary_html,
+            audio_hash=audio_hash,
+            audio_size=audio_size,
+            audio_mime_type='audio/wav',
+            audio_metadata=audio_metadata,
+            settings_metadata=metadata,  # Using new column name
+            extracted_text=extracted_text,
+            source_id=source_id
+        )
+
+    def _analyze_audio(self, audio):
+        """Compute duration and waveform peaks once so the history list never needs the audio"""
         try:
-            # Create timestamp-based ID (maintaining compatibility)
-            entry_id = datetime.now().strftime("%Y%m%d_%H%M%S")
-            
-            # Create new entry
-            entry = HistoryEntry(
-                id=entry_id,
-                original_filename=original_filename,
-                summary_html=summary_html,
-                audio_data=base64.b64decode(audio_data),  # Store as binary
-                settings_metadata=metadata,  # Using new column name
-                extracted_text=extracted_text
-            )
-            
-            # Add and commit to database
-            self.db.add(entry)
-            self.db.commit()
+            with span('audio_analysis') as stage:
+                if not is_stream(audio):
+                    stage.bytes_in = len(audio)
+                return analyze_wav(audio)
+        except Exception as e:
+            # A missing waveform must not cost the user their narration
+            logger.warning(f"Could not analyze audio: {str(e)}")
+            return None
+
+    def open_audio(self, entry_id):
+        """Open an entry's audio for streaming.
+
+        Returns (file object, size, MIME type, content hash), or None if there
+        is no such entry. Entries not yet moved to the blob store are served
+        from the legacy column.
+        """
+        try:
+            entry = self.db.query(HistoryEntry).filter(HistoryEntry.id == entry_id).first()
+            if entry is None:
+                return None
+            if entry.audio_hash:
+                return (self.blob_store.open(entry.audio_hash), entry.audio_size, entry.audio_mime_type,
+                        entry.audio_hash)
+            if entry.audio_data is None:
+                return None
+            return io.BytesIO(entry.audio_data), len(entry.audio_data), entry.audio_mime_type, None
+        except Exception as e:
+            raise Exception(f"Failed to open entry audio: {str(e)}")
+
+    @contextmanager
+    def _blob_transaction(self):
+        """Scope of a transaction that locks blobs with _lock_blob.
+
+        A save holds its blobs' locks from after storing them until its entries
+        are committed, and release_blobs holds a blob's lock from its reference
+        check until the blob is deleted. A blob is therefore never deleted while
+        an entry that deduplicates to it is being saved. PostgreSQL locks each
+        blob with a transaction-level advisory lock, which also covers other
+        workers: shared for saves, so they never wait for each other, and
+        exclusive for releases. Other databases run these transactions one at a
+        time in the process.
+        """
+        if engine.dialect.name == 'postgresql':
+            yield
+        else:
+            with _blob_lock:
+                yield
+
+    def _lock_blob(self, audio_hash, shared=False):
+        if engine.dialect.name == 'postgresql':
+            # Held until the session's transaction ends; the key is the hash's first 60 bits
+            function = 'pg_advisory_xact_lock_shared' if shared else 'pg_advisory_xact_lock'
+            self.db.execute(text(f'SELECT {function}(:key)'), {'key': int(audio_hash[:15], 16)})
+
+    def _pin_blob(self, audio_hash, audio):
+        """Lock a just-stored blob for the save, storing it again if a release deleted it meanwhile"""
+        self._lock_blob(audio_hash, shared=True)
+        if self.blob_store.exists(audio_hash):
+            return
+        if is_stream(audio):
+            if not audio.seekable():
+                raise BlobNotFound(audio_hash)
+            audio.seek(0)
+        logger.info(f'Storing blob {audio_hash[:12]} again after it was released')
+        self.blob_store.put(audio, 'audio/wav')
+
+    def release_blobs(self, audio_hashes):
+        """Delete blobs that are no longer referenced by any entry"""
+        for audio_hash in {audio_hash for audio_hash in audio_hashes if audio_hash}:
+            with self._blob_transaction():
+                try:
+                    self._lock_blob(audio_hash)
+                    still_used = self.db.query(HistoryEntry.id).filter(HistoryEntry.audio_hash == audio_hash).first()
+                    if not still_used:
+                        self.blob_store.delete(audio_hash)
+                    self.db.commit()
+                except Exception:
+                    self.db.rollback()
+                    raise
+
+    def save_entry(self, audio, summary_html, original_filename, metadata, extracted_text, source_id=None):
+        """Save a new history entry to the database.
+
+        audio is the WAV file as a bytes-like object or a readable binary
+        stream, which is copied to the blob store without being read whole.
+        """
+        try:
+            with span('db_save') as stage, self._blob_transaction():
+                # Create new entry
+                entry = self._build_entry(audio, summary_html, original_filename, metadata, extracted_text,
+                                          source_id)
+                entry_id = entry.id
+                stage.bytes_in = entry.audio_size
+                
+                # Add and commit to database
+                self.db.add(entry)
+                self.db.commit()
             
             return entry_id
             
@@ -35,6 +178,53 @@ class HistoryManager:
             self.db.rollback()
             raise Exception(f"Failed to save history entry: {str(e)}")
 
+    def save_entries(self, entries):
+        """Save several history entries in one transaction.
+
+        Each item is a dict with the keyword arguments of save_entry, and
+        optionally an entry_id from new_entry_id() assigned in advance. Returns
+        the new entry IDs in the same order.
+        """
+        try:
+            with span('db_save', entries=len(entries)) as stage, self._blob_transaction():
+                rows = [self._build_entry(**item) for item in entries]
+                stage.bytes_in = sum(row.audio_size for row in rows)
+                entry_ids = [row.id for row in rows]
+                self.db.add_all(rows)
+                self.db.commit()
+            return entry_ids
+
+        except Exception as e:
+            self.db.rollback()
+            raise Exception(f"Failed to save history entries: {str(e)}")
+
+    def get_source_text(self, source_id):
+        """Get the extracted text of a source document, or None if it was never stored"""
+        try:
+            text = self.db.query(SourceDocument.extracted_text).filter(SourceDocument.id == source_id).scalar()
+            self.db.commit()
+            return text
+        except Exception as e:
+            self.db.rollback()
+            raise Exception(f"Failed to get source document: {str(e)}")
+
+    def save_source(self, source_id, original_filename, processing_method, extracted_text):
+        """Store a document's extracted text for its variants (kept if it already exists)"""
+        try:
+            self.db.add(SourceDocument(
+                id=source_id,
+                original_filename=original_filename,
+                processing_method=processing_method,
+                extracted_text=extracted_text
+            ))
+            self.db.commit()
+        except IntegrityError:
+            # Another request stored the same document first
+            self.db.rollback()
+        except Exception as e:
+            self.db.rollback()
+            raise Exception(f"Failed to save source document: {str(e)}")
+
     def get_entries(self, limit=10, offset=0, include_text=False):
         """Get the most recent history entries from the database"""
         try:
@@ -42,12 +232,22 @@ class HistoryManager:
             query = self.db.query(HistoryEntry).order_by(desc(HistoryEntry.timestamp))
             entries = query.offset(offset).limit(limit).all()
             
+            # Variants keep their text on the source document, fetched in one query
+            source_texts = {}
+            if include_text:
+                source_ids = {entry.source_id for entry in entries if entry.extracted_text is None and entry.source_id}
+                if source_ids:
+                    source_texts = dict(self.db.query(SourceDocument.id, SourceDocument.extracted_text)
+                                        .filter(SourceDocument.id.in_(source_ids)))
+
             # Convert entries to dictionary format
             result = []
             for entry in entries:
                 entry_dict = entry.to_dict()
                 if not include_text:
                     entry_dict.pop('extracted_text', None)
+                elif entry_dict['extracted_text'] is None:
+                    entry_dict['extracted_text'] = source_texts.get(entry.source_id)
                 result.append(entry_dict)
             
             return result
@@ -55,37 +255,82 @@ class HistoryManager:
         except Exception as e:
             raise Exception(f"Failed to get history entries: {str(e)}")
 
-    def get_entry_text(self, entry_id):
-        """Get the extracted text for a specific entry"""
+    def get_entry(self, entry_id):
+        """Get one history entry; its audio is read through open_audio"""
         try:
             entry = self.db.query(HistoryEntry).filter(HistoryEntry.id == entry_id).first()
-            return entry.extracted_text if entry else None
+            return entry.to_dict() if entry else None
+        except Exception as e:
+            raise Exception(f"Failed to get history entry: {str(e)}")
+
+    def get_entry_text(self, entry_id):
+        """Get the extracted text for a specific entry, or its source document's for variants"""
+        try:
+            return (self.db.query(func.coalesce(HistoryEntry.extracted_text, SourceDocument.extracted_text))
+                    .outerjoin(SourceDocument, SourceDocument.id == HistoryEntry.source_id)
+                    .filter(HistoryEntry.id == entry_id)
+                    .scalar())
         except Exception as e:
             raise Exception(f"Failed to get entry text: {str(e)}")
 
     def delete_entry(self, entry_id):
         """Delete a history entry"""
         try:
-            entry = self.db.query(HistoryEntry).filter(HistoryEntry.id == entry_id).first()
-            if entry:
-                self.db.delete(entry)
-                self.db.commit()
-                return True
-            return False
+            return self._delete_where(HistoryEntry.id == entry_id) > 0
         except Exception as e:
             self.db.rollback()
             raise Exception(f"Failed to delete history entry: {str(e)}")
 
-    def clear_history(self):
-        """Clear all history entries"""
+    def delete_entries(self, entry_ids):
+        """Delete several history entries in one statement and return how many were deleted"""
         try:
-            self.db.query(HistoryEntry).delete()
-            self.db.commit()
+            return self._delete_where(HistoryEntry.id.in_(entry_ids)) if entry_ids else 0
+        except Exception as e:
+            self.db.rollback()
+            raise Exception(f"Failed to delete history entries: {str(e)}")
+
+    def _delete_where(self, condition):
+        # A single DELETE ... RETURNING, so rows (and their text and audio
+        # columns) are never loaded just to be removed
+        audio_hashes = self.db.execute(
+            delete(HistoryEntry).where(condition).returning(HistoryEntry.audio_hash),
+            execution_options={'synchronize_session': False}
+        ).scalars().all()
+        self.db.commit()
+        self.release_blobs(set(audio_hashes))
+        return len(audio_hashes)
+
+    def clear_history(self, batch_size=None):
+        """Clear all history entries, a batch of rows per statement"""
+        batch_size = batch_size or RETENTION['batch_size']
+        try:
+            while True:
+                entry_ids = [row.id for row in self.db.query(HistoryEntry.id).order_by(HistoryEntry.id).limit(batch_size)]
+                if not entry_ids:
+                    break
+                self._delete_where(HistoryEntry.id.in_(entry_ids))
+            self.purge_sources()
             return True
         except Exception as e:
             self.db.rollback()
             raise Exception(f"Failed to clear history: {str(e)}")
 
+    def purge_sources(self, created_before=None):
+        """Delete source documents that no history entry refers to any more; returns how many"""
+        try:
+            unused = ~self.db.query(HistoryEntry.id).filter(HistoryEntry.source_id == SourceDocument.id).exists()
+            if created_before is not None:
+                # Spare sources whose variants are still being generated
+                unused = unused & (SourceDocument.created_at < created_before)
+            deleted = self.db.execute(
+                delete(SourceDocument).where(unused), execution_options={'synchronize_session': False}
+            ).rowcount
+            self.db.commit()
+            return deleted
+        except Exception as e:
+            self.db.rollback()
+            raise Exception(f"Failed to purge source documents: {str(e)}")
+
     def __del__(self):
         """Ensure database session is closed"""
-        self.db.close() 
\ No newline at end of file
+        self.db.remove() 
\ No newline at end of file
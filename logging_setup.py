@@ -0,0 +1,140 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import zlib
+
+from config import LOGGING
+from metrics import REGISTRY, Counter, current_span, current_trace
+
+TEXT_FORMAT = '%(asctime)s - %(levelname)s - [%(request_id)s %(stage)s] %(message)s'
+
+LOG_DROPPED = REGISTRY.register(Counter(
+    'log_records_dropped_total', 'Log records dropped because the log queue was full'))
+
+_listener = None
+_listener_lock = threading.Lock()
+_settings = dict(LOGGING)
+
+
+class ContextFilter(logging.Filter):
+    """Attach the request ID and pipeline stage of the calling thread to each record"""
+
+    def filter(self, record):
+        trace = current_trace()
+        stage = current_span()
+        record.request_id = trace.request_id if trace is not None else '-'
+        record.stage = stage.stage if stage is not None else '-'
+        return True
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Hand records to the listener thread, dropping them rather than blocking when it falls behind"""
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_DROPPED.inc()
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'request_id': getattr(record, 'request_id', '-'),
+            'stage': getattr(record, 'stage', '-'),
+            'message': record.getMessage()
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+def _output_handlers(settings):
+    formatter = JsonFormatter() if settings['format'] == 'json' else logging.Formatter(TEXT_FORMAT)
+    handlers = [logging.StreamHandler()]
+    if settings['file']:
+        handlers.append(logging.handlers.RotatingFileHandler(
+            settings['file'],
+            maxBytes=settings['max_bytes'],
+            backupCount=settings['backup_count'],
+            delay=True
+        ))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    return handlers
+
+
+def _start_listener(settings):
+    """Route the root logger through a queue drained by a background writer thread"""
+    global _listener
+    log_queue = queue.Queue(maxsize=settings['queue_size'])
+    queue_handler = DroppingQueueHandler(log_queue)
+    queue_handler.addFilter(ContextFilter())
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(settings['level'])
+
+    _listener = logging.handlers.QueueListener(log_queue, *_output_handlers(settings), respect_handler_level=True)
+    _listener.start()
+
+
+def _restart_after_fork():
+    # The writer thread does not survive fork; give the child its own
+    if _listener is not None:
+        _start_listener(_settings)
+
+
+def configure_logging(**overrides):
+    """Set up non-blocking logging for the process (safe to call more than once)
+
+    Keyword arguments override entries of config.LOGGING, e.g. file=None for
+    console-only logging in command-line tools.
+    """
+    with _listener_lock:
+        if _listener is not None:
+            return
+        _settings.update(overrides)
+        _start_listener(_settings)
+        atexit.register(stop_logging)
+
+
+def stop_logging():
+    """Flush queued records and stop the writer thread"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def payload_sampled():
+    """Whether the current request logs payloads in full (sampled per request ID)"""
+    rate = _settings['payload_sample_rate']
+    if rate <= 0:
+        return False
+    trace = current_trace()
+    if rate >= 1 or trace is None:
+        return rate >= 1
+    return zlib.crc32(trace.request_id.encode('utf-8')) % 10000 < rate * 10000
+
+
+def payload(value, limit=None):
+    """Shorten a potentially large value for logging, e.g. form fields or model output"""
+    text = value if isinstance(value, str) else str(value)
+    limit = _settings['max_payload_chars'] if limit is None else limit
+    if len(text) <= limit or payload_sampled():
+        return text
+    return f'{text[:limit]}... [{len(text) - limit} more chars]'
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_restart_after_fork)
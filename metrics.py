@@ -0,0 +1,381 @@
+import contextvars
+import glob
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+# Default histogram buckets (seconds) sized for model calls that range from
+# sub-second OCR pages to multi-minute summarizations
+DURATION_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+BYTES_BUCKETS = (1024, 10240, 102400, 1048576, 10485760, 52428800, 104857600)
+
+# Per-request trace, populated by span() while a request is active
+_current_trace = contextvars.ContextVar('current_trace', default=None)
+_current_span = contextvars.ContextVar('current_span', default=None)
+_trace_listeners = []
+
+logger = logging.getLogger(__name__)
+
+
+def _label_key(pairs):
+    """Rebuild a label key from its JSON form, a list of [name, value] pairs"""
+    return tuple(tuple(pair) for pair in pairs)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    parts = []
+    for key, value in labels:
+        escaped = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(f'{key}="{escaped}"')
+    return '{' + ','.join(parts) + '}'
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def snapshot(self):
+        """This process's values in a JSON-serializable form"""
+        with self._lock:
+            return [[list(key), value] for key, value in self._values.items()]
+
+    def render(self, snapshots=None):
+        """Render this process's values, or the sum of several processes' snapshots"""
+        if snapshots is None:
+            snapshots = [self.snapshot()]
+        values = {}
+        for snapshot in snapshots:
+            for key, value in snapshot:
+                key = _label_key(key)
+                values[key] = values.get(key, 0) + value
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.kind}']
+        for key, value in sorted(values.items()):
+            lines.append(f'{self.name}{_format_labels(key)} {value}')
+        return lines
+
+
+class Gauge(Counter):
+    """A value that is set rather than incremented; across processes, live processes' values are summed"""
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, description, buckets=DURATION_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['counts'][i] += 1
+            series['sum'] += value
+            series['count'] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(key), {**series, 'counts': list(series['counts'])}] for key, series in self._series.items()]
+
+    def render(self, snapshots=None):
+        if snapshots is None:
+            snapshots = [self.snapshot()]
+        merged = {}
+        for snapshot in snapshots:
+            for key, series in snapshot:
+                total = merged.setdefault(_label_key(key), {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0})
+                total['counts'] = [a + b for a, b in zip(total['counts'], series['counts'])]
+                total['sum'] += series['sum']
+                total['count'] += series['count']
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} histogram']
+        for key, series in sorted(merged.items()):
+            for bound, count in zip(self.buckets, series['counts']):
+                lines.append(f'{self.name}_bucket{_format_labels(key + (("le", bound),))} {count}')
+            lines.append(f'{self.name}_bucket{_format_labels(key + (("le", "+Inf"),))} {series["count"]}')
+            lines.append(f'{self.name}_sum{_format_labels(key)} {series["sum"]}')
+            lines.append(f'{self.name}_count{_format_labels(key)} {series["count"]}')
+        return lines
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Registry:
+    """The process's metrics, optionally shared with sibling worker processes.
+
+    Under a pre-forking server every worker has its own registry. Once share
+    is called, the worker writes a snapshot of its metrics to a directory
+    every few seconds and on exit, and render merges the snapshots of all
+    workers: counters and histograms are summed over every worker that ever
+    wrote one, gauges over the workers still running.
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._directory = None
+        self._path = None
+        self._write_lock = threading.Lock()
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def share(self, directory, interval=5.0):
+        """Start writing this process's snapshots to directory for merged rendering"""
+        os.makedirs(directory, exist_ok=True)
+        self._directory = directory
+        # Unique per worker, so a reused PID never overwrites an exited worker's totals
+        self._path = os.path.join(directory, f'metrics-{os.getpid()}-{uuid.uuid4().hex[:8]}.json')
+        self.write_snapshot()
+        thread = threading.Thread(target=self._write_periodically, args=(interval,), name='metrics-writer',
+                                  daemon=True)
+        thread.start()
+
+    def _write_periodically(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.write_snapshot()
+            except Exception as e:
+                logger.warning(f'Could not write metrics snapshot: {str(e)}')
+
+    def write_snapshot(self):
+        if self._path is None:
+            return
+        data = {'pid': os.getpid(), 'metrics': {metric.name: metric.snapshot() for metric in self._metrics}}
+        with self._write_lock:
+            fd, tmp_path = tempfile.mkstemp(dir=self._directory, prefix='.tmp-')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self._path)
+
+    def _read_snapshots(self):
+        snapshots = []
+        for path in glob.glob(os.path.join(self._directory, 'metrics-*.json')):
+            try:
+                with open(path) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue  # Removed or replaced while being read
+        return snapshots
+
+    def render(self):
+        """Render all registered metrics in the Prometheus text exposition format"""
+        snapshots = None
+        if self._directory is not None:
+            # Include this worker's latest values, then merge every worker's
+            self.write_snapshot()
+            snapshots = self._read_snapshots()
+        lines = []
+        for metric in self._metrics:
+            if snapshots is None:
+                lines.extend(metric.render())
+                continue
+            lines.extend(metric.render([
+                snapshot['metrics'].get(metric.name, []) for snapshot in snapshots
+                if metric.kind != 'gauge' or _process_alive(snapshot['pid'])
+            ]))
+        return '\n'.join(lines) + '\n'
+
+
+def clear_shared_metrics(directory):
+    """Remove the snapshots of a previous server run"""
+    for path in glob.glob(os.path.join(directory, 'metrics-*.json')):
+        os.unlink(path)
+
+
+REGISTRY = Registry()
+
+STAGE_DURATION = REGISTRY.register(Histogram(
+    'aoai_stage_duration_seconds', 'Duration of each pipeline stage'))
+STAGE_BYTES = REGISTRY.register(Histogram(
+    'aoai_stage_payload_bytes', 'Payload size handled by each pipeline stage', buckets=BYTES_BUCKETS))
+STAGE_TOTAL = REGISTRY.register(Counter(
+    'aoai_stage_total', 'Number of pipeline stage executions by outcome'))
+STAGE_TOKENS = REGISTRY.register(Counter(
+    'aoai_stage_tokens_total', 'Tokens consumed by each pipeline stage'))
+STAGE_RETRIES = REGISTRY.register(Counter(
+    'aoai_stage_retries_total', 'Retries performed by each pipeline stage'))
+REQUEST_DURATION = REGISTRY.register(Histogram(
+    'aoai_request_duration_seconds', 'End-to-end request duration'))
+
+
+class Span:
+    """Timing and usage record for a single pipeline stage"""
+
+    def __init__(self, stage, attributes=None):
+        self.stage = stage
+        self.attributes = dict(attributes or {})
+        self.start = time.perf_counter()
+        self.duration = None
+        self.status = 'ok'
+        self.prompt_tokens = 0
+        self.cached_tokens = 0  # Prompt tokens served from the deployment's prompt cache
+        self.completion_tokens = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.retries = 0
+
+    def record_usage(self, completion):
+        """Record token usage from a chat completion, if present"""
+        usage = getattr(completion, 'usage', None)
+        if usage is None:
+            return
+        self.prompt_tokens += getattr(usage, 'prompt_tokens', 0) or 0
+        self.completion_tokens += getattr(usage, 'completion_tokens', 0) or 0
+        details = getattr(usage, 'prompt_tokens_details', None)
+        self.cached_tokens += getattr(details, 'cached_tokens', 0) or 0
+
+    def to_dict(self):
+        return {
+            'stage': self.stage,
+            'duration_ms': round((self.duration or 0) * 1000, 2),
+            'status': self.status,
+            'prompt_tokens': self.prompt_tokens,
+            'cached_tokens': self.cached_tokens,
+            'completion_tokens': self.completion_tokens,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'retries': self.retries,
+            **self.attributes
+        }
+
+
+class RequestTrace:
+    """Collects the spans recorded during one request"""
+
+    def __init__(self, name, request_id=None):
+        self.name = name
+        self.request_id = request_id or uuid.uuid4().hex[:12]
+        self.start = time.perf_counter()
+        self.duration = None
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def add(self, span):
+        with self._lock:
+            self.spans.append(span)
+
+    def stage_totals(self):
+        """Sum span durations (seconds) per stage"""
+        totals = {}
+        with self._lock:
+            for span in self.spans:
+                totals[span.stage] = totals.get(span.stage, 0.0) + (span.duration or 0.0)
+        return totals
+
+    def to_dict(self):
+        with self._lock:
+            spans = [span.to_dict() for span in self.spans]
+        return {
+            'request_id': self.request_id,
+            'name': self.name,
+            'duration_ms': round((self.duration or 0) * 1000, 2),
+            'spans': spans
+        }
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+def current_span():
+    return _current_span.get()
+
+
+def add_trace_listener(listener):
+    """Register a callable that receives every completed RequestTrace"""
+    _trace_listeners.append(listener)
+
+
+def remove_trace_listener(listener):
+    if listener in _trace_listeners:
+        _trace_listeners.remove(listener)
+
+
+@contextmanager
+def request_trace(name, request_id=None):
+    """Start a per-request trace that spans recorded below it are attached to"""
+    trace = RequestTrace(name, request_id)
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        trace.duration = time.perf_counter() - trace.start
+        REQUEST_DURATION.observe(trace.duration, route=name)
+        _current_trace.reset(token)
+        for listener in list(_trace_listeners):
+            listener(trace)
+
+
+@contextmanager
+def span(stage, **attributes):
+    """Time a pipeline stage and export its duration, tokens, bytes and retries"""
+    current = Span(stage, attributes)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException:
+        current.status = 'error'
+        raise
+    finally:
+        _current_span.reset(token)
+        current.duration = time.perf_counter() - current.start
+        STAGE_DURATION.observe(current.duration, stage=stage)
+        STAGE_TOTAL.inc(stage=stage, status=current.status)
+        if current.prompt_tokens:
+            STAGE_TOKENS.inc(current.prompt_tokens, stage=stage, kind='prompt')
+        if current.cached_tokens:
+            STAGE_TOKENS.inc(current.cached_tokens, stage=stage, kind='cached')
+        if current.completion_tokens:
+            STAGE_TOKENS.inc(current.completion_tokens, stage=stage, kind='completion')
+        if current.bytes_in:
+            STAGE_BYTES.observe(current.bytes_in, stage=stage, direction='in')
+        if current.bytes_out:
+            STAGE_BYTES.observe(current.bytes_out, stage=stage, direction='out')
+        if current.retries:
+            STAGE_RETRIES.inc(current.retries, stage=stage)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.add(current)
+
+
+def render_metrics():
+    return REGISTRY.render()
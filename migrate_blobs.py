@@ -0,0 +1,134 @@
+"""Move audio stored inline in history_entries.audio_data into the blob store.
+
+Adds the blob reference columns if they are missing, then processes rows in
+small batches: each WAV is written to the blob store, the row gets its hash,
+size and MIME type, and the inline copy is cleared. Every batch commits on
+its own and only rows without an audio_hash are selected, so the migration
+can be interrupted and rerun at any time.
+
+Entries saved before waveform peaks were computed at save time are then
+backfilled with their duration and peaks, in the same resumable batches.
+
+Usage:
+    python migrate_blobs.py --batch-size 50
+    python migrate_blobs.py --keep-inline   # copy to the blob store but keep audio_data
+"""
+import argparse
+import logging
+
+from dotenv import load_dotenv
+
+load_dotenv('keys.env')
+
+from sqlalchemy import func
+
+from audio import analyze_wav
+from blobstore import get_blob_store
+from database import SessionLocal, engine, init_db
+from logging_setup import configure_logging
+from models import HistoryEntry
+
+logger = logging.getLogger('migrate_blobs')
+
+
+def migrate(batch_size=50, keep_inline=False):
+    init_db()
+    store = get_blob_store()
+    db = SessionLocal()
+    migrated = 0
+    moved_bytes = 0
+    last_id = ''
+    try:
+        remaining = db.query(func.count(HistoryEntry.id)).filter(
+            HistoryEntry.audio_hash.is_(None), HistoryEntry.audio_data.isnot(None)
+        ).scalar()
+        logger.info(f'{remaining} entries to migrate')
+
+        while True:
+            # Keyset pagination on id keeps each batch query cheap and lets
+            # --keep-inline runs move past rows they have already copied
+            ids = [row.id for row in db.query(HistoryEntry.id).filter(
+                HistoryEntry.audio_hash.is_(None),
+                HistoryEntry.audio_data.isnot(None),
+                HistoryEntry.id > last_id
+            ).order_by(HistoryEntry.id).limit(batch_size)]
+            if not ids:
+                break
+
+            for entry_id in ids:
+                audio_data = db.query(HistoryEntry.audio_data).filter(HistoryEntry.id == entry_id).scalar()
+                audio_hash = store.put(audio_data, 'audio/wav')
+                values = {
+                    HistoryEntry.audio_hash: audio_hash,
+                    HistoryEntry.audio_size: len(audio_data),
+                    HistoryEntry.audio_mime_type: 'audio/wav'
+                }
+                if not keep_inline:
+                    values[HistoryEntry.audio_data] = None
+                db.query(HistoryEntry).filter(HistoryEntry.id == entry_id).update(values, synchronize_session=False)
+                moved_bytes += len(audio_data)
+            db.commit()
+            migrated += len(ids)
+            last_id = ids[-1]
+            logger.info(f'Migrated {migrated}/{remaining} entries ({moved_bytes / (1024 * 1024):.1f} MB)')
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+    if migrated and not keep_inline and engine.dialect.name == 'postgresql':
+        logger.info('Done. Run VACUUM (FULL) history_entries during a quiet period to return the freed space.')
+    return migrated
+
+
+def backfill_audio_metadata(batch_size=50):
+    """Compute duration and waveform peaks for entries saved before they were stored"""
+    store = get_blob_store()
+    db = SessionLocal()
+    filled = 0
+    last_id = ''
+    try:
+        while True:
+            rows = db.query(HistoryEntry.id, HistoryEntry.audio_hash).filter(
+                HistoryEntry.audio_metadata.is_(None),
+                HistoryEntry.audio_hash.isnot(None),
+                HistoryEntry.id > last_id
+            ).order_by(HistoryEntry.id).limit(batch_size).all()
+            if not rows:
+                break
+
+            for row in rows:
+                try:
+                    audio_metadata = analyze_wav(store.get(row.audio_hash))
+                except Exception as e:
+                    logger.warning(f'Skipping {row.id}: {str(e)}')
+                    continue
+                db.query(HistoryEntry).filter(HistoryEntry.id == row.id).update(
+                    {HistoryEntry.audio_metadata: audio_metadata}, synchronize_session=False
+                )
+                filled += 1
+            db.commit()
+            last_id = rows[-1].id
+            logger.info(f'Backfilled audio metadata for {filled} entries')
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+    return filled
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Move inline history audio into the blob store')
+    parser.add_argument('--batch-size', type=int, default=50, help='Rows per transaction')
+    parser.add_argument('--keep-inline', action='store_true', help='Copy audio to the blob store without clearing audio_data')
+    args = parser.parse_args()
+
+    configure_logging(file=None)
+    migrate(args.batch_size, args.keep_inline)
+    backfill_audio_metadata(args.batch_size)
+
+
+if __name__ == '__main__':
+    main()
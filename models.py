@@ -1,27 +1,62 @@
-from sqlalchemy import Column, Integer, String, DateTime, LargeBinary, JSON, Text
+from sqlalchemy import Column, Integer, BigInteger, Float, String, DateTime, LargeBinary, JSON, Text
+from sqlalchemy.orm import deferred
 from sqlalchemy.sql import func
 from database import Base
-import base64
 
 class HistoryEntry(Base):
     __tablename__ = "history_entries"
 
     id = Column(String, primary_key=True)  # Using string ID to maintain compatibility
-    timestamp = Column(DateTime(timezone=True), server_default=func.now())
+    # Partition key of the table on PostgreSQL (see retention.py)
+    timestamp = Column(DateTime(timezone=True), server_default=func.now(), nullable=False, index=True)
     original_filename = Column(String)
     summary_html = Column(Text)
-    audio_data = Column(LargeBinary)  # For storing WAV files
+    # Legacy inline WAV storage; emptied by migrate_blobs.py and never loaded
+    # unless accessed explicitly
+    audio_data = deferred(Column(LargeBinary))
+    audio_hash = Column(String(64), index=True)  # SHA-256 of the WAV in the blob store
+    audio_size = Column(BigInteger)
+    audio_mime_type = Column(String)
+    audio_metadata = Column(JSON)  # Duration, sample rate and waveform peaks computed at save time
     settings_metadata = Column(JSON)  # For storing processing settings
     extracted_text = Column(Text)
+    # SourceDocument the entry was narrated from, for entries of variant requests
+    source_id = Column(String(64), index=True)
 
     def to_dict(self):
-        """Convert entry to dictionary format"""
+        """Convert entry to dictionary format; the audio itself is served from /history/<id>/audio"""
         return {
             "id": self.id,
             "timestamp": self.timestamp.isoformat(),
             "original_filename": self.original_filename,
             "summary_html": self.summary_html,
-            "audio_data": base64.b64encode(self.audio_data).decode('utf-8') if self.audio_data else None,
+            "audio_size": self.audio_size,
+            "audio_mime_type": self.audio_mime_type,
+            "audio_metadata": self.audio_metadata,
             "settings": self.settings_metadata,
-            "extracted_text": self.extracted_text
-        } 
\ No newline at end of file
+            "extracted_text": self.extracted_text,
+            "source_id": self.source_id
+        }
+
+class SourceDocument(Base):
+    """A document's extracted text, shared by the history entries of its variants"""
+    __tablename__ = "source_documents"
+
+    id = Column(String(64), primary_key=True)  # SHA-256 of the document and processing method
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    original_filename = Column(String)
+    processing_method = Column(String)
+    extracted_text = Column(Text)
+
+class InFlightGeneration(Base):
+    """Claim on a running generation, so identical requests in other workers wait for it"""
+    __tablename__ = "inflight_generations"
+
+    key = Column(String(64), primary_key=True)  # SHA-256 of the input and generation parameters
+    owner = Column(String)  # host:pid of the worker running it
+    status = Column(String, nullable=False)  # running, done or failed
+    claimed_at = Column(Float, nullable=False)  # Epoch seconds; identifies one run of the key
+    heartbeat_at = Column(Float, nullable=False, index=True)
+    entry_id = Column(String)  # History entry holding the result once done
+    error = Column(Text)
+    status_code = Column(Integer)
@@ -0,0 +1,724 @@
+import asyncio
+import base64
+import contextvars
+import hashlib
+import importlib
+import io
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from aoai_client import get_client
+from audio import PCM16_SAMPLE_RATE, PcmBuffer, pcm_to_wav
+from config import AZURE_MODELS, PIPELINE, PODCAST, VARIANTS
+from logging_setup import payload
+from metrics import REGISTRY, Histogram, span
+from prompts import (card_messages, language_name, narration_messages, ocr_messages, summary_messages,
+                     turn_messages)
+from tools import get_summary_card_tool, process_summary_card
+
+logger = logging.getLogger(__name__)
+
+# PDF and audio libraries are imported on first use (or by preload_modules)
+# so importing the pipeline stays cheap for tools that never need them
+HEAVY_MODULES = ('PyPDF2', 'pdf2image', 'pydub')
+
+
+def preload_modules():
+    """Import the PDF and audio libraries ahead of the first request that needs them"""
+    for name in HEAVY_MODULES:
+        importlib.import_module(name)
+
+# Rough narration speed, used to size the buffer for a chunk's streamed audio
+SPOKEN_CHARS_PER_SECOND = 14
+
+TTS_FIRST_AUDIO = REGISTRY.register(Histogram(
+    'aoai_tts_first_audio_seconds', 'Time from sending a streamed TTS request to its first audio frames'))
+
+# Extracted text keyed by (sha256 of the file, processing method), so the same
+# document is only extracted once per process (reruns, batch manifests that
+# list one file several times)
+EXTRACTION_CACHE_SIZE = 64
+_extraction_cache = OrderedDict()
+_extraction_cache_lock = threading.Lock()
+
+
+# Model call slots shared by all variants of one request (see generate_variants)
+_call_budget = contextvars.ContextVar('call_budget', default=None)
+
+
+@contextmanager
+def call_slot():
+    """Hold one of the request's shared model call slots while a call runs, if it has a budget"""
+    budget = _call_budget.get()
+    if budget is None:
+        yield
+        return
+    with budget:
+        yield
+
+
+class PipelineError(Exception):
+    """A pipeline failure with the HTTP status the API should report"""
+
+    def __init__(self, message, status_code=500):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+
+PAGE_BREAK = "=== Page Break ==="
+# End of a sentence including closing quotes/brackets; CJK full stops need no space
+SENTENCE_END = re.compile(r'[.!?\u2026]["\'\u201d\u2019)\]]*\s+|[\u3002\uff01\uff1f]["\'\u201d\u2019)\]]*\s*')
+
+
+class ChunkSplitter:
+    """Cut a summary into narration chunks while it is still being generated.
+
+    A chunk is complete once its page break arrives. If the model writes more
+    than max_chars without one, the text is cut at the last sentence boundary
+    within max_chars so synthesis does not have to wait for the page break.
+    """
+
+    def __init__(self, max_chars=1500):
+        self.max_chars = max_chars
+        self._buffer = ''
+
+    def feed(self, text):
+        """Add streamed text and return the chunks it completed"""
+        self._buffer += text
+        chunks = []
+        while True:
+            index = self._buffer.find(PAGE_BREAK)
+            # Search up to the page break, or leave out the tail, which may
+            # hold the start of one. Without a page break, wait until the
+            # searched text reaches past max_chars, so every sentence end that
+            # fits has arrived and the cut is the one the whole text would get
+            end = index if index >= 0 else len(self._buffer) - len(PAGE_BREAK)
+            if end > self.max_chars:
+                boundaries = [m.end() for m in SENTENCE_END.finditer(self._buffer, 0, end)]
+                if boundaries:
+                    # Cut at the last sentence end that fits; a single sentence
+                    # longer than max_chars is cut at its own end
+                    fitting = [boundary for boundary in boundaries if boundary <= self.max_chars]
+                    cut = fitting[-1] if fitting else boundaries[0]
+                    chunks.append(self._buffer[:cut])
+                    self._buffer = self._buffer[cut:]
+                    continue
+            if index >= 0:
+                chunks.append(self._buffer[:index])
+                self._buffer = self._buffer[index + len(PAGE_BREAK):]
+                continue
+            break
+        return [chunk.strip() for chunk in chunks if chunk.strip()]
+
+    def flush(self):
+        """Return the final chunks once the summary is complete"""
+        # A closing page break lets the rest be cut like any other text
+        chunks = self.feed(PAGE_BREAK)
+        self._buffer = ''
+        return chunks
+
+
+def split_summary(summary, max_chars=None):
+    """Split a complete summary into narration chunks"""
+    splitter = ChunkSplitter(max_chars or PIPELINE['max_chunk_chars'])
+    return splitter.feed(summary) + splitter.flush()
+
+
+# A podcast line opens with its speaker's label, e.g. "Speaker 2:" or "**Speaker 1 (Host):**"
+SPEAKER_LABEL = re.compile(r'^[\s*_#>-]*speaker\s*(\d+)[^:\n]{0,40}:[\s*_]*', re.IGNORECASE)
+
+
+class TurnSplitter:
+    """Cut a podcast script into (speaker, text) turns while it is still being generated.
+
+    A turn is complete once the next speaker's label arrives. Turns longer
+    than max_chars are cut at a sentence boundary into several turns of the
+    same speaker, so long answers are synthesized in parallel too.
+    """
+
+    def __init__(self, max_chars=400):
+        self.max_chars = max_chars
+        self._line = ''
+        self._speaker = 1
+        self._text = ''
+
+    def feed(self, text):
+        """Add streamed text and return the turns it completed"""
+        lines = (self._line + text).split('\n')
+        # The last line may still be missing the rest of its label
+        self._line = lines.pop()
+        turns = []
+        for line in lines:
+            turns.extend(self._add_line(line))
+        return turns
+
+    def flush(self):
+        """Return the final turns once the script is complete"""
+        turns = self._add_line(self._line)
+        self._line = ''
+        return turns + self._take(len(self._text))
+
+    def _add_line(self, line):
+        turns = []
+        line = line.replace(PAGE_BREAK, '')
+        label = SPEAKER_LABEL.match(line)
+        if label:
+            turns.extend(self._take(len(self._text)))
+            self._speaker = int(label.group(1))
+            line = line[label.end():]
+        self._text += line + '\n'
+        while len(self._text) > self.max_chars:
+            boundaries = [m.end() for m in SENTENCE_END.finditer(self._text, 0, len(self._text) - 1)]
+            if not boundaries:
+                break
+            fitting = [boundary for boundary in boundaries if boundary <= self.max_chars]
+            turns.extend(self._take(fitting[-1] if fitting else boundaries[0]))
+        return turns
+
+    def _take(self, length):
+        # End the current speaker's turn after length characters
+        text, self._text = self._text[:length].strip(), self._text[length:]
+        return [(self._speaker, text)] if text else []
+
+
+def split_turns(script, max_chars=None):
+    """Split a complete podcast script into (speaker, text) turns"""
+    splitter = TurnSplitter(max_chars or PODCAST['max_turn_chars'])
+    return splitter.feed(script) + splitter.flush()
+
+
+def turn_gaps(turns, gap_ms=None):
+    """Seconds of silence after each turn but the last: a pause where the speaker changes"""
+    gap = (PODCAST['turn_gap_ms'] if gap_ms is None else gap_ms) / 1000
+    return [gap if turn[0] != following[0] else 0.0 for turn, following in zip(turns, turns[1:])]
+
+
+def extract_text_from_pdf_hybrid(pdf_bytes):
+    try:
+        import PyPDF2
+
+        # First try to extract text directly using PyPDF2
+        pdf_reader = PyPDF2.PdfReader(io.BytesIO(pdf_bytes))
+        num_pages = len(pdf_reader.pages)
+        logger.info(f'PDF has {num_pages} pages')
+        
+        text = ""
+        with span('pdf_text_layer', pages=num_pages) as stage:
+            stage.bytes_in = len(pdf_bytes)
+            for page_num, page in enumerate(pdf_reader.pages, 1):
+                logger.info(f'Processing page {page_num}/{num_pages}')
+                page_text = page.extract_text()
+                if page_text.strip():
+                    text += page_text + "\n"
+            stage.bytes_out = len(text.encode('utf-8'))
+        
+        # If we got meaningful text, return it
+        if len(text.strip()) > 500:  # Arbitrary threshold
+            logger.info(f'Successfully extracted {len(text)} characters directly from PDF. Using text extraction.')
+            return text
+        else:
+            logger.info(f'Only extracted {len(text.strip())} characters, which is below threshold of 500. Falling back to vision.')
+
+        # If direct extraction didn't get enough text, fall back to vision approach
+        logger.info('Direct text extraction insufficient, falling back to vision approach')
+        return extract_text_from_pdf_vision(pdf_bytes)
+
+    except Exception as e:
+        logger.error(f'Error in hybrid PDF processing: {str(e)}', exc_info=True)
+        raise Exception(f"Could not process PDF: {str(e)}")
+
+async def process_page_vision(client, image, page_num, total_pages, sem):
+    try:
+        logger.info(f'Processing page {page_num}/{total_pages}')
+        
+        # Convert image to PNG and base64
+        img_byte_arr = io.BytesIO()
+        image.save(img_byte_arr, format='PNG')
+        img_byte_arr = img_byte_arr.getvalue()
+        img_base64 = base64.b64encode(img_byte_arr).decode('utf-8')
+        logger.info(f'Page {page_num} converted to PNG and base64 encoded')
+    
+        # Send to text / vision model
+        logger.info(f'Sending page {page_num} to {AZURE_MODELS["text"]}')
+        
+        async with sem:
+            with span('ocr_page', page=page_num) as stage:
+                stage.bytes_in = len(img_byte_arr)
+                completion = await asyncio.to_thread(
+                    client.create_chat_completion,
+                    role='text',
+                    messages=ocr_messages(f"data:image/png;base64,{img_base64}")
+                )
+                stage.record_usage(completion)
+                stage.bytes_out = len((completion.choices[0].message.content or '').encode('utf-8'))
+        
+        page_text = completion.choices[0].message.content
+        logger.info(f'Successfully received text for page {page_num}')
+        return page_num, page_text
+    except Exception as e:
+        logger.error(f'Error processing page {page_num}: {str(e)}', exc_info=True)
+        raise
+
+def extract_text_from_pdf_vision(pdf_bytes):
+    try:
+        from pdf2image import convert_from_bytes
+
+        # Convert PDF pages to images
+        logger.info('Converting PDF to images')
+        images = convert_from_bytes(pdf_bytes)
+        
+        if not images:
+            raise Exception("Could not convert PDF to images")
+            
+        logger.info(f'Successfully converted PDF to {len(images)} images')
+        
+        # Create an event loop for async operations
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        
+        # Process all pages concurrently with a semaphore limit of 10; the
+        # client's rate limiter paces the calls against the deployment quota
+        total_pages = len(images)
+
+        async def process_all_pages():
+            sem = asyncio.Semaphore(10)
+            tasks = [
+                process_page_vision(get_client(), image, idx, total_pages, sem)
+                for idx, image in enumerate(images, start=1)
+            ]
+            return await asyncio.gather(*tasks, return_exceptions=True)
+
+        # Run all tasks concurrently
+        logger.info(f'Processing all pages concurrently (max 10 at a time)')
+        try:
+            all_results = loop.run_until_complete(process_all_pages())
+        finally:
+            # Close the event loop
+            loop.close()
+        
+        # Pages that still fail after retries make the extraction fail rather
+        # than silently producing a summary of an incomplete document
+        processed_results = []
+        failed_pages = []
+        for page_num, result in enumerate(all_results, start=1):
+            if isinstance(result, Exception):
+                logger.error(f'Page {page_num} processing error: {str(result)}')
+                failed_pages.append(page_num)
+                continue
+            processed_results.append(result)
+        if failed_pages:
+            raise Exception(f"Failed to process page(s) {', '.join(map(str, failed_pages))} of {total_pages}")
+        
+        # Sort results by page number and extract text
+        processed_results.sort(key=lambda x: x[0])  # Sort by page number
+        all_text = [text for _, text in processed_results]
+        
+        # Combine text from all pages
+        final_text = "\n\n=== Page Break ===\n\n".join(all_text)
+        logger.info(f'Successfully processed all {len(processed_results)} pages')
+        logger.info(f'Final text length: {len(final_text)} characters')
+        
+        return final_text
+
+    except Exception as e:
+        logger.error(f'Error in vision PDF processing: {str(e)}', exc_info=True)
+        raise Exception(f"Could not process PDF: {str(e)}")
+
+def summarize_text(text, target_minutes, tone, language, goal, goal_instruction=None, voice1_style=None, voice2_style=None,
+                   stream=False):
+    """Summarize text into a narration script; with stream=True, return an iterator over its text as it is generated"""
+    try:
+        # Add logging at the start of summarize_text
+        logger.info(f"summarize_text called with:")
+        logger.info(f"  target_minutes: {target_minutes}")
+        logger.info(f"  tone: {tone}")
+        logger.info(f"  language: {language}")
+        logger.info(f"  goal: {goal}")
+        if goal == "custom":
+            logger.info(f"  goal_instruction: {payload(goal_instruction)}")
+        if goal == "podcast":
+            logger.info(f"  voice1_style: {voice1_style}")
+            logger.info(f"  voice2_style: {voice2_style}")
+        
+        target_language = language_name(language)
+        logger.info(f"  Mapped language '{language}' to '{target_language}'")
+        
+        logger.info(f'Starting text summarization for {target_minutes} minute(s) in {tone} tone, language: {target_language}')
+        logger.info(f'Input text length: {len(text)} characters')
+        
+        # Assuming average speaking rate of 150 words per minute
+        target_words = target_minutes * 110
+        
+        messages = summary_messages(text, target_minutes, target_words, tone, language, goal, goal_instruction,
+                                    voice1_style, voice2_style)
+
+        if stream:
+            return _stream_summary(messages, text, target_language, target_words)
+
+        with call_slot(), span('summarize', language=target_language, target_words=target_words) as stage:
+            stage.bytes_in = len(text.encode('utf-8'))
+            completion = get_client().create_chat_completion(role='text', messages=messages)
+            stage.record_usage(completion)
+            stage.bytes_out = len((completion.choices[0].message.content or '').encode('utf-8'))
+        
+        summary = completion.choices[0].message.content
+        logger.info(f'Successfully generated {tone} summary in {target_language} (length: {len(summary)} characters)')
+        return summary
+        
+    except Exception as e:
+        logger.error(f'Error summarizing text: {str(e)}', exc_info=True)
+        return None
+
+def _stream_summary(messages, text, target_language, target_words):
+    """Yield the summary text as the model generates it"""
+    with call_slot(), span('summarize', language=target_language, target_words=target_words, stream=True) as stage:
+        stage.bytes_in = len(text.encode('utf-8'))
+        completion = get_client().create_chat_completion(
+            role='text',
+            messages=messages,
+            stream=True,
+            stream_options={'include_usage': True}
+        )
+        try:
+            for event in completion:
+                stage.record_usage(event)
+                if event.choices and event.choices[0].delta.content:
+                    delta = event.choices[0].delta.content
+                    stage.bytes_out += len(delta.encode('utf-8'))
+                    yield delta
+        finally:
+            completion.close()
+
+def extract_text(filename, file_bytes, processing_method='vision'):
+    """Extract text from an uploaded document, reusing earlier extractions of the same bytes"""
+    cache_key = (hashlib.sha256(file_bytes).hexdigest(), processing_method)
+    with _extraction_cache_lock:
+        if cache_key in _extraction_cache:
+            _extraction_cache.move_to_end(cache_key)
+            logger.info(f'Using cached extraction for {filename}')
+            return _extraction_cache[cache_key]
+
+    # Extract text based on file type and processing method
+    with span('extract', file_type=filename.rsplit('.', 1)[-1].lower(), method=processing_method) as stage:
+        stage.bytes_in = len(file_bytes)
+        if filename.endswith('.pdf'):
+            logger.info('Processing PDF file')
+            if processing_method == 'vision':
+                text = extract_text_from_pdf_vision(file_bytes)
+            else:
+                text = extract_text_from_pdf_hybrid(file_bytes)
+        else:  # For txt files
+            logger.info('Processing TXT file')
+            text = file_bytes.decode('utf-8')
+        stage.bytes_out = len(text.encode('utf-8')) if text else 0
+
+    if text:
+        with _extraction_cache_lock:
+            _extraction_cache[cache_key] = text
+            while len(_extraction_cache) > EXTRACTION_CACHE_SIZE:
+                _extraction_cache.popitem(last=False)
+    return text
+
+def format_summary_card(summary, goal, goal_instruction=None):
+    """Turn the summary into an HTML summary card using the create_summary_card tool"""
+    logger.info('Creating formatted summary card')
+    with call_slot(), span('card_format', goal=goal) as stage:
+        stage.bytes_in = len(summary.encode('utf-8'))
+        format_completion = get_client().create_chat_completion(
+            role='text',
+            messages=card_messages(summary, goal, goal_instruction),
+            tools=[get_summary_card_tool(goal, goal_instruction)],
+            tool_choice="required"
+        )
+        stage.record_usage(format_completion)
+
+    # Process the tool calls to create formatted summary
+    formatted_summary = summary
+    if hasattr(format_completion.choices[0].message, 'tool_calls') and format_completion.choices[0].message.tool_calls:
+        tool_call = format_completion.choices[0].message.tool_calls[0]
+        if tool_call.function.name == "create_summary_card":
+            formatted_summary = process_summary_card(tool_call, goal, goal_instruction)
+    return formatted_summary
+
+def synthesize_chunk(chunk, index, language, voice, tone):
+    """Generate the audio for one summary chunk: WAV bytes, or a PcmBuffer when STREAM_AUDIO is on"""
+    logger.info(f'Processing chunk {index}')
+    messages = narration_messages(chunk, language, voice, tone)
+    with call_slot(), span('tts_chunk', chunk=index, streamed=PIPELINE['stream_audio']) as stage:
+        audio_data = _synthesize(messages, voice, chunk, stage)
+    logger.info(f'Successfully generated audio for chunk {index}')
+    return audio_data
+
+def podcast_voices(voice, voice2=None, voice1_style=None, voice2_style=None):
+    """The (voice, style) of Speaker 1 and Speaker 2"""
+    return (
+        (voice, voice1_style or 'contemplating_british'),
+        (voice2 or PODCAST['second_voice'], voice2_style or 'authoritative_professor')
+    )
+
+def synthesize_turn(turn, index, language, speakers):
+    """Generate the audio for one podcast turn in its speaker's voice and style"""
+    speaker, text = turn
+    # Scripts occasionally number a third speaker; alternate between the two voices
+    voice, style = speakers[(speaker - 1) % len(speakers)]
+    logger.info(f'Processing turn {index} (speaker {speaker}, {voice})')
+    with call_slot(), span('tts_turn', turn=index, speaker=speaker, streamed=PIPELINE['stream_audio']) as stage:
+        audio_data = _synthesize(turn_messages(text, language, style), voice, text, stage)
+    logger.info(f'Successfully generated audio for turn {index}')
+    return audio_data
+
+def _synthesize(messages, voice, text, stage):
+    """Run one audio completion: WAV bytes, or a PcmBuffer when STREAM_AUDIO is on"""
+    stage.bytes_in = len(text.encode('utf-8'))
+    if PIPELINE['stream_audio']:
+        return _stream_chunk_audio(messages, voice, text, stage)
+
+    completion = get_client().create_chat_completion(
+        role='audio',
+        messages=messages,
+        modalities=["text", "audio"],
+        audio={"voice": voice, "format": "wav"},
+        temperature=1.2,
+        top_p=1,
+        frequency_penalty=0,
+        presence_penalty=0
+    )
+
+    stage.record_usage(completion)
+    audio_data = base64.b64decode(completion.choices[0].message.audio.data)
+    stage.bytes_out = len(audio_data)
+    return audio_data
+
+def _stream_chunk_audio(messages, voice, chunk, stage):
+    """Collect streamed pcm16 audio deltas into a buffer sized for the chunk's expected speech"""
+    start = time.perf_counter()
+    buffer = PcmBuffer(int(len(chunk) / SPOKEN_CHARS_PER_SECOND * PCM16_SAMPLE_RATE * 2 * 1.25))
+    completion = get_client().create_chat_completion(
+        role='audio',
+        messages=messages,
+        modalities=["text", "audio"],
+        audio={"voice": voice, "format": "pcm16"},
+        temperature=1.2,
+        top_p=1,
+        frequency_penalty=0,
+        presence_penalty=0,
+        stream=True,
+        stream_options={'include_usage': True}
+    )
+    try:
+        for event in completion:
+            stage.record_usage(event)
+            if not event.choices:
+                continue
+            # The SDK has no typed field for audio deltas; they arrive as extra data
+            audio = getattr(event.choices[0].delta, 'audio', None)
+            encoded = audio.get('data') if isinstance(audio, dict) else getattr(audio, 'data', None)
+            if encoded:
+                if buffer.length == 0:
+                    TTS_FIRST_AUDIO.observe(time.perf_counter() - start)
+                buffer.append_base64(encoded)
+    finally:
+        completion.close()
+    if buffer.length == 0:
+        raise Exception('The audio deployment returned no audio')
+    stage.bytes_out = buffer.length
+    return buffer
+
+def synthesize_audio(summary, language, voice, tone):
+    """Generate one WAV file per chunk of a complete summary"""
+    summary_chunks = split_summary(summary)
+    logger.info(f'Split summary into {len(summary_chunks)} chunks')
+    return [
+        synthesize_chunk(chunk, i + 1, language, voice, tone)
+        for i, chunk in enumerate(summary_chunks)
+    ]
+
+def synthesize_podcast(script, language, speakers):
+    """Generate the audio of a complete podcast script, several turns at a time.
+
+    Returns the turns and their audio, in order.
+    """
+    turns = split_turns(script)
+    logger.info(f'Split podcast script into {len(turns)} turns')
+    with ThreadPoolExecutor(max_workers=max(1, PODCAST['turn_concurrency']), thread_name_prefix='tts') as executor:
+        futures = [
+            executor.submit(contextvars.copy_context().run, synthesize_turn, turn, i + 1, language, speakers)
+            for i, turn in enumerate(turns)
+        ]
+        try:
+            return turns, [future.result() for future in futures]
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+def merge_audio(audio_chunks, gaps=None):
+    """Concatenate the chunks' audio into one WAV file, returned as a bytes-like object.
+
+    gaps, if given, holds the seconds of silence to put after each chunk but
+    the last.
+    """
+    logger.info('Combining audio chunks')
+    with span('merge', chunks=len(audio_chunks)) as stage:
+        if all(isinstance(audio_data, PcmBuffer) for audio_data in audio_chunks):
+            # Streamed chunks are raw frames; the WAV header is only added here
+            stage.bytes_in = sum(audio_data.length for audio_data in audio_chunks)
+            combined_audio_bytes = pcm_to_wav(audio_chunks, gaps)
+        else:
+            from pydub import AudioSegment
+
+            stage.bytes_in = sum(len(audio_data) for audio_data in audio_chunks)
+            combined_audio = AudioSegment.empty()
+            for index, audio_data in enumerate(audio_chunks):
+                audio_segment = AudioSegment.from_wav(io.BytesIO(audio_data))
+                combined_audio += audio_segment
+                if gaps and index < len(gaps) and gaps[index] > 0:
+                    combined_audio += AudioSegment.silent(duration=gaps[index] * 1000, frame_rate=audio_segment.frame_rate)
+
+            output = io.BytesIO()
+            combined_audio.export(output, format='wav')
+            combined_audio_bytes = output.getbuffer()
+        stage.bytes_out = len(combined_audio_bytes)
+    logger.info('Successfully combined all audio chunks')
+    return combined_audio_bytes
+
+def stream_narration(text, summary_length, tone, language, goal, goal_instruction=None,
+                     voice='alloy', voice1_style=None, voice2_style=None, voice2=None):
+    """Stream the summary and synthesize each chunk as soon as it is complete.
+
+    Podcast scripts are split into speaker turns instead of chunks. Returns
+    the summary, the futures of the chunks' audio and the chunks (or turns)
+    themselves, in order. Synthesis of the first chunks runs while the model
+    is still writing later ones.
+    """
+    # Taken before the summarize span opens: the chunks are synthesized while
+    # it is still current here, and their logs and retries belong to their own spans
+    context = contextvars.copy_context()
+    deltas = summarize_text(text, summary_length, tone, language, goal, goal_instruction,
+                            voice1_style, voice2_style, stream=True)
+    if deltas is None:
+        raise PipelineError('Could not summarize text', 500)
+
+    speakers = podcast_voices(voice, voice2, voice1_style, voice2_style)
+
+    def synthesize(chunk, index):
+        if goal == 'podcast':
+            return synthesize_turn(chunk, index, language, speakers)
+        return synthesize_chunk(chunk, index, language, voice, tone)
+
+    if goal == 'podcast':
+        splitter = TurnSplitter(PODCAST['max_turn_chars'])
+        concurrency = PODCAST['turn_concurrency']
+    else:
+        splitter = ChunkSplitter(PIPELINE['max_chunk_chars'])
+        concurrency = PIPELINE['tts_concurrency']
+    executor = ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix='tts')
+    parts = []
+    chunks = []
+    futures = []
+
+    def submit(completed):
+        for chunk in completed:
+            index = len(futures) + 1
+            logger.info(f'Summary part {index} complete, starting synthesis')
+            chunks.append(chunk)
+            # Each worker gets its own copy of the request's trace and priority
+            futures.append(executor.submit(context.copy().run, synthesize, chunk, index))
+
+    try:
+        for delta in deltas:
+            parts.append(delta)
+            submit(splitter.feed(delta))
+        submit(splitter.flush())
+    except Exception as e:
+        executor.shutdown(wait=False, cancel_futures=True)
+        logger.error(f'Error streaming summary: {str(e)}', exc_info=True)
+        raise PipelineError('Could not summarize text', 500)
+    finally:
+        deltas.close()
+    # Workers exit once the submitted chunks are done
+    executor.shutdown(wait=False)
+
+    summary = ''.join(parts)
+    if not futures:
+        logger.error('Summarization returned no text')
+        raise PipelineError('Could not summarize text', 500)
+    logger.info(f'Successfully generated summary (length: {len(summary)} characters) in {len(futures)} parts')
+    return summary, futures, chunks
+
+def generate_narration(text, summary_length, tone, language, goal, goal_instruction=None,
+                       voice='alloy', voice1_style=None, voice2_style=None, voice2=None):
+    """Run summarization, summary card formatting and audio synthesis for extracted text.
+
+    For podcasts, voice and voice2 are the voices of Speaker 1 and Speaker 2.
+    """
+    # Summarize the text with target length
+    logger.info(f'Starting text summarization for {summary_length} minute(s)')
+    logger.info(f'Using voice: {voice}')
+
+    if PIPELINE['stream_summary']:
+        summary, audio_futures, chunks = stream_narration(
+            text, summary_length, tone, language, goal, goal_instruction, voice, voice1_style, voice2_style, voice2
+        )
+        try:
+            # The summary card is formatted while the last chunks are synthesized
+            formatted_summary = format_summary_card(summary, goal, goal_instruction)
+            audio_chunks = [future.result() for future in audio_futures]
+        except BaseException:
+            for future in audio_futures:
+                future.cancel()
+            raise
+    else:
+        summary = summarize_text(text, summary_length, tone, language, goal, goal_instruction, voice1_style, voice2_style)
+        if not summary:
+            logger.error('Summarization failed')
+            raise PipelineError('Could not summarize text', 500)
+
+        logger.info(f'Successfully generated {summary_length}-minute summary (length: {len(summary)} characters)')
+        formatted_summary = format_summary_card(summary, goal, goal_instruction)
+        if goal == 'podcast':
+            chunks, audio_chunks = synthesize_podcast(
+                summary, language, podcast_voices(voice, voice2, voice1_style, voice2_style))
+        else:
+            audio_chunks = synthesize_audio(summary, language, voice, tone)
+
+    # Podcast turns are stitched with a pause where the speaker changes
+    gaps = turn_gaps(chunks) if goal == 'podcast' else None
+    combined_audio = merge_audio(audio_chunks, gaps)
+
+    return {
+        'summary': summary,
+        'formatted_summary': formatted_summary,
+        'audio': combined_audio
+    }
+
+def generate_variants(text, variants, concurrency=None):
+    """Narrate one extracted text in several variants at once.
+
+    variants is a list of dicts of generate_narration's keyword arguments.
+    The model calls of all variants share concurrency slots. Returns one
+    result per variant, in order; a variant that failed has its exception
+    instead.
+    """
+    budget = threading.BoundedSemaphore(max(1, concurrency or VARIANTS['concurrency']))
+
+    def run(variant):
+        _call_budget.set(budget)
+        return generate_narration(text, **variant)
+
+    results = []
+    with ThreadPoolExecutor(max_workers=len(variants), thread_name_prefix='variant') as executor:
+        futures = [executor.submit(contextvars.copy_context().run, run, variant) for variant in variants]
+        for index, future in enumerate(futures, start=1):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                logger.error(f'Variant {index} failed: {str(e)}')
+                results.append(e)
+    return results
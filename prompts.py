@@ -0,0 +1,187 @@
+"""Prompt templates for the summary, summary card, narration and OCR calls.
+
+Azure OpenAI caches prompt prefixes of 1024 tokens or more and reuses them
+for later calls that start with the same tokens. The templates are therefore
+built once, at import, and every prompt starts with its static instructions,
+byte-identical across requests. Request-specific settings (language, length,
+tone, voice) always come after them. For summaries the document comes before
+the settings, so summarizing the same document again, for example in another
+language, also reuses the cached document.
+"""
+
+# Proper language names for the language codes of the form
+LANGUAGE_NAMES = {
+    'english': 'English',
+    'spanish': 'Spanish',
+    'french': 'French',
+    'german': 'German',
+    'italian': 'Italian',
+    'portuguese': 'Portuguese',
+    'dutch': 'Dutch',
+    'polish': 'Polish',
+    'japanese': 'Japanese',
+    'chinese': 'Chinese',
+    'korean': 'Korean',
+    'swedish': 'Swedish'
+}
+
+TONE_INSTRUCTIONS = {
+    'professional': "Use clear, precise language with business-appropriate terminology.",
+    'conversational': "Use natural, friendly language as if speaking to a friend.",
+    'enthusiastic': "Use energetic and engaging language with dynamic expressions.",
+    'formal': "Use sophisticated vocabulary and academic language.",
+    'casual': "Use relaxed, everyday language and a laid-back style.",
+    'empathetic': "Use warm, understanding language that shows emotional awareness."
+}
+
+GOAL_INSTRUCTIONS = {
+    'general_summary': "Create a comprehensive overview of the main points and key takeaways from the document.",
+    'key_insights': "Focus on extracting and highlighting the most important insights, findings, and key points from the document.",
+    'action_items': "Identify and list the main action items, tasks, and next steps mentioned in the document.",
+    'topic_analysis': "Analyze the document with a focus on the specific topic or aspect requested.",
+    'recommendations': "Extract and elaborate on the recommendations, suggestions, and proposed solutions from the document."
+}
+
+PODCAST_GOAL_TEMPLATE = """Create an engaging conversation about the document between two people:
+Speaker 1 ({voice1_style}): Ask insightful questions about the content.
+Speaker 2 ({voice2_style}): Provide detailed, informative answers.
+Make it feel like a natural podcast discussion while covering the key points from the document. When creating the summary put emphasis on the speak tone like  voice)
+Start every turn on a new line with "Speaker 1:" or "Speaker 2:". Everything after the label is read aloud by that speaker, so do not add stage directions or the speakers' names."""
+
+# Voice style mappings
+VOICE_STYLE_PROMPTS = {
+    'contemplating_british': """You are an expert voice actor specializing in silly voices. Respond and vocalize to the user the EXACT same input text, but in your voice response you MUST express EACH of the vocal cadence, inflection, and tone of David Attenborough.""",
+
+    'curious_american': """You are an expert voice actor specializing in silly voices. Respond and vocalize to the user the EXACT same input text, but in your voice response you MUST express EACH of the vocal cadence, inflection, and tone of Bill Nye the Science Guy.""",
+
+    'energetic_host': """You are an expert voice actor specializing in silly voices. Respond and vocalize to the user the EXACT same input text, but in your voice response you MUST express EACH of the vocal cadence, inflection, and tone of Jimmy Fallon.""",
+
+    'thoughtful_journalist': """You are an expert voice actor specializing in silly voices. Respond and vocalize to the user the EXACT same input text, but in your voice response you MUST express EACH of the vocal cadence, inflection, and tone of Morgan Freeman.""",
+
+    'friendly_interviewer': """You are an expert voice actor specializing in silly voices. Respond and vocalize to the user the EXACT same input text, but in your voice response you MUST express EACH of the vocal cadence, inflection, and tone of Oprah Winfrey.""",
+
+    'authoritative_professor': """You are an expert voice actor specializing in silly voices. Respond and vocalize to the user the EXACT same input text, but in your voice response you MUST express EACH of the vocal cadence, inflection, and tone of Neil deGrasse Tyson.""",
+
+    'passionate_expert': """You are an expert voice actor specializing in silly voices. Respond and vocalize to the user the EXACT same input text, but in your voice response you MUST express EACH of the vocal cadence, inflection, and tone of Tony Robbins.""",
+
+    'analytical_researcher': """You are an expert voice actor specializing in silly voices. Respond and vocalize to the user the EXACT same input text, but in your voice response you MUST express EACH of the vocal cadence, inflection, and tone of Carl Sagan.""",
+
+    'experienced_practitioner': """You are an expert voice actor specializing in silly voices. Respond and vocalize to the user the EXACT same input text, but in your voice response you MUST express EACH of the vocal cadence, inflection, and tone of Gordon Ramsay.""",
+
+    'industry_veteran': """You are an expert voice actor specializing in silly voices. Respond and vocalize to the user the EXACT same input text, but in your voice response you MUST express EACH of the vocal cadence, inflection, and tone of Steve Jobs.""",
+
+    'pirate_interviewer': """You are an expert voice actor specializing in silly voices. Respond and vocalize to the user the EXACT same input text, but in your voice response you MUST express EACH of the vocal cadence, inflection, and tone of Johnny Depp as Jack Sparrow.""",
+
+    'vampire_expert': """You are an expert voice actor specializing in silly voices. Respond and vocalize to the user the EXACT same input text, but in your voice response you MUST express EACH of the vocal cadence, inflection, and tone of Christopher Lee as Count Dracula."""
+}
+
+SUMMARY_INSTRUCTIONS = """You are a specialized document analyzer. The user sends a document, followed by the goal, language, length and tone of the summary to write about it.
+
+Format your response as a clear, engaging summary that takes the requested time to read aloud, in the requested language only.
+Focus on delivering content that precisely matches the specified goal while maintaining a natural speaking flow. The summary should be like a script for audiobook narrator.
+For every 100 words, make a page break, write out === Page Break === """
+
+SUMMARY_TASK_TEMPLATE = """Your task: {goal_instruction}
+
+The summary must be written entirely in {language}. Do not use any other language.
+It should take approximately {target_minutes} minute(s) to read aloud (about {target_words} words). {tone_instruction}"""
+
+CARD_INSTRUCTIONS = "You are a content formatter. Create a beautifully formatted summary card using the create_summary_card tool."
+
+CARD_GOAL_TEMPLATE = "Format the content according to the goal: {goal}"
+
+NARRATION_INSTRUCTIONS = """You are a professional audiobook reader. Your task is to read the provided text in the language given below, ensuring it remains engaging throughout.
+
+# Output Format
+Produce an engaging narration in that language, maintaining the specified tone, and read the text WORD for WORD."""
+
+NARRATION_SETTINGS_TEMPLATE = """- **Language**: {language}
+- **Voice**: {voice}
+- **Tone**: {tone}"""
+
+TURN_INSTRUCTIONS = "You are one of the two speakers of a podcast. Read your line WORD for WORD, and do not read speaker labels out loud."
+
+TURN_SETTINGS_TEMPLATE = """{style}
+
+Read your line in {language}."""
+
+OCR_INSTRUCTIONS = "Please read this document and extract all the text you see in a clear format. Also describe graphs, images, and tables in a clear format."
+
+
+def language_name(language):
+    """Proper name of a language code, defaulting to English"""
+    return LANGUAGE_NAMES.get(language.lower(), 'English')
+
+
+def goal_text(goal, goal_instruction=None, voice1_style=None, voice2_style=None):
+    """What the summary should do for a goal; custom goals use the user's own instruction"""
+    if goal == 'podcast':
+        return PODCAST_GOAL_TEMPLATE.format(
+            voice1_style=VOICE_STYLE_PROMPTS[voice1_style] if voice1_style else 'contemplating_british',
+            voice2_style=VOICE_STYLE_PROMPTS[voice2_style] if voice2_style else 'authoritative_professor'
+        )
+    if goal in GOAL_INSTRUCTIONS:
+        return GOAL_INSTRUCTIONS[goal]
+    if goal == 'custom':
+        return goal_instruction
+    return "Analyze the document according to this specific goal: " + goal
+
+
+def summary_messages(text, target_minutes, target_words, tone, language, goal, goal_instruction=None,
+                     voice1_style=None, voice2_style=None):
+    """Static instructions, then the document, then this request's goal, language, length and tone"""
+    tone_instruction = TONE_INSTRUCTIONS.get(tone, TONE_INSTRUCTIONS['conversational']) if goal != 'podcast' else ""
+    task = SUMMARY_TASK_TEMPLATE.format(
+        goal_instruction=goal_text(goal, goal_instruction, voice1_style, voice2_style),
+        language=language_name(language),
+        target_minutes=target_minutes,
+        target_words=target_words,
+        tone_instruction=tone_instruction
+    )
+    return [
+        {"role": "system", "content": SUMMARY_INSTRUCTIONS},
+        {"role": "user", "content": text},
+        {"role": "user", "content": task.rstrip()}
+    ]
+
+
+def card_messages(summary, goal, goal_instruction=None):
+    """The summary card formatting prompt; the goal follows the static instructions"""
+    return [
+        {"role": "system", "content": CARD_INSTRUCTIONS},
+        {"role": "system", "content": CARD_GOAL_TEMPLATE.format(goal=goal if goal != 'custom' else goal_instruction)},
+        {"role": "user", "content": summary}
+    ]
+
+
+def narration_messages(chunk, language, voice, tone):
+    """The audiobook reader prompt for one summary chunk; podcasts use turn_messages"""
+    settings = NARRATION_SETTINGS_TEMPLATE.format(language=language, voice=voice, tone=tone)
+    return [
+        {"role": "system", "content": [{"type": "text", "text": NARRATION_INSTRUCTIONS}]},
+        {"role": "system", "content": [{"type": "text", "text": settings}]},
+        {"role": "user", "content": chunk}
+    ]
+
+
+def turn_messages(text, language, style):
+    """The prompt for one podcast speaker's turn"""
+    return [
+        {"role": "system", "content": [{"type": "text", "text": TURN_INSTRUCTIONS}]},
+        {"role": "system", "content": [{"type": "text", "text": TURN_SETTINGS_TEMPLATE.format(
+            style=VOICE_STYLE_PROMPTS[style], language=language)}]},
+        {"role": "user", "content": text}
+    ]
+
+
+def ocr_messages(image_url):
+    """The text extraction prompt for one page image"""
+    return [
+        {
+            "role": "user",
+            "content": [
+                {"type": "text", "text": OCR_INSTRUCTIONS},
+                {"type": "image_url", "image_url": {"url": image_url}}
+            ]
+        }
+    ]
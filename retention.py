@@ -0,0 +1,351 @@
+"""Retention of history entries, and the monthly partitions of history_entries.
+
+Entries older than HISTORY_MAX_AGE_DAYS, and the oldest entries beyond
+HISTORY_MAX_TOTAL_BYTES of audio, are deleted by a background thread in every
+server worker (one at a time on PostgreSQL, through an advisory lock). Rows
+go in keyset-ordered batches of RETENTION_BATCH_SIZE, one short DELETE each,
+so the table is never locked for long.
+
+On PostgreSQL, history_entries is range-partitioned by month on timestamp.
+Months that have expired entirely are detached and dropped instead of being
+deleted row by row, and the partitions for the coming months are created
+ahead of time. Databases created before partitioning can be converted once,
+with the app stopped.
+
+Usage:
+    python retention.py run         # one retention pass with the configured limits
+    python retention.py partition   # convert an existing history_entries table
+"""
+import argparse
+import logging
+import random
+import re
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta, timezone
+
+from dotenv import load_dotenv
+
+load_dotenv('keys.env')
+
+from sqlalchemy import func, inspect, text, tuple_
+
+from config import RETENTION
+from database import engine, init_db
+from history import HistoryManager
+from logging_setup import configure_logging
+from metrics import REGISTRY, Counter
+from models import HistoryEntry
+
+logger = logging.getLogger(__name__)
+
+TABLE = HistoryEntry.__tablename__
+PARTITION_NAME = re.compile(rf'^{TABLE}_p(\d{{4}})_(\d{{2}})$')
+# Session-level advisory lock held by the worker running a retention pass
+LOCK_KEY = zlib.crc32(b'history_retention')
+
+HISTORY_EXPIRED = REGISTRY.register(Counter(
+    'history_entries_expired_total', 'History entries removed by the retention policy'))
+
+
+def month_start(moment):
+    return datetime(moment.year, moment.month, 1, tzinfo=timezone.utc)
+
+
+def add_months(month, count):
+    index = month.year * 12 + month.month - 1 + count
+    return datetime(index // 12, index % 12 + 1, 1, tzinfo=timezone.utc)
+
+
+def partition_name(month):
+    return f'{TABLE}_p{month:%Y_%m}'
+
+
+def is_partitioned(connection):
+    return connection.execute(text(
+        'SELECT 1 FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid '
+        'WHERE c.relname = :table AND pg_table_is_visible(c.oid)'
+    ), {'table': TABLE}).first() is not None
+
+
+def create_partitioned_table(connection):
+    """Create history_entries partitioned by month, with a default partition for stray timestamps"""
+    compiler = connection.dialect.ddl_compiler(connection.dialect, None)
+    columns = [compiler.get_column_specification(column) for column in HistoryEntry.__table__.columns]
+    # The partition key has to be part of the primary key; IDs stay unique
+    # because they are generated from the save time
+    connection.execute(text(
+        f'CREATE TABLE {TABLE} ({", ".join(columns)}, PRIMARY KEY (id, "timestamp")) '
+        f'PARTITION BY RANGE ("timestamp")'
+    ))
+    connection.execute(text(f'CREATE TABLE {TABLE}_default PARTITION OF {TABLE} DEFAULT'))
+
+
+def list_partitions(connection):
+    """Monthly partitions of history_entries as (first day of the month, table name), oldest first"""
+    names = connection.execute(text(
+        'SELECT child.relname FROM pg_inherits '
+        'JOIN pg_class parent ON parent.oid = pg_inherits.inhparent '
+        'JOIN pg_class child ON child.oid = pg_inherits.inhrelid '
+        'WHERE parent.relname = :table'
+    ), {'table': TABLE}).scalars()
+    partitions = []
+    for name in names:
+        match = PARTITION_NAME.match(name)
+        if match:
+            partitions.append((datetime(int(match[1]), int(match[2]), 1, tzinfo=timezone.utc), name))
+    return sorted(partitions)
+
+
+def ensure_partitions(connection, start, months_ahead):
+    """Create the monthly partitions from start's month until months_ahead months from now"""
+    existing = {month for month, _ in list_partitions(connection)}
+    month = month_start(start)
+    last = add_months(month_start(datetime.now(timezone.utc)), months_ahead)
+    while month <= last:
+        if month not in existing:
+            try:
+                with connection.begin_nested():
+                    connection.execute(text(
+                        f'CREATE TABLE {partition_name(month)} PARTITION OF {TABLE} '
+                        f"FOR VALUES FROM ('{month.isoformat()}') TO ('{add_months(month, 1).isoformat()}')"
+                    ))
+                logger.info(f'Created partition {partition_name(month)}')
+            except Exception as e:
+                # Fails when rows for the month already landed in the default partition
+                logger.warning(f'Could not create partition {partition_name(month)}: {str(e)}')
+        month = add_months(month, 1)
+
+
+def prepare_history_table(connection):
+    """Create history_entries partitioned on PostgreSQL and keep partitions ahead of the clock"""
+    if not RETENTION['partition']:
+        return
+    if not inspect(connection).has_table(TABLE):
+        create_partitioned_table(connection)
+    if is_partitioned(connection):
+        ensure_partitions(connection, datetime.now(timezone.utc), RETENTION['partitions_ahead'])
+    else:
+        logger.info(f'{TABLE} is not partitioned; run "python retention.py partition" to convert it')
+
+
+def drop_partition(connection, name):
+    """Detach and drop one partition; returns its row count and the audio hashes it referenced"""
+    count = connection.execute(text(f'SELECT count(*) FROM {name}')).scalar()
+    audio_hashes = connection.execute(text(
+        f'SELECT DISTINCT audio_hash FROM {name} WHERE audio_hash IS NOT NULL'
+    )).scalars().all()
+    connection.execute(text(f'ALTER TABLE {TABLE} DETACH PARTITION {name}'))
+    connection.execute(text(f'DROP TABLE {name}'))
+    logger.info(f'Dropped partition {name} ({count} entries)')
+    return count, audio_hashes
+
+
+def _drop_partitions(manager, select):
+    """Drop the past months for which select(connection, month, name) is true, oldest first"""
+    deleted = 0
+    current = month_start(datetime.now(timezone.utc))
+    for month, name in _partitions():
+        # The current and future months keep receiving inserts
+        if month >= current:
+            break
+        with engine.begin() as connection:
+            if not select(connection, month, name):
+                break
+            count, audio_hashes = drop_partition(connection, name)
+        manager.release_blobs(audio_hashes)
+        deleted += count
+    return deleted
+
+
+def _partitions():
+    if engine.dialect.name != 'postgresql' or not RETENTION['partition']:
+        return []
+    with engine.connect() as connection:
+        return list_partitions(connection) if is_partitioned(connection) else []
+
+
+def _oldest_first(manager, columns, condition, batch_size):
+    """Yield batches of rows in (timestamp, id) order, resuming after the last row of each batch"""
+    last = None
+    while True:
+        query = manager.db.query(HistoryEntry.id, HistoryEntry.timestamp, *columns)
+        if condition is not None:
+            query = query.filter(condition)
+        if last is not None:
+            query = query.filter(tuple_(HistoryEntry.timestamp, HistoryEntry.id) > last)
+        rows = query.order_by(HistoryEntry.timestamp, HistoryEntry.id).limit(batch_size).all()
+        if not rows:
+            return
+        last = (rows[-1].timestamp, rows[-1].id)
+        yield rows
+
+
+def expire_by_age(manager, cutoff, batch_size, batch_pause=0.0):
+    """Delete entries saved before cutoff and return how many were removed"""
+    deleted = _drop_partitions(manager, lambda connection, month, name: add_months(month, 1) <= cutoff)
+    for rows in _oldest_first(manager, [], HistoryEntry.timestamp < cutoff, batch_size):
+        deleted += manager.delete_entries([row.id for row in rows])
+        time.sleep(batch_pause)
+    return deleted
+
+
+def expire_by_size(manager, max_total_bytes, batch_size, batch_pause=0.0):
+    """Delete the oldest entries until their audio totals at most max_total_bytes"""
+    total = manager.db.query(func.coalesce(func.sum(HistoryEntry.audio_size), 0)).scalar()
+    manager.db.commit()
+    excess = total - max_total_bytes
+    if excess <= 0:
+        return 0
+
+    def fits(connection, month, name):
+        nonlocal excess
+        size = connection.execute(text(f'SELECT coalesce(sum(audio_size), 0) FROM {name}')).scalar()
+        if size > excess:
+            return False
+        excess -= size
+        return True
+
+    deleted = _drop_partitions(manager, fits)
+    if excess <= 0:
+        return deleted
+    for rows in _oldest_first(manager, [HistoryEntry.audio_size], None, batch_size):
+        entry_ids = []
+        for row in rows:
+            if excess <= 0:
+                break
+            entry_ids.append(row.id)
+            excess -= row.audio_size or 0
+        deleted += manager.delete_entries(entry_ids)
+        if excess <= 0:
+            break
+        time.sleep(batch_pause)
+    return deleted
+
+
+def run_retention(settings=RETENTION, manager=None):
+    """Apply the retention limits once; returns the entries removed per limit, or None if another worker is running"""
+    lock = engine.connect() if engine.dialect.name == 'postgresql' else None
+    try:
+        if lock is not None:
+            if not lock.execute(text('SELECT pg_try_advisory_lock(:key)'), {'key': LOCK_KEY}).scalar():
+                return None
+            lock.commit()
+
+        manager = manager or HistoryManager()
+        try:
+            if engine.dialect.name == 'postgresql' and settings['partition']:
+                with engine.begin() as connection:
+                    if is_partitioned(connection):
+                        ensure_partitions(connection, datetime.now(timezone.utc), settings['partitions_ahead'])
+
+            expired = {'age': 0, 'size': 0}
+            if settings['max_age_days'] > 0:
+                cutoff = datetime.now(timezone.utc) - timedelta(days=settings['max_age_days'])
+                expired['age'] = expire_by_age(manager, cutoff, settings['batch_size'], settings['batch_pause'])
+            if settings['max_total_bytes'] > 0:
+                expired['size'] = expire_by_size(
+                    manager, settings['max_total_bytes'], settings['batch_size'], settings['batch_pause'])
+            # Source documents outlive their last variant by a day at most
+            manager.purge_sources(created_before=datetime.now(timezone.utc) - timedelta(days=1))
+        finally:
+            manager.db.remove()
+
+        for reason, count in expired.items():
+            if count:
+                HISTORY_EXPIRED.inc(count, reason=reason)
+                logger.info(f'Retention removed {count} entries by {reason}')
+        return expired
+    finally:
+        if lock is not None:
+            lock.execute(text('SELECT pg_advisory_unlock(:key)'), {'key': LOCK_KEY})
+            lock.commit()
+            lock.close()
+
+
+class RetentionWorker(threading.Thread):
+    """Background thread that runs a retention pass every interval_seconds"""
+
+    def __init__(self, settings=RETENTION):
+        super().__init__(name='history-retention', daemon=True)
+        self.settings = settings
+        self._stopped = threading.Event()
+
+    def run(self):
+        # Spread the first pass of workers that started together
+        if self._stopped.wait(random.uniform(0, min(60.0, self.settings['interval_seconds']))):
+            return
+        while True:
+            try:
+                run_retention(self.settings)
+            except Exception as e:
+                logger.error(f'Retention pass failed: {str(e)}', exc_info=True)
+            if self._stopped.wait(self.settings['interval_seconds']):
+                return
+
+    def stop(self):
+        self._stopped.set()
+
+
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def start_retention_worker():
+    """Start this process's retention thread if there is anything for it to do"""
+    global _worker
+    partitioned = RETENTION['partition'] and engine.dialect.name == 'postgresql'
+    if not (RETENTION['max_age_days'] > 0 or RETENTION['max_total_bytes'] > 0 or partitioned):
+        return None
+    with _worker_lock:
+        if _worker is None:
+            _worker = RetentionWorker()
+            _worker.start()
+    return _worker
+
+
+def partition_existing_table():
+    """Rebuild an unpartitioned history_entries as a partitioned table, in one transaction"""
+    if engine.dialect.name != 'postgresql':
+        raise SystemExit('Partitioning needs PostgreSQL')
+    init_db()
+    columns = [f'"{column.name}"' for column in HistoryEntry.__table__.columns]
+    values = ['coalesce("timestamp", now())' if column == '"timestamp"' else column for column in columns]
+    with engine.begin() as connection:
+        if is_partitioned(connection):
+            logger.info(f'{TABLE} is already partitioned')
+            return
+        oldest = connection.execute(text(f'SELECT min("timestamp") FROM {TABLE}')).scalar()
+        connection.execute(text(f'ALTER TABLE {TABLE} RENAME TO {TABLE}_unpartitioned'))
+        # Free the primary key's name for the new table
+        connection.execute(text(f'ALTER INDEX IF EXISTS {TABLE}_pkey RENAME TO {TABLE}_unpartitioned_pkey'))
+        create_partitioned_table(connection)
+        ensure_partitions(connection, oldest or datetime.now(timezone.utc), RETENTION['partitions_ahead'])
+        copied = connection.execute(text(
+            f'INSERT INTO {TABLE} ({", ".join(columns)}) '
+            f'SELECT {", ".join(values)} FROM {TABLE}_unpartitioned'
+        )).rowcount
+        connection.execute(text(f'DROP TABLE {TABLE}_unpartitioned'))
+    # Recreate the indexes on the new table
+    init_db()
+    logger.info(f'Partitioned {TABLE} by month ({copied} entries copied)')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Apply the history retention policy or partition the history table')
+    parser.add_argument('command', choices=['run', 'partition'])
+    args = parser.parse_args()
+
+    configure_logging(file=None)
+    if args.command == 'partition':
+        partition_existing_table()
+        return
+    init_db()
+    expired = run_retention()
+    if expired is None:
+        logger.info('Another process is running retention; nothing done')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,225 @@
+import hashlib
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+from sqlalchemy import or_
+from sqlalchemy.exc import IntegrityError
+
+from config import SINGLE_FLIGHT
+from database import SessionLocal
+from metrics import REGISTRY, Counter
+from models import InFlightGeneration
+from pipeline import PipelineError
+
+logger = logging.getLogger(__name__)
+
+COALESCED = REGISTRY.register(Counter(
+    'single_flight_coalesced_total', 'Requests that shared the result of an identical running request'))
+
+
+def request_key(source, params):
+    """Identity of a generation: a hash of the input (file bytes or text) and every generation parameter"""
+    data = source if isinstance(source, (bytes, bytearray)) else source.encode('utf-8')
+    payload = json.dumps({'source': hashlib.sha256(data).hexdigest(), **params}, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Run a generation once for all identical requests that overlap in time.
+
+    Callers in the same process wait on an Event. When shared is set, a claim
+    row in the database does the same across worker processes: the worker
+    holding the claim runs the generation while the others poll the row and
+    then load the finished history entry through load_result.
+    """
+
+    def __init__(self, shared=True, lease_seconds=30.0, poll_interval=0.5,
+                 wait_timeout=1800.0, retain_seconds=600.0):
+        self.shared = shared
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.wait_timeout = wait_timeout
+        self.retain_seconds = retain_seconds
+        self.owner = f'{socket.gethostname()}:{os.getpid()}'
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def run(self, key, generate, load_result):
+        """Return generate()'s result, or that of an identical generation already running.
+
+        generate must return a dict with the 'entry_id' of the saved history
+        entry; load_result(entry_id) rebuilds that result in another worker.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            logger.info(f'Joining in-flight generation {key[:12]} in this process')
+            COALESCED.inc(scope='process')
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = self._run_shared(key, generate, load_result) if self.shared else generate()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def _run_shared(self, key, generate, load_result):
+        deadline = time.monotonic() + self.wait_timeout
+        while True:
+            try:
+                owned, claimed_at = self._claim(key)
+            except Exception as e:
+                # Coalescing is an optimisation; never fail a request over it
+                logger.warning(f'Could not claim generation {key[:12]}, running it anyway: {str(e)}')
+                return generate()
+
+            if owned:
+                return self._run_claimed(key, claimed_at, generate)
+
+            if claimed_at is not None:
+                logger.info(f'Waiting for generation {key[:12]} running in another worker')
+                entry_id = self._wait(key, claimed_at, deadline)
+                if entry_id is not None:
+                    COALESCED.inc(scope='database')
+                    return load_result(entry_id)
+            # The claim went away or its worker stopped; try to take it over
+
+    def _run_claimed(self, key, claimed_at, generate):
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat, args=(key, claimed_at, stop), daemon=True)
+        heartbeat.start()
+        try:
+            result = generate()
+        except PipelineError as e:
+            self._finish(key, claimed_at, 'failed', error=e.message, status_code=e.status_code)
+            raise
+        except Exception as e:
+            self._finish(key, claimed_at, 'failed', error=str(e), status_code=500)
+            raise
+        finally:
+            stop.set()
+        self._finish(key, claimed_at, 'done', entry_id=result['entry_id'])
+        return result
+
+    def _claim(self, key):
+        """Try to become the worker running key; returns (owned, claimed_at of the current run)"""
+        now = time.time()
+        db = SessionLocal()
+        try:
+            db.add(InFlightGeneration(key=key, owner=self.owner, status='running', claimed_at=now, heartbeat_at=now))
+            try:
+                db.commit()
+                return True, now
+            except IntegrityError:
+                db.rollback()
+
+            # Take over a finished run, or one whose worker stopped sending heartbeats
+            taken = db.query(InFlightGeneration).filter(
+                InFlightGeneration.key == key,
+                or_(InFlightGeneration.status != 'running',
+                    InFlightGeneration.heartbeat_at < now - self.lease_seconds)
+            ).update({
+                InFlightGeneration.owner: self.owner,
+                InFlightGeneration.status: 'running',
+                InFlightGeneration.claimed_at: now,
+                InFlightGeneration.heartbeat_at: now,
+                InFlightGeneration.entry_id: None,
+                InFlightGeneration.error: None,
+                InFlightGeneration.status_code: None
+            }, synchronize_session=False)
+            db.commit()
+            if taken:
+                return True, now
+            claimed_at = db.query(InFlightGeneration.claimed_at).filter(InFlightGeneration.key == key).scalar()
+            return False, claimed_at
+        finally:
+            db.close()
+
+    def _wait(self, key, claimed_at, deadline):
+        """Poll another worker's run of key; returns its entry ID, or None if the claim lapsed"""
+        while time.monotonic() < deadline:
+            time.sleep(self.poll_interval)
+            db = SessionLocal()
+            try:
+                row = db.query(InFlightGeneration).filter(InFlightGeneration.key == key).first()
+            finally:
+                db.close()
+            if row is None or row.claimed_at != claimed_at:
+                return None
+            if row.status == 'done':
+                return row.entry_id
+            if row.status == 'failed':
+                raise PipelineError(row.error or 'Generation failed', row.status_code or 500)
+            if row.heartbeat_at < time.time() - self.lease_seconds:
+                return None
+        raise PipelineError('Timed out waiting for an identical request to finish', 504)
+
+    def _heartbeat(self, key, claimed_at, stop):
+        while not stop.wait(self.lease_seconds / 3):
+            self._update(key, claimed_at, {InFlightGeneration.heartbeat_at: time.time()})
+
+    def _finish(self, key, claimed_at, status, entry_id=None, error=None, status_code=None):
+        now = time.time()
+        self._update(key, claimed_at, {
+            InFlightGeneration.status: status,
+            InFlightGeneration.heartbeat_at: now,
+            InFlightGeneration.entry_id: entry_id,
+            InFlightGeneration.error: error,
+            InFlightGeneration.status_code: status_code
+        }, purge_before=now - self.retain_seconds)
+
+    def _update(self, key, claimed_at, values, purge_before=None):
+        db = SessionLocal()
+        try:
+            db.query(InFlightGeneration).filter(
+                InFlightGeneration.key == key, InFlightGeneration.claimed_at == claimed_at
+            ).update(values, synchronize_session=False)
+            if purge_before is not None:
+                # Finished claims are only needed until their waiters have read them
+                db.query(InFlightGeneration).filter(
+                    InFlightGeneration.status != 'running', InFlightGeneration.heartbeat_at < purge_before
+                ).delete(synchronize_session=False)
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            logger.warning(f'Could not update generation claim {key[:12]}: {str(e)}')
+        finally:
+            db.close()
+
+
+_single_flight = None
+_single_flight_lock = threading.Lock()
+
+
+def get_single_flight():
+    """Return the process-wide SingleFlight configured in config.SINGLE_FLIGHT"""
+    global _single_flight
+    if _single_flight is None:
+        with _single_flight_lock:
+            if _single_flight is None:
+                settings = {key: value for key, value in SINGLE_FLIGHT.items() if key != 'enabled'}
+                _single_flight = SingleFlight(**settings)
+    return _single_flight
@@ -0,0 +1,36 @@
+"""Shared test setup: a scratch SQLite database and blob store, configured before the app modules load"""
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# config.py and database.py read the environment when they are first imported
+SCRATCH = tempfile.mkdtemp(prefix='aoai-tests-')
+os.environ['DATABASE_URL'] = f'sqlite:///{os.path.join(SCRATCH, "test.db")}'
+os.environ['BLOB_STORE_BACKEND'] = 'local'
+os.environ['BLOB_STORE_PATH'] = os.path.join(SCRATCH, 'blobs')
+
+
+@pytest.fixture
+def database():
+    """Empty tables, created on first use and cleared after each test"""
+    from database import Base, engine, init_db
+    init_db()
+    yield engine
+    with engine.begin() as connection:
+        for table in reversed(Base.metadata.sorted_tables):
+            connection.execute(table.delete())
+
+
+@pytest.fixture
+def history(database, tmp_path):
+    """A HistoryManager over the scratch database and a blob store of its own"""
+    from blobstore import LocalBlobStore
+    from history import HistoryManager
+    manager = HistoryManager(blob_store=LocalBlobStore(str(tmp_path / 'blobs')))
+    yield manager
+    manager.db.remove()
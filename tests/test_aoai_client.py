@@ -0,0 +1,221 @@
+import threading
+import time
+
+import httpx
+import pytest
+from openai import BadRequestError, InternalServerError, RateLimitError
+
+from aoai_client import (PRIORITY_BATCH, PRIORITY_INTERACTIVE, Deployment, DeploymentLimiter, DeploymentPool,
+                         RateLimitedClient, TokenBucket)
+
+
+class FakeClock:
+    """Time that only moves when a test advances it"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds, limiter=None):
+        self.now += seconds
+        if limiter is not None:
+            # Wake waiters, whose timeouts run on real time
+            with limiter._cond:
+                limiter._cond.notify_all()
+
+
+def wait_until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.001)
+
+
+def test_token_bucket_refills_up_to_capacity():
+    bucket = TokenBucket(60, now=0.0)
+    bucket.level = 0.0
+
+    bucket.refill(2.5)
+    assert bucket.level == pytest.approx(2.5)
+    assert bucket.wait_time(4) == pytest.approx(1.5)
+    # Larger than the bucket: waits for a full bucket only
+    assert bucket.wait_time(1000) == pytest.approx(57.5)
+
+    bucket.refill(500.0)
+    assert bucket.level == 60.0
+
+
+def test_batch_waiter_queued_first_is_served_after_interactive():
+    clock = FakeClock()
+    limiter = DeploymentLimiter('test', rpm=60, tpm=100000, clock=clock)
+    limiter.requests.level = 0.0
+    served = []
+
+    def acquire(name, priority):
+        limiter.acquire(10, priority)
+        served.append(name)
+
+    batch = threading.Thread(target=acquire, args=('batch', PRIORITY_BATCH))
+    batch.start()
+    wait_until(lambda: len(limiter._waiters) == 1)
+    interactive = threading.Thread(target=acquire, args=('interactive', PRIORITY_INTERACTIVE))
+    interactive.start()
+    wait_until(lambda: len(limiter._waiters) == 2)
+
+    # One request's worth of capacity: it goes to the interactive waiter
+    clock.advance(1.0, limiter)
+    interactive.join(5)
+    assert served == ['interactive']
+    assert batch.is_alive()
+
+    clock.advance(1.0, limiter)
+    batch.join(5)
+    assert served == ['interactive', 'batch']
+
+
+def test_throttling_pauses_and_slows_the_deployment():
+    clock = FakeClock()
+    limiter = DeploymentLimiter('test', rpm=600, tpm=100000, clock=clock)
+
+    limiter.on_throttled(retry_after=2.0)
+
+    assert limiter.blocked_until == clock.now + 2.0
+    assert limiter.requests.rate * 60 == pytest.approx(420)
+    assert limiter.estimated_wait(10) == pytest.approx(2.0)
+    # More 429s from the same overload do not cut the rate again
+    limiter.on_throttled(retry_after=0.5)
+    assert limiter.requests.rate * 60 == pytest.approx(420)
+
+    limiter.on_success()
+    assert limiter.requests.rate * 60 == pytest.approx(450)
+    for _ in range(20):
+        limiter.on_success()
+    assert limiter.requests.rate * 60 == 600
+
+
+def test_ratelimit_headers_clamp_the_buckets():
+    limiter = DeploymentLimiter('test', rpm=600, tpm=100000, clock=FakeClock())
+
+    limiter.observe_headers({'x-ratelimit-remaining-requests': '3', 'x-ratelimit-remaining-tokens': '2500'})
+    assert limiter.requests.level == 3
+    assert limiter.tokens.level == 2500
+
+    # Headers never raise the local estimate
+    limiter.observe_headers({'x-ratelimit-remaining-requests': '500', 'x-ratelimit-remaining-tokens': 'n/a'})
+    assert limiter.requests.level == 3
+    assert limiter.tokens.level == 2500
+
+
+class FakeRawResponse:
+    def __init__(self, headers=None):
+        self.headers = headers or {}
+
+    def parse(self):
+        return 'completion'
+
+
+class FakeClient:
+    """Stands in for AzureOpenAI: each call takes the next outcome, an exception or response headers"""
+
+    def __init__(self, outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = 0
+        self.chat = self.completions = self.with_raw_response = self
+
+    def create(self, **kwargs):
+        self.calls += 1
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return FakeRawResponse(outcome)
+
+
+def status_error(error_class, status_code, headers=None):
+    request = httpx.Request('POST', 'https://example.openai.azure.com/openai/deployments/test/chat/completions')
+    response = httpx.Response(status_code, headers=headers, request=request)
+    return error_class(f'HTTP {status_code}', response=response, body=None)
+
+
+def make_client(clock, *outcomes_per_deployment):
+    deployments = []
+    for index, outcomes in enumerate(outcomes_per_deployment):
+        deployment = Deployment('text', f'gpt-4o-{index}', f'https://region{index}.openai.azure.com',
+                                'key', '2024-10-01-preview', rpm=600, tpm=100000)
+        deployment.client = FakeClient(outcomes)
+        deployment.limiter = DeploymentLimiter(deployment.label, 600, 100000, clock=clock)
+        deployments.append(deployment)
+    sleeps = []
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        clock.advance(seconds)
+
+    client = RateLimitedClient({'text': DeploymentPool('text', deployments)}, base_delay=0.01, max_delay=0.05,
+                               clock=clock, sleep=sleep)
+    return client, deployments, sleeps
+
+
+def test_429_with_retry_after_pauses_the_deployment_before_retrying():
+    clock = FakeClock()
+    throttled = status_error(RateLimitError, 429, {'retry-after': '2', 'x-ratelimit-remaining-requests': '0'})
+    client, (deployment,), sleeps = make_client(clock, [throttled, {}])
+    start = clock.now
+
+    assert client.create_chat_completion(role='text', messages=[{'role': 'user', 'content': 'Hi'}]) == 'completion'
+
+    assert deployment.client.calls == 2
+    # Retry-After wins over the (shorter) backoff
+    assert sleeps == [2.0]
+    assert deployment.limiter.blocked_until == start + 2.0
+    assert deployment.limiter.requests.rate * 60 < 600
+
+
+def test_5xx_fails_over_to_an_untried_deployment_before_backing_off():
+    clock = FakeClock()
+    client, (first, second), sleeps = make_client(clock, [status_error(InternalServerError, 500)], [{}])
+
+    assert client.create_chat_completion(role='text', messages=[{'role': 'user', 'content': 'Hi'}]) == 'completion'
+
+    assert (first.client.calls, second.client.calls) == (1, 1)
+    assert sleeps == []
+    assert first.consecutive_failures == 1
+
+
+def test_backs_off_once_every_deployment_has_failed():
+    clock = FakeClock()
+    client, (first, second), sleeps = make_client(
+        clock, [status_error(InternalServerError, 500), {}], [status_error(InternalServerError, 503)])
+
+    assert client.create_chat_completion(role='text', messages=[{'role': 'user', 'content': 'Hi'}]) == 'completion'
+
+    assert (first.client.calls, second.client.calls) == (2, 1)
+    assert len(sleeps) == 1 and 0 <= sleeps[0] <= 0.05
+
+
+def test_client_errors_are_not_retried():
+    clock = FakeClock()
+    client, (deployment,), sleeps = make_client(clock, [status_error(BadRequestError, 400), {}])
+
+    with pytest.raises(BadRequestError):
+        client.create_chat_completion(role='text', messages=[{'role': 'user', 'content': 'Hi'}])
+    assert deployment.client.calls == 1
+    assert sleeps == []
+
+
+def test_quota_fraction_and_workers_split_each_deployment_quota(monkeypatch):
+    from aoai_client import create_client
+    from config import AZURE_DEPLOYMENTS
+    # The AzureOpenAI clients fall back to these when the config has no credentials
+    monkeypatch.setenv('AZURE_OPENAI_API_KEY', 'test')
+    monkeypatch.setenv('AZURE_OPENAI_ENDPOINT', 'https://example.openai.azure.com')
+    monkeypatch.setenv('AZURE_OPENAI_QUOTA_WORKERS', '2')
+    monkeypatch.setenv('AZURE_OPENAI_QUOTA_FRACTION', '0.3')
+
+    client = create_client()
+
+    for role, entries in AZURE_DEPLOYMENTS.items():
+        for entry, deployment in zip(entries, client.pools[role].deployments):
+            assert deployment.limiter.max_rpm == max(1, int(entry['rpm'] * 0.15))
+            assert deployment.limiter.tokens.capacity == max(1, int(entry['tpm'] * 0.15))
@@ -0,0 +1,100 @@
+import json
+
+import pytest
+
+import batch
+from benchmarks.fake_aoai import make_wav
+from models import HistoryEntry
+
+
+class Crash(Exception):
+    """Stands in for the process dying at a given point"""
+
+
+@pytest.fixture
+def jobs(tmp_path):
+    folder = tmp_path / 'documents'
+    folder.mkdir()
+    for index in range(3):
+        (folder / f'report-{index}.txt').write_text(f'Report {index}')
+    return batch.load_jobs(str(folder), batch.PARAMETER_DEFAULTS)
+
+
+@pytest.fixture
+def generated(history, monkeypatch):
+    """Run jobs without calling the models, recording which documents were generated"""
+    paths = []
+
+    def run_job(job):
+        paths.append(job['path'])
+        return {
+            'audio': make_wav(0.1),
+            'summary_html': '<p>Summary</p>',
+            'original_filename': job['path'].rsplit('/', 1)[-1],
+            'metadata': {'batch': True},
+            'extracted_text': 'Text',
+        }
+
+    monkeypatch.setattr(batch, 'run_job', run_job)
+    monkeypatch.setattr(batch, 'HistoryManager', lambda: history)
+    return paths
+
+
+def entry_count(history):
+    count = history.db.query(HistoryEntry).count()
+    history.db.commit()
+    return count
+
+
+def checkpoint_statuses(path):
+    statuses = {}
+    with open(path) as f:
+        for line in f:
+            record = json.loads(line)
+            statuses[record['key']] = record['status']
+    return statuses
+
+
+def test_resume_after_a_crash_between_commit_and_checkpoint_does_not_regenerate(
+        history, jobs, generated, tmp_path, monkeypatch):
+    checkpoint = str(tmp_path / 'checkpoint.jsonl')
+    append_checkpoint = batch.append_checkpoint
+
+    def crash_before_done(path, records):
+        if records[0]['status'] == 'done':
+            raise Crash()
+        append_checkpoint(path, records)
+
+    monkeypatch.setattr(batch, 'append_checkpoint', crash_before_done)
+    with pytest.raises(Crash):
+        batch.run_batch(jobs, 1, 10, checkpoint)
+    assert entry_count(history) == 3
+    monkeypatch.setattr(batch, 'append_checkpoint', append_checkpoint)
+    generated.clear()
+
+    assert batch.run_batch(jobs, 1, 10, checkpoint) == (0, 0)
+
+    assert generated == []
+    assert entry_count(history) == 3
+    assert set(checkpoint_statuses(checkpoint).values()) == {'done'}
+
+
+def test_resume_after_a_crash_before_commit_regenerates(history, jobs, generated, tmp_path, monkeypatch):
+    checkpoint = str(tmp_path / 'checkpoint.jsonl')
+    save_entries = history.save_entries
+
+    def crash(items):
+        raise Crash()
+
+    monkeypatch.setattr(history, 'save_entries', crash)
+    with pytest.raises(Crash):
+        batch.run_batch(jobs, 1, 10, checkpoint)
+    assert entry_count(history) == 0
+    monkeypatch.setattr(history, 'save_entries', save_entries)
+    generated.clear()
+
+    assert batch.run_batch(jobs, 1, 10, checkpoint) == (3, 0)
+
+    assert sorted(generated) == sorted(job['path'] for job in jobs)
+    assert entry_count(history) == 3
+    assert set(checkpoint_statuses(checkpoint).values()) == {'done'}
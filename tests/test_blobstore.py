@@ -0,0 +1,109 @@
+import io
+import os
+
+import pytest
+
+from blobstore import BlobNotFound, BlobStore, LocalBlobStore, content_hash
+
+
+def test_incomplete_backend_fails_when_created():
+    class NoDelete(BlobStore):
+        def put(self, data, mime_type='application/octet-stream'):
+            return content_hash(data)
+
+        def get(self, digest):
+            return b''
+
+        def size(self, digest):
+            return 0
+
+        def exists(self, digest):
+            return False
+
+    with pytest.raises(TypeError, match='delete'):
+        NoDelete()
+
+
+def test_local_store_round_trip(tmp_path):
+    store = LocalBlobStore(str(tmp_path))
+    data = b'RIFF' + bytes(range(256)) * 64
+
+    digest = store.put(data)
+
+    assert digest == content_hash(data)
+    assert store.put(io.BytesIO(data)) == digest
+    assert store.exists(digest)
+    assert store.size(digest) == len(data)
+    assert store.get(digest) == data
+    store.delete(digest)
+    store.delete(digest)
+    assert not store.exists(digest)
+    with pytest.raises(BlobNotFound):
+        store.get(digest)
+
+
+@pytest.fixture
+def s3_store(monkeypatch):
+    """An S3BlobStore on a fresh bucket: MinIO when TEST_S3_ENDPOINT_URL is set, moto otherwise"""
+    import uuid
+    from blobstore import S3BlobStore
+
+    endpoint_url = os.getenv('TEST_S3_ENDPOINT_URL')
+    if endpoint_url:
+        # docker-compose --profile s3 up -d minio, then TEST_S3_ENDPOINT_URL=http://localhost:9000
+        store = S3BlobStore(f'aoai-test-{uuid.uuid4().hex[:12]}', prefix='audio', endpoint_url=endpoint_url,
+                            region='us-east-1', access_key=os.getenv('TEST_S3_ACCESS_KEY', 'minioadmin'),
+                            secret_key=os.getenv('TEST_S3_SECRET_KEY', 'minioadmin'))
+        store.client.create_bucket(Bucket=store.bucket)
+        yield store
+        for item in store.client.list_objects_v2(Bucket=store.bucket).get('Contents', []):
+            store.client.delete_object(Bucket=store.bucket, Key=item['Key'])
+        store.client.delete_bucket(Bucket=store.bucket)
+        return
+
+    moto = pytest.importorskip('moto')
+    for name in ('AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY'):
+        monkeypatch.setenv(name, 'testing')
+    with moto.mock_aws():
+        store = S3BlobStore('aoai-test', prefix='audio', region='us-east-1')
+        store.client.create_bucket(Bucket=store.bucket)
+        yield store
+
+
+def test_s3_store_round_trip(s3_store):
+    data = b'RIFF' + bytes(range(256)) * 64
+
+    digest = s3_store.put(data, 'audio/wav')
+
+    assert digest == content_hash(data)
+    assert s3_store.exists(digest)
+    assert s3_store.size(digest) == len(data)
+    assert s3_store.get(digest) == data
+    with s3_store.open(digest) as body:
+        assert body.read() == data
+    head = s3_store.client.head_object(Bucket=s3_store.bucket, Key=s3_store.key(digest))
+    assert head['ContentType'] == 'audio/wav'
+    assert s3_store.key(digest).startswith(f'audio/{digest[:2]}/{digest[2:4]}/')
+
+    s3_store.delete(digest)
+
+    assert not s3_store.exists(digest)
+    with pytest.raises(BlobNotFound):
+        s3_store.get(digest)
+    with pytest.raises(BlobNotFound):
+        s3_store.size(digest)
+
+
+def test_s3_store_stream_put(s3_store):
+    # Larger than the in-memory part of the spool, so it goes through a temporary file
+    data = os.urandom(9 * 1024 * 1024)
+
+    digest = s3_store.put(io.BytesIO(data), 'audio/wav')
+
+    assert digest == content_hash(data)
+    assert s3_store.size(digest) == len(data)
+    assert s3_store.get(digest) == data
+    # The same content again is recognised without a second upload
+    assert s3_store.put(io.BytesIO(data)) == digest
+    assert s3_store.put(data) == digest
+    assert s3_store.client.list_objects_v2(Bucket=s3_store.bucket)['KeyCount'] == 1
@@ -0,0 +1,61 @@
+import io
+
+from benchmarks.fake_aoai import make_wav
+from blobstore import content_hash
+
+
+def save(history, audio):
+    return history.save_entry(audio, '<p>Summary</p>', 'report.txt', {'language': 'english'}, 'Text')
+
+
+def release_after_first_put(store):
+    """Make the store's next put() lose the race with a release.
+
+    The release checks the blob's references after put() has returned, before
+    the save has locked the blob, and deletes it. Returns the list of digests
+    put() is called with.
+    """
+    put = store.put
+    calls = []
+
+    def put_then_release(data, mime_type='application/octet-stream'):
+        digest = put(data, mime_type)
+        if not calls:
+            store.delete(digest)
+        calls.append(digest)
+        return digest
+
+    store.put = put_then_release
+    return calls
+
+
+def test_release_deletes_only_unreferenced_blobs(history):
+    shared, own = make_wav(0.1), make_wav(0.2)
+    first, _, third = save(history, shared), save(history, shared), save(history, own)
+
+    assert history.delete_entries([first, third]) == 2
+
+    assert history.blob_store.exists(content_hash(shared))
+    assert not history.blob_store.exists(content_hash(own))
+
+
+def test_save_stores_again_a_blob_released_while_it_was_being_saved(history):
+    audio = make_wav(0.1)
+    calls = release_after_first_put(history.blob_store)
+
+    entry_id = save(history, audio)
+
+    assert calls == [content_hash(audio)] * 2
+    audio_file, size, _, _ = history.open_audio(entry_id)
+    with audio_file:
+        assert audio_file.read() == audio
+    assert size == len(audio)
+
+
+def test_save_rewinds_a_stream_released_while_it_was_being_saved(history):
+    audio = make_wav(0.1)
+    release_after_first_put(history.blob_store)
+
+    save(history, io.BytesIO(audio))
+
+    assert history.blob_store.get(content_hash(audio)) == audio
@@ -0,0 +1,26 @@
+import pipeline
+from metrics import current_span, span
+
+
+def test_streamed_chunks_are_synthesized_outside_the_summarize_span(monkeypatch):
+    def summarize_text(*args, stream=False):
+        with span('summarize'):
+            yield 'First sentence. '
+            yield 'Second sentence. '
+            yield 'Third one. '
+
+    def synthesize_chunk(chunk, index, language, voice, tone):
+        stage = current_span()
+        return stage.stage if stage is not None else None
+
+    monkeypatch.setattr(pipeline, 'summarize_text', summarize_text)
+    monkeypatch.setattr(pipeline, 'synthesize_chunk', synthesize_chunk)
+    monkeypatch.setitem(pipeline.PIPELINE, 'max_chunk_chars', 20)
+
+    with span('request'):
+        _, futures, chunks = pipeline.stream_narration('Text', 1, 'conversational', 'english',
+                                                       'general_summary')
+
+    # The first chunk is cut while the summary is still being written
+    assert chunks == ['First sentence.', 'Second sentence.', 'Third one.']
+    assert [future.result(5) for future in futures] == ['request'] * 3
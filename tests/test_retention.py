@@ -0,0 +1,114 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from benchmarks.fake_aoai import make_wav
+from blobstore import content_hash
+from models import HistoryEntry, SourceDocument
+from retention import expire_by_age, expire_by_size, run_retention
+
+NOW = datetime.now(timezone.utc)
+
+SETTINGS = {
+    'max_age_days': 0,
+    'max_total_bytes': 0,
+    'interval_seconds': 3600,
+    'batch_size': 2,
+    'batch_pause': 0.0,
+    'partition': True,
+    'partitions_ahead': 2,
+}
+
+
+def seed(history, days_ago, audio, source_id=None):
+    """Save an entry and backdate it"""
+    entry_id = history.save_entry(audio, '<p>Summary</p>', 'report.txt', {}, None, source_id=source_id)
+    history.db.query(HistoryEntry).filter(HistoryEntry.id == entry_id).update(
+        {HistoryEntry.timestamp: NOW - timedelta(days=days_ago)}, synchronize_session=False)
+    history.db.commit()
+    return entry_id
+
+
+def remaining(history):
+    ids = {entry_id for (entry_id,) in history.db.query(HistoryEntry.id)}
+    history.db.commit()
+    return ids
+
+
+@pytest.fixture
+def entries(history):
+    """Eight entries from 45 days to an hour old; the oldest shares its audio with the newest"""
+    shared = make_wav(0.3)
+    audio = {days: make_wav(0.1 + days / 1000) for days in (40, 35, 30, 20, 10)}
+    ids = {
+        'old_shared': seed(history, 45, shared),
+        **{f'old_{days}': seed(history, days, audio[days]) for days in (40, 35, 30)},
+        # Same timestamp as old_30, which ends a batch of two, so the keyset
+        # has to break the tie on id
+        'old_30b': seed(history, 30, make_wav(0.05)),
+        'recent_20': seed(history, 20, audio[20]),
+        'recent_10': seed(history, 10, audio[10]),
+        'new_shared': seed(history, 1 / 24, shared),
+    }
+    hashes = {name: content_hash(audio[int(name.rsplit('_', 1)[1])]) for name in ids if name[-2:].isdigit()}
+    hashes['shared'] = content_hash(shared)
+    return ids, hashes
+
+
+def test_expire_by_age_deletes_old_rows_in_batches_and_releases_their_blobs(history, entries):
+    ids, hashes = entries
+
+    deleted = expire_by_age(history, NOW - timedelta(days=25), batch_size=2)
+
+    assert deleted == 5
+    assert remaining(history) == {ids['recent_20'], ids['recent_10'], ids['new_shared']}
+    store = history.blob_store
+    assert not any(store.exists(hashes[name]) for name in ('old_40', 'old_35', 'old_30'))
+    assert store.exists(hashes['recent_20']) and store.exists(hashes['recent_10'])
+    # Still used by the new entry
+    assert store.exists(hashes['shared'])
+
+
+def test_expire_by_size_deletes_oldest_until_under_the_limit(history, entries):
+    ids, hashes = entries
+    sizes = dict(history.db.query(HistoryEntry.id, HistoryEntry.audio_size))
+    history.db.commit()
+    keep = [ids['recent_20'], ids['recent_10'], ids['new_shared']]
+    limit = sum(sizes[entry_id] for entry_id in keep) + sizes[ids['old_30b']] - 1
+
+    deleted = expire_by_size(history, limit, batch_size=2)
+
+    # One byte too few for old_30b, which is the newest of the old entries
+    assert deleted == 5
+    assert remaining(history) == set(keep)
+    assert sum(sizes[entry_id] for entry_id in remaining(history)) <= limit
+    assert not history.blob_store.exists(hashes['old_40'])
+    assert history.blob_store.exists(hashes['shared'])
+
+
+def test_expire_by_size_does_nothing_under_the_limit(history, entries):
+    ids, _ = entries
+
+    assert expire_by_size(history, 10 ** 9, batch_size=2) == 0
+    assert remaining(history) == set(ids.values())
+
+
+def test_run_retention_applies_both_limits_and_purges_unused_sources(history, entries):
+    ids, hashes = entries
+    sizes = dict(history.db.query(HistoryEntry.id, HistoryEntry.audio_size))
+    history.save_source('unused', 'old.txt', 'vision', 'Old text')
+    history.save_source('used', 'new.txt', 'vision', 'New text')
+    seed(history, 0, make_wav(0.01), source_id='used')
+    history.db.query(SourceDocument).update(
+        {SourceDocument.created_at: NOW - timedelta(days=2)}, synchronize_session=False)
+    history.db.commit()
+    total_recent = sum(sizes[ids[name]] for name in ('recent_20', 'recent_10', 'new_shared'))
+
+    expired = run_retention({**SETTINGS, 'max_age_days': 25, 'max_total_bytes': total_recent},
+                            manager=history)
+
+    # Age takes the five old entries, size then the oldest remaining one
+    assert expired == {'age': 5, 'size': 1}
+    assert ids['recent_20'] not in remaining(history)
+    assert not history.blob_store.exists(hashes['recent_20'])
+    assert {source_id for (source_id,) in history.db.query(SourceDocument.id)} == {'used'}
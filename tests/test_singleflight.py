@@ -0,0 +1,152 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from models import InFlightGeneration
+from pipeline import PipelineError
+from singleflight import COALESCED, SingleFlight
+
+KEY = 'a' * 64
+
+
+def worker(name, **settings):
+    """A SingleFlight standing in for one server worker"""
+    single_flight = SingleFlight(**{'lease_seconds': 0.3, 'poll_interval': 0.02, 'wait_timeout': 10.0, **settings})
+    single_flight.owner = name
+    return single_flight
+
+
+def claim_row(database):
+    from database import SessionLocal
+    db = SessionLocal()
+    try:
+        return db.query(InFlightGeneration).filter(InFlightGeneration.key == KEY).first()
+    finally:
+        db.close()
+
+
+def wait_until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.005)
+
+
+def loaded(entry_id):
+    return {'entry_id': entry_id, 'loaded': True}
+
+
+def coalesced(scope):
+    return sum(value for labels, value in COALESCED.snapshot() if dict(labels).get('scope') == scope)
+
+
+def record_claims(single_flight):
+    """Record the (owned, claimed_at) result of each of the worker's claim attempts"""
+    claims = []
+    claim = single_flight._claim
+    single_flight._claim = lambda key: claims.append(claim(key)) or claims[-1]
+    return claims
+
+
+def test_exactly_one_of_several_claimers_leads(database):
+    workers = [worker(f'worker-{index}') for index in range(8)]
+    start = threading.Barrier(len(workers))
+
+    def claim(single_flight):
+        start.wait()
+        return single_flight._claim(KEY)
+
+    with ThreadPoolExecutor(len(workers)) as executor:
+        results = list(executor.map(claim, workers))
+
+    leaders = [single_flight.owner for single_flight, (owned, _) in zip(workers, results) if owned]
+    assert len(leaders) == 1
+    # Everyone agrees on which run they are waiting for
+    assert len({claimed_at for _, claimed_at in results}) == 1
+    assert claim_row(database).owner == leaders[0]
+
+
+def test_other_worker_waits_for_the_leader_and_loads_its_entry(database):
+    leader, follower = worker('worker-a'), worker('worker-b')
+    release = threading.Event()
+    calls = []
+
+    def generate():
+        calls.append('generate')
+        # Longer than the lease, so this only works if heartbeats renew it
+        release.wait(5)
+        return {'entry_id': 'entry-1'}
+
+    with ThreadPoolExecutor(2) as executor:
+        leading = executor.submit(leader.run, KEY, generate, loaded)
+        wait_until(lambda: claim_row(database) is not None)
+        following = executor.submit(follower.run, KEY, generate, loaded)
+        time.sleep(3 * leader.lease_seconds)
+        release.set()
+
+        assert leading.result(5) == {'entry_id': 'entry-1'}
+        assert following.result(5) == {'entry_id': 'entry-1', 'loaded': True}
+    assert calls == ['generate']
+    row = claim_row(database)
+    assert (row.owner, row.status, row.entry_id) == ('worker-a', 'done', 'entry-1')
+
+
+def test_lapsed_claim_is_taken_over(database):
+    stalled, successor = worker('worker-a'), worker('worker-b')
+    # A worker that claimed the key and stopped without sending heartbeats
+    owned, claimed_at = stalled._claim(KEY)
+    assert owned
+
+    result = successor.run(KEY, lambda: {'entry_id': 'entry-2'}, loaded)
+
+    assert result == {'entry_id': 'entry-2'}
+    row = claim_row(database)
+    assert (row.owner, row.status, row.entry_id) == ('worker-b', 'done', 'entry-2')
+    assert row.claimed_at > claimed_at
+    # The stalled worker's late updates no longer touch the new run
+    stalled._finish(KEY, claimed_at, 'failed', error='late', status_code=500)
+    assert claim_row(database).status == 'done'
+
+
+def test_live_claim_is_not_taken_over(database):
+    leader, other = worker('worker-a'), worker('worker-b')
+    owned, claimed_at = leader._claim(KEY)
+
+    assert other._claim(KEY) == (False, claimed_at)
+
+
+def test_leader_failure_reaches_waiters_with_its_status_code(database):
+    leader, follower = worker('worker-a'), worker('worker-b')
+    follower_claims = record_claims(follower)
+    release = threading.Event()
+    generated = []
+
+    def generate():
+        release.wait(5)
+        raise PipelineError('Could not extract text from file', 400)
+
+    def generate_again():
+        generated.append('generate')
+        return {'entry_id': 'unexpected'}
+
+    joined = coalesced('process')
+    with ThreadPoolExecutor(3) as executor:
+        leading = executor.submit(leader.run, KEY, generate, loaded)
+        wait_until(lambda: claim_row(database) is not None)
+        # One waiter in the leader's process, one in another worker
+        joining = executor.submit(leader.run, KEY, generate_again, loaded)
+        following = executor.submit(follower.run, KEY, generate_again, loaded)
+        wait_until(lambda: coalesced('process') == joined + 1 and follower_claims)
+        assert follower_claims[0][0] is False
+        release.set()
+
+        for future in (leading, joining, following):
+            with pytest.raises(PipelineError) as failure:
+                future.result(5)
+            assert failure.value.status_code == 400
+            assert failure.value.message == 'Could not extract text from file'
+    assert generated == []
+    row = claim_row(database)
+    assert (row.status, row.status_code) == ('failed', 400)
@@ -0,0 +1,109 @@
+import random
+
+import pytest
+
+from pipeline import PAGE_BREAK, ChunkSplitter, TurnSplitter, split_summary, split_turns
+
+SENTENCES = [
+    "The program reached its third milestone this quarter.",
+    "Teams in every region completed the migration to the new platform!",
+    "Support tickets fell by a third compared with the previous period.",
+    "Was the retirement of the legacy reporting tools on schedule?",
+    "“Automation comes next,” the report says.",
+    "Training starts in the spring (for every team).",
+]
+
+
+def summary_text(seed, pages=6):
+    rng = random.Random(seed)
+    return f'\n{PAGE_BREAK}\n'.join(
+        ' '.join(rng.choice(SENTENCES) for _ in range(rng.randint(1, 30))) for _ in range(pages))
+
+
+def podcast_script(seed, turns=12):
+    rng = random.Random(seed)
+    return '\n'.join(
+        f"{rng.choice(['Speaker 1:', '**Speaker 2 (Guest):**', '- speaker 1 :'])} "
+        + ' '.join(rng.choice(SENTENCES) for _ in range(rng.randint(1, 12)))
+        + (f'\n{PAGE_BREAK}' if rng.random() < 0.2 else '')
+        for _ in range(turns))
+
+
+def fragments(text, seed, max_size):
+    """Cut text into consecutive pieces of random sizes, as a streamed response arrives"""
+    rng = random.Random(seed)
+    pieces, start = [], 0
+    while start < len(text):
+        size = rng.randint(1, max_size)
+        pieces.append(text[start:start + size])
+        start += size
+    return pieces
+
+
+def streamed(splitter, pieces):
+    results = []
+    for piece in pieces:
+        results.extend(splitter.feed(piece))
+    return results + splitter.flush()
+
+
+@pytest.mark.parametrize('seed', range(20))
+@pytest.mark.parametrize('max_size', [1, 3, 17, 200])
+def test_chunks_do_not_depend_on_fragment_sizes(seed, max_size):
+    text = summary_text(seed)
+
+    chunks = streamed(ChunkSplitter(max_chars=300), fragments(text, seed, max_size))
+
+    assert chunks == split_summary(text, max_chars=300)
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_chunks_fit_max_chars_when_there_is_a_sentence_boundary(seed):
+    text = summary_text(seed)
+
+    chunks = split_summary(text, max_chars=250)
+
+    assert chunks
+    assert all(len(chunk) <= 250 for chunk in chunks)
+    assert ' '.join(chunks).split() == text.replace(PAGE_BREAK, '').split()
+
+
+def test_a_sentence_longer_than_max_chars_is_kept_whole():
+    sentence = 'word ' * 80 + 'end.'
+
+    assert split_summary(f'Short one. {sentence} Next.', max_chars=100) == ['Short one.', sentence, 'Next.']
+
+
+@pytest.mark.parametrize('cut', range(1, len(PAGE_BREAK)))
+def test_page_break_split_across_deltas(cut):
+    splitter = ChunkSplitter(max_chars=1000)
+
+    first = splitter.feed('First page.\n' + PAGE_BREAK[:cut])
+    second = splitter.feed(PAGE_BREAK[cut:] + '\nSecond page.')
+
+    assert first == []
+    assert second == ['First page.']
+    assert splitter.flush() == ['Second page.']
+
+
+@pytest.mark.parametrize('seed', range(20))
+@pytest.mark.parametrize('max_size', [1, 4, 40])
+def test_turns_do_not_depend_on_fragment_sizes(seed, max_size):
+    script = podcast_script(seed)
+
+    turns = streamed(TurnSplitter(max_chars=200), fragments(script, seed, max_size))
+
+    assert turns == split_turns(script, max_chars=200)
+    assert all(len(text) <= 200 for _, text in turns)
+    assert all(PAGE_BREAK not in text and 'peaker' not in text for _, text in turns)
+
+
+@pytest.mark.parametrize('cut', range(1, len('**Speaker 2 (Guest):** ')))
+def test_speaker_label_split_across_deltas(cut):
+    script = 'Speaker 1: What changed this quarter?\n**Speaker 2 (Guest):** The migration finished.\n'
+    label_start = script.index('**Speaker 2')
+    splitter = TurnSplitter(max_chars=400)
+
+    turns = streamed(splitter, [script[:label_start + cut], script[label_start + cut:]])
+
+    assert turns == [(1, 'What changed this quarter?'), (2, 'The migration finished.')]
@@ -0,0 +1,9 @@
+"""WSGI entry point for production servers: gunicorn wsgi:app -c gunicorn.conf.py"""
+from app import create_app
+from pipeline import preload_modules
+
+app = create_app()
+
+# Loaded once in the gunicorn master (preload_app), so forked workers share
+# these modules' memory copy-on-write instead of each importing their own
+preload_modules()